@@ -9,7 +9,6 @@
  This is distributed under GNU LGPL license, see license.txt
 
 """
-from __future__ import print_function
 
 import sys
 import struct
@@ -17,7 +16,6 @@ import struct
 from modbus_tk.simulator import Simulator, LOGGER
 from modbus_tk.defines import HOLDING_REGISTERS
 from modbus_tk.modbus_tcp import TcpServer
-from modbus_tk.utils import PY2
 
 try:
     import serial
@@ -68,10 +66,7 @@ class MySimulator(Simulator):
         # operates on slave 1 and block foo
         slave = self.server.get_slave(1)
 
-        if PY2:
-            pi_bytes = [ord(a_byte) for a_byte in struct.pack("f", 3.14)]
-        else:
-            pi_bytes = [int(a_byte) for a_byte in struct.pack("f", 3.14)]
+        pi_bytes = [int(a_byte) for a_byte in struct.pack("f", 3.14)]
 
         pi_register1 = pi_bytes[0] * 256 + pi_bytes[1]
         pi_register2 = pi_bytes[2] * 256 + pi_bytes[3]
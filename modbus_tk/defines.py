@@ -17,6 +17,8 @@ SLAVE_DEVICE_FAILURE = 4
 COMMAND_ACKNOWLEDGE = 5
 SLAVE_DEVICE_BUSY = 6
 MEMORY_PARITY_ERROR = 8
+GATEWAY_PATH_UNAVAILABLE = 10
+GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND = 11
 
 #supported modbus functions
 RAW = 0
@@ -41,3 +43,9 @@ COILS = 1
 DISCRETE_INPUTS = 2
 HOLDING_REGISTERS = 3
 ANALOG_INPUTS = 4
+
+#maximum number of values in one query
+MAX_READ_BITS = 2000
+MAX_READ_REGISTERS = 125
+MAX_WRITE_BITS = 1968
+MAX_WRITE_REGISTERS = 123
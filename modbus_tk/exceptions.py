@@ -86,3 +86,11 @@ class ModbusInvalidRequestError(Exception):
     with the expected format
     """
     pass
+
+
+class DeadlineExpiredError(Exception):
+    """
+    Exception raised when a query scheduled on a bus is not executed
+    before its deadline
+    """
+    pass
@@ -9,16 +9,42 @@
  This is distributed under GNU LGPL license, see license.txt
 """
 
-from __future__ import with_statement
+import queue
 import threading
+import weakref
 
+from modbus_tk import LOGGER
+
+# serialize the changes of the hooks
 _LOCK = threading.RLock()
+# the tuple of functions of every hook
+# the tuples are replaced and never modified: call_hooks reads them without lock
 _HOOKS = {}
+# the hooks installed for an instance only: {instance: {name: tuple of functions}}
+_INSTANCE_HOOKS = weakref.WeakKeyDictionary()
+
+
+def _update_dispatch(instance):
+    """
+    compute the functions called by every hook of the instance: the global ones and its own ones
+    They are stored in the _hooks attribute of the instance, None if it has no own hooks
+    """
+    own_hooks = _INSTANCE_HOOKS.get(instance)
+    if not own_hooks:
+        instance._hooks = None
+        return
+    dispatch = dict(_HOOKS)
+    for (name, fcts) in own_hooks.items():
+        dispatch[name] = dispatch.get(name, ()) + fcts
+    instance._hooks = dispatch
 
 
-def install_hook(name, fct):
+def install_hook(name, fct, instance=None):
     """
     Install one of the following hook
+    If instance is set, the hook is only called for this master, server, slave or block:
+    the first item of the args of the hook. The global hooks are called first
+    The hooks of the instance are precomputed in its _hooks attribute
 
     modbus_rtu.RtuMaster.before_open((master,))
     modbus_rtu.RtuMaster.after_close((master,)
@@ -43,14 +69,30 @@ def install_hook(name, fct):
     modbus_tcp.TcpMaster.after_recv((master, response))
 
 
+    modbus_tcp_async.AsyncTcpMaster.before_connect((master, ))
+    modbus_tcp_async.AsyncTcpMaster.after_connect((master, ))
+    modbus_tcp_async.AsyncTcpMaster.before_close((master, ))
+    modbus_tcp_async.AsyncTcpMaster.after_close((master, ))
+    modbus_tcp_async.AsyncTcpMaster.before_send((master, request)) returns modified request or None
+    modbus_tcp_async.AsyncTcpMaster.after_recv((master, response)) returns modified response or None
+
     modbus_tcp.TcpServer.on_connect((server, client, address))
     modbus_tcp.TcpServer.on_disconnect((server, sock))
-    modbus_tcp.TcpServer.after_recv((server, sock, request)) returns modified request or None
+    modbus_tcp.TcpServer.after_recv((server, sock, mbap)) returns modified mbap or None
     modbus_tcp.TcpServer.before_send((server, sock, response)) returns modified response or None
     modbus_tcp.TcpServer.on_error((server, sock, excpt))
 
+    modbus_tcp_async.AsyncTcpServer.on_connect((server, writer, address))
+    modbus_tcp_async.AsyncTcpServer.on_disconnect((server, writer))
+    modbus_tcp_async.AsyncTcpServer.after_recv((server, writer, request)) returns modified request or None
+    modbus_tcp_async.AsyncTcpServer.before_send((server, writer, response)) returns modified response or None
+    modbus_tcp_async.AsyncTcpServer.after_send((server, writer, response))
+    modbus_tcp_async.AsyncTcpServer.on_error((server, writer, excpt))
+
     modbus_rtu_over_tcp.RtuOverTcpMaster.after_recv((master, response))
 
+    modbus_gateway.TcpRtuGateway.before_forward((gateway, unit_id, pdu)) returns modified pdu or None
+
     modbus.Master.before_send((master, request)) returns modified request or None
     modbus.Master.after_send((master))
     modbus.Master.after_recv((master, response)) returns modified response or None
@@ -74,37 +116,154 @@ def install_hook(name, fct):
 
     modbus.Databank.on_error((db, excpt, request_pdu))
 
-    modbus.ModbusBlock.setitem((self, slice, value))
+    modbus.ModbusBlock.setitem((self, slice, value)) called by a slave once the values are written and unlocked
 
     modbus.Server.before_handle_request((server, request)) returns modified request or None
     modbus.Server.after_handle_request((server, response)) returns modified response or None
     modbus.Server.on_exception((server, excpt))
     """
     with _LOCK:
-        try:
-            _HOOKS[name].append(fct)
-        except KeyError:
-            _HOOKS[name] = [fct]
+        if instance is None:
+            _HOOKS[name] = _HOOKS.get(name, ()) + (fct, )
+            for other in list(_INSTANCE_HOOKS.keys()):
+                _update_dispatch(other)
+        else:
+            own_hooks = dict(_INSTANCE_HOOKS.get(instance, {}))
+            own_hooks[name] = own_hooks.get(name, ()) + (fct, )
+            _INSTANCE_HOOKS[instance] = own_hooks
+            _update_dispatch(instance)
 
 
-def uninstall_hook(name, fct=None):
-    """remove the function from the hooks"""
+def uninstall_hook(name, fct=None, instance=None):
+    """remove the function from the hooks. All the functions if fct is None"""
     with _LOCK:
+        if instance is None:
+            hooks = _HOOKS
+        else:
+            hooks = dict(_INSTANCE_HOOKS.get(instance, {}))
         if fct:
-            _HOOKS[name].remove(fct)
+            fcts = list(hooks[name])
+            fcts.remove(fct)
+            hooks[name] = tuple(fcts)
+        else:
+            hooks[name] = ()
+        if instance is None:
+            for other in list(_INSTANCE_HOOKS.keys()):
+                _update_dispatch(other)
         else:
-            del _HOOKS[name][:]
+            hooks = dict((key, fcts) for (key, fcts) in hooks.items() if fcts)
+            if hooks:
+                _INSTANCE_HOOKS[instance] = hooks
+            else:
+                _INSTANCE_HOOKS.pop(instance, None)
+            _update_dispatch(instance)
 
 
 def call_hooks(name, args):
-    """call the function associated with the hook and pass the given args"""
-    with _LOCK:
+    """
+    call the function associated with the hook and pass the given args
+    No lock is held while the functions run: they may install or uninstall hooks
+    """
+    # the hooks of an instance with its own hooks are precomputed by install_hook
+    hooks = getattr(args[0], "_hooks", None) if args else None
+    fcts = (hooks or _HOOKS).get(name)
+    if fcts:
+        for fct in fcts:
+            retval = fct(args)
+            if retval is not None:
+                return retval
+    return None
+
+
+class HookExecutor(object):
+    """
+    Run the hooks installed by install_async_hook in a background thread
+    The calls are queued: the thread calling the hook doesn't wait for them.
+    When the queue is full, the calls are dropped and counted or the caller waits if block is True
+    """
+
+    def __init__(self, maxsize=1000, block=False):
+        """Constructor: maxsize is the maximum number of calls waiting in the queue"""
+        self._queue = queue.Queue(maxsize)
+        self._block = block
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+
+    def submit(self, fct, args):
+        """queue a call of fct(args)"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="HookExecutor")
+                    self._thread.daemon = True
+                    self._thread.start()
         try:
-            for fct in _HOOKS[name]:
-                retval = fct(args)
-                if retval is not None:
-                    return retval
-        except KeyError:
-            pass
-        return None
+            self._queue.put((fct, args), self._block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def join(self):
+        """wait until all the queued calls are done"""
+        self._queue.join()
+
+    def _run(self):
+        """call the queued functions"""
+        while True:
+            (fct, args) = self._queue.get()
+            try:
+                fct(args)
+            except Exception as excpt:
+                LOGGER.error("Error in the hook %s: %s", fct, excpt)
+            finally:
+                self._queue.task_done()
+
+
+class _AsyncHook(object):
+    """A hook queuing the calls of a function to an executor. Equal to the function for uninstall_hook"""
+
+    def __init__(self, fct, executor):
+        """Constructor"""
+        self.fct = fct
+        self.executor = executor
+
+    def __call__(self, args):
+        """queue the call: the result is always None"""
+        self.executor.submit(self.fct, args)
+
+    def __eq__(self, other):
+        """"""
+        if isinstance(other, _AsyncHook):
+            other = other.fct
+        return self.fct == other
+
+    def __ne__(self, other):
+        """"""
+        return not self == other
 
+    def __hash__(self):
+        """"""
+        return hash(self.fct)
+
+
+_DEFAULT_EXECUTOR = None
+
+
+def get_default_hook_executor():
+    """returns the executor used by install_async_hook when none is given"""
+    global _DEFAULT_EXECUTOR
+    with _LOCK:
+        if _DEFAULT_EXECUTOR is None:
+            _DEFAULT_EXECUTOR = HookExecutor()
+        return _DEFAULT_EXECUTOR
+
+
+def install_async_hook(name, fct, instance=None, executor=None):
+    """
+    Install a hook observing the calls without slowing them (see install_hook)
+    fct is called later by the executor: it can't modify the data and its result is ignored
+    The args are passed as they are: the objects may have been modified by the time fct runs
+    uninstall_hook(name, fct) removes it
+    """
+    install_hook(name, _AsyncHook(fct, executor or get_default_hook_executor()), instance)
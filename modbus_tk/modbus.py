@@ -12,9 +12,11 @@
  2010/01/08 - RD: Update master.execute(..) to calculate lengths automatically based on requested command
 """
 
-from __future__ import with_statement
-
+import array
+import bisect
+import contextlib
 import struct
+import sys
 import threading
 import re
 
@@ -26,7 +28,8 @@ from modbus_tk.exceptions import(
     ModbusInvalidRequestError
 )
 from modbus_tk.hooks import call_hooks
-from modbus_tk.utils import threadsafe_function, get_log_buffer
+from modbus_tk.subscription import Subscription
+from modbus_tk.utils import threadsafe_method, get_log_buffer, pack_bits, pack_true_bits, unpack_bits, ReadWriteLock
 
 # modbus_tk is using the python logging mechanism
 # you can define this logger in your app in order to see its prints logs
@@ -73,6 +76,26 @@ class Query(object):
         """
         raise NotImplementedError()
 
+    def build_prepared_request(self, pdu, slave):
+        """
+        Returns the request of a PreparedQuery. It is built once per type of master and sent
+        by every execution after renew_request. The query is kept and shared by these executions
+        Returns None if the request must be built by build_request for every execution
+        """
+        return None
+
+    def renew_request(self, request):
+        """Returns the request built by build_prepared_request for a new execution"""
+        return request
+
+    def parse_prepared_response(self, request, response):
+        """
+        Check that the response corresponds to the request returned by renew_request
+        and extract the modbus application protocol response pdu
+        Must not change the query: it may be used by several threads at the same time
+        """
+        raise NotImplementedError()
+
 
 class Master(object):
     """
@@ -80,11 +103,23 @@ class Master(object):
     To be subclassed with a class implementing the MAC layer
     """
 
+    # the arguments of execute in their order: used for passing queries as tuples
+    _EXECUTE_ARGUMENTS = (
+        "slave", "function_code", "starting_address", "quantity_of_x", "output_value", "data_format",
+        "expected_length", "write_starting_address_fc23", "number_file", "pdu", "returns_raw", "and_mask", "or_mask"
+    )
+
+    # the hooks called for this instance only: set by hooks.install_hook
+    _hooks = None
+
     def __init__(self, timeout_in_sec, hooks=None):
         """Constructor: can define a timeout"""
         self._timeout = timeout_in_sec
         self._verbose = False
         self._is_opened = False
+        # serialize the queries sent on the same connection
+        # queries on other masters are not blocked
+        self._lock = threading.RLock()
 
     def __del__(self):
         """Destructor: close the connection"""
@@ -134,7 +169,7 @@ class Master(object):
         """
         raise NotImplementedError()
 
-    @threadsafe_function
+    @threadsafe_method
     def execute(
         self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="",
         expected_length=-1, write_starting_address_fc23=0, number_file=None, pdu="", returns_raw=False, and_mask=-1, or_mask=-1
@@ -153,14 +188,219 @@ class Master(object):
         ((sub _ seq_0 _ data), (sub_seq_1_data),... (sub_seq_N_data)).
         """
 
+        # open the connection if it is not already done
+        self.open()
+
+        (pdu, data_format, expected_length, is_read_function, nb_of_digits) = self._make_request_pdu(
+            function_code, starting_address, quantity_of_x, output_value, data_format, expected_length,
+            write_starting_address_fc23, number_file, pdu, and_mask, or_mask
+        )
+
+        response_pdu = self._exchange(slave, pdu, expected_length)
+
+        if response_pdu is not None:
+            return self._parse_response_pdu(
+                function_code, response_pdu, data_format, is_read_function, nb_of_digits, returns_raw
+            )
+
+    def _exchange(self, slave, pdu, expected_length, wait_response=None):
+        """
+        Send the request pdu to the slave and returns the pdu of its response
+        Returns None if no response is expected: wait_response is False or, by default, slave is None
+        """
+        if wait_response is None:
+            wait_response = slave is not None
+        # instantiate a query which implements the MAC (TCP or RTU) part of the protocol
+        query = self._make_query()
+
+        # add the mac part of the protocol to the request
+        request = query.build_request(pdu, slave)
+
+        response = self._transfer(request, wait_response, expected_length)
+        if response is not None:
+            # extract the pdu part of the response
+            return query.parse_response(response)
+        return None
+
+    def _exchange_prepared(self, prepared):
+        """
+        Send the request of a prepared query and returns the pdu of its response
+        The request is framed once per type of master: only what changes for every execution is renewed
+        """
+        (query, request) = prepared.get_request(self)
+        if request is None:
+            return self._exchange(
+                prepared.slave, prepared.pdu, prepared.expected_length, prepared.expects_response()
+            )
+
+        request = query.renew_request(request)
+        response = self._transfer(request, prepared.expects_response(), prepared.expected_length)
+        if response is not None:
+            return query.parse_prepared_response(request, response)
+        return None
+
+    def _transfer(self, request, wait_response, expected_length):
+        """
+        Send a request to the slave and returns its response
+        Returns None without waiting if wait_response is False
+        """
+        retval = call_hooks("modbus.Master.before_send", (self, request))
+        if retval is not None:
+            request = retval
+        if self._verbose:
+            LOGGER.debug(get_log_buffer("-> ", request))
+        self._send(request)
+
+        call_hooks("modbus.Master.after_send", (self, ))
+
+        if not wait_response:
+            return None
+
+        # receive the data from the slave
+        response = self._recv(expected_length)
+        retval = call_hooks("modbus.Master.after_recv", (self, response))
+        if retval is not None:
+            response = retval
+        if self._verbose:
+            LOGGER.debug(get_log_buffer("<- ", response))
+        return response
+
+    def prepare(
+        self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="",
+        expected_length=-1, write_starting_address_fc23=0, number_file=None, pdu="", returns_raw=False, and_mask=-1, or_mask=-1
+    ):
+        """
+        Build a query which can be executed many times by execute_prepared
+        The arguments are the ones of execute. The request pdu, the decoder of the response
+        and the expected length are computed once
+        """
+        return PreparedQuery(
+            self, slave, function_code, returns_raw, *self._make_request_pdu(
+                function_code, starting_address, quantity_of_x, output_value, data_format, expected_length,
+                write_starting_address_fc23, number_file, pdu, and_mask, or_mask
+            )
+        )
+
+    @threadsafe_method
+    def execute_prepared(self, prepared):
+        """Execute a query built by prepare and returns the same result as execute"""
+        # open the connection if it is not already done
+        self.open()
+
+        response_pdu = self._exchange_prepared(prepared)
+
+        if response_pdu is not None:
+            return prepared.parse_response_pdu(response_pdu)
+
+    def _get_execute_kwargs(self, query):
+        """returns the arguments of execute as a dict. The query is a dict or a tuple of the arguments"""
+        if isinstance(query, dict):
+            return dict(query)
+        return dict(zip(self._EXECUTE_ARGUMENTS, query))
+
+    def _get_prepared_query(self, query):
+        """returns the PreparedQuery corresponding to a query passed to execute_many"""
+        if isinstance(query, PreparedQuery):
+            return query
+        return self.prepare(**self._get_execute_kwargs(query))
+
+    @threadsafe_method
+    def execute_many(self, queries, window=None):
+        """
+        Execute several queries and returns the list of their results in the same order
+        Every query is a PreparedQuery, a tuple or a dict with the arguments of execute
+        The queries are executed one after the other and the first error is raised.
+        window is the maximum number of queries waiting for their response: it is only used by
+        the masters which can send a query before receiving the previous response (TcpMaster)
+        """
+        return [self.execute_prepared(self._get_prepared_query(query)) for query in queries]
+
+    def _make_bulk_queries(self, slave, function_code, starting_address, quantity, max_quantity, values=None):
+        """returns the prepared queries reading or writing quantity values by chunks of max_quantity"""
+        if quantity <= 0 or starting_address < 0 or starting_address + quantity > 0x10000:
+            raise InvalidArgumentError(
+                "Invalid range: {0} values at address {1}".format(quantity, starting_address)
+            )
+        queries = []
+        for offset in range(0, quantity, max_quantity):
+            count = min(max_quantity, quantity - offset)
+            if values is None:
+                queries.append(self.prepare(slave, function_code, starting_address + offset, count))
+            else:
+                queries.append(
+                    self.prepare(
+                        slave, function_code, starting_address + offset, output_value=values[offset:offset + count]
+                    )
+                )
+        return queries
+
+    def _read_bulk(self, slave, function_code, starting_address, quantity, max_quantity, window):
+        """read quantity values by chunks and returns them as one tuple"""
+        queries = self._make_bulk_queries(slave, function_code, starting_address, quantity, max_quantity)
+        return tuple(value for values in self.execute_many(queries, window) for value in values)
+
+    def _write_bulk(self, slave, function_code, starting_address, values, max_quantity, window):
+        """write the values by chunks and returns (starting_address, number of values written)"""
+        queries = self._make_bulk_queries(slave, function_code, starting_address, len(values), max_quantity, values)
+        self.execute_many(queries, window)
+        return (starting_address, len(values))
+
+    def read_coils_bulk(self, slave, starting_address, quantity, window=None):
+        """
+        Read any number of coils: the request is split in queries complying with the modbus limits
+        The queries are pipelined if the master supports it (see execute_many)
+        """
+        return self._read_bulk(
+            slave, defines.READ_COILS, starting_address, quantity, defines.MAX_READ_BITS, window
+        )
+
+    def read_discrete_inputs_bulk(self, slave, starting_address, quantity, window=None):
+        """Read any number of discrete inputs (see read_coils_bulk)"""
+        return self._read_bulk(
+            slave, defines.READ_DISCRETE_INPUTS, starting_address, quantity, defines.MAX_READ_BITS, window
+        )
+
+    def read_holding_registers_bulk(self, slave, starting_address, quantity, window=None):
+        """Read any number of holding registers (see read_coils_bulk)"""
+        return self._read_bulk(
+            slave, defines.READ_HOLDING_REGISTERS, starting_address, quantity, defines.MAX_READ_REGISTERS, window
+        )
+
+    def read_input_registers_bulk(self, slave, starting_address, quantity, window=None):
+        """Read any number of input registers (see read_coils_bulk)"""
+        return self._read_bulk(
+            slave, defines.READ_INPUT_REGISTERS, starting_address, quantity, defines.MAX_READ_REGISTERS, window
+        )
+
+    def write_coils_bulk(self, slave, starting_address, values, window=None):
+        """
+        Write any number of coils: the request is split in queries complying with the modbus limits
+        The queries are pipelined if the master supports it (see execute_many)
+        returns (starting_address, number of coils written)
+        """
+        return self._write_bulk(
+            slave, defines.WRITE_MULTIPLE_COILS, starting_address, values, defines.MAX_WRITE_BITS, window
+        )
+
+    def write_registers_bulk(self, slave, starting_address, values, window=None):
+        """Write any number of holding registers (see write_coils_bulk)"""
+        return self._write_bulk(
+            slave, defines.WRITE_MULTIPLE_REGISTERS, starting_address, values, defines.MAX_WRITE_REGISTERS, window
+        )
+
+    def _make_request_pdu(
+        self, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="",
+        expected_length=-1, write_starting_address_fc23=0, number_file=None, pdu="", and_mask=-1, or_mask=-1
+    ):
+        """
+        Build the modbus pdu of a request. The arguments are the ones of execute
+        Returns a tuple (pdu, data_format, expected_length, is_read_function, nb_of_digits)
+        """
         is_read_function = False
         nb_of_digits = 0
         if number_file is None:
             number_file = tuple()
 
-        # open the connection if it is not already done
-        self.open()
-
         # Build the modbus pdu and the format of the expected data.
         # It depends of function code. see modbus specifications for details.
         if function_code == defines.READ_COILS or function_code == defines.READ_DISCRETE_INPUTS:
@@ -244,17 +484,7 @@ class Master(object):
             if (len(output_value) % 8) > 0:
                 byte_count += 1
             pdu = struct.pack(">BHHB", function_code, starting_address, len(output_value), byte_count)
-            i, byte_value = 0, 0
-            for j in output_value:
-                if j > 0:
-                    byte_value += pow(2, i)
-                if i == 7:
-                    pdu += struct.pack(">B", byte_value)
-                    i, byte_value = 0, 0
-                else:
-                    i += 1
-            if i > 0:
-                pdu += struct.pack(">B", byte_value)
+            pdu += pack_bits(output_value)
             if not data_format:
                 data_format = ">HH"
             if expected_length < 0:
@@ -341,80 +571,53 @@ class Master(object):
         else:
             raise ModbusFunctionNotSupportedError("The {0} function code is not supported. ".format(function_code))
 
-        # instantiate a query which implements the MAC (TCP or RTU) part of the protocol
-        query = self._make_query()
-
-        # add the mac part of the protocol to the request
-        request = query.build_request(pdu, slave)
+        return pdu, data_format, expected_length, is_read_function, nb_of_digits
 
-        # send the request to the slave
-        retval = call_hooks("modbus.Master.before_send", (self, request))
-        if retval is not None:
-            request = retval
-        if self._verbose:
-            LOGGER.debug(get_log_buffer("-> ", request))
-        self._send(request)
-
-        call_hooks("modbus.Master.after_send", (self, ))
-
-        if slave is not None:
-            # receive the data from the slave
-            response = self._recv(expected_length)
-            retval = call_hooks("modbus.Master.after_recv", (self, response))
-            if retval is not None:
-                response = retval
-            if self._verbose:
-                LOGGER.debug(get_log_buffer("<- ", response))
-
-            # extract the pdu part of the response
-            response_pdu = query.parse_response(response)
-
-            # analyze the received data
-            (return_code, byte_2) = struct.unpack(">BB", response_pdu[0:2])
+    def _parse_response_pdu(
+        self, function_code, response_pdu, data_format, is_read_function, nb_of_digits, returns_raw=False
+    ):
+        """
+        Analyze the response pdu and returns the data as defined by execute
+        Raise a ModbusError if the slave has returned an exception
+        """
+        (return_code, byte_2) = struct.unpack(">BB", response_pdu[0:2])
 
-            if return_code > 0x80:
-                # the slave has returned an error
-                exception_code = byte_2
-                raise ModbusError(exception_code)
+        if return_code > 0x80:
+            # the slave has returned an error
+            exception_code = byte_2
+            raise ModbusError(exception_code)
+        else:
+            if is_read_function:
+                # get the values returned by the reading function
+                byte_count = byte_2
+                data = response_pdu[2:]
+                if byte_count != len(data):
+                    # the byte count in the pdu is invalid
+                    raise ModbusInvalidResponseError(
+                        "Byte count is {0} while actual number of bytes is {1}. ".format(byte_count, len(data))
+                    )
+            elif function_code == defines.DEVICE_INFO:
+                data = response_pdu[1:]
+                data_format = ">" + (len(data) * "B")
             else:
-                if is_read_function:
-                    # get the values returned by the reading function
-                    byte_count = byte_2
-                    data = response_pdu[2:]
-                    if byte_count != len(data):
-                        # the byte count in the pdu is invalid
-                        raise ModbusInvalidResponseError(
-                            "Byte count is {0} while actual number of bytes is {1}. ".format(byte_count, len(data))
-                        )
-                elif function_code == defines.DEVICE_INFO:
-                    data = response_pdu[1:]
-                    data_format = ">" + (len(data) * "B")
-                else:
-                    # returns what is returned by the slave after a writing function
-                    data = response_pdu[1:]
-
-                # returns the data as a tuple according to the data_format
-                # (calculated based on the function or user-defined)
-                if returns_raw:
-                    return data
-                result = struct.unpack(data_format, data)
-                if nb_of_digits > 0:
-                    digits = []
-                    for byte_val in result:
-                        for i in range(8):
-                            if len(digits) >= nb_of_digits:
-                                break
-                            digits.append(byte_val % 2)
-                            byte_val = byte_val >> 1
-                    result = tuple(digits)
-                if function_code == defines.READ_FILE_RECORD:
-                    sub_seq = list()
-                    ptr = 0
-                    while ptr < len(result):
-                        sub_seq += ((ptr + 2, ptr + 2 + result[ptr] // 2), )
-                        ptr += result[ptr] // 2 + 2
-                    result = tuple(map(lambda sub_seq_x: result[sub_seq_x[0]:sub_seq_x[1]], sub_seq))
-                return result
+                # returns what is returned by the slave after a writing function
+                data = response_pdu[1:]
+
+            # returns the data as a tuple according to the data_format
+            # (calculated based on the function or user-defined)
+            if returns_raw:
+                return data
+            result = struct.unpack(data_format, data)
+            if nb_of_digits > 0:
+                result = tuple(unpack_bits(data, nb_of_digits))
+            if function_code == defines.READ_FILE_RECORD:
+                sub_seq = list()
+                ptr = 0
+                while ptr < len(result):
+                    sub_seq += ((ptr + 2, ptr + 2 + result[ptr] // 2), )
+                    ptr += result[ptr] // 2 + 2
+                result = tuple(map(lambda sub_seq_x: result[sub_seq_x[0]:sub_seq_x[1]], sub_seq))
+            return result
 
     def set_timeout(self, timeout_in_sec):
         """Defines a timeout on the MAC layer"""
@@ -425,15 +628,100 @@ class Master(object):
         return self._timeout
 
 
+class PreparedQuery(object):
+    """
+    A query built once by Master.prepare and executed many times by Master.execute_prepared
+    """
+
+    def __init__(
+        self, master, slave, function_code, returns_raw, pdu, data_format, expected_length, is_read_function,
+        nb_of_digits
+    ):
+        """Constructor: the arguments after returns_raw are the ones returned by Master._make_request_pdu"""
+        self.master = master
+        self.slave = slave
+        self.function_code = function_code
+        self.pdu = pdu
+        self.expected_length = expected_length
+        self.returns_raw = returns_raw
+        self._data_format = data_format
+        self._is_read_function = is_read_function
+        self._nb_of_digits = nb_of_digits
+        # the query and the request framed by every type of master: see get_request
+        self._requests = {}
+
+        # decode the whole response of a reading function at once: function code, byte count and data
+        self._response_struct = None
+        self._bits_response_length = 0
+        if is_read_function and not returns_raw and nb_of_digits:
+            self._bits_response_length = 2 + (nb_of_digits + 7) // 8
+        if (
+            is_read_function and not returns_raw and not nb_of_digits
+            and function_code != defines.READ_FILE_RECORD and data_format[:1] in ("<", ">", "!", "=")
+        ):
+            self._response_struct = struct.Struct(data_format[0] + "BB" + data_format[1:])
+            self._byte_count = self._response_struct.size - 2
+
+    def execute(self):
+        """Execute the query with its master"""
+        return self.master.execute_prepared(self)
+
+    def expects_response(self):
+        """Returns True if the slave answers the query. No response is expected if slave is None"""
+        return self.slave is not None
+
+    def get_request(self, master):
+        """
+        Returns the query implementing the MAC layer of a master and the request framed by this query
+        They are built once per type of master. The request is None if it can not be framed once
+        """
+        item = self._requests.get(master.__class__)
+        if item is None:
+            query = master._make_query()
+            item = (query, query.build_prepared_request(self.pdu, self.slave))
+            self._requests[master.__class__] = item
+        return item
+
+    def parse_response_pdu(self, response_pdu):
+        """Analyze the response pdu and returns the data as execute does"""
+        response_struct = self._response_struct
+        if response_struct is not None and len(response_pdu) == response_struct.size:
+            values = response_struct.unpack(response_pdu)
+            if values[0] == self.function_code and values[1] == self._byte_count:
+                return values[2:]
+        elif len(response_pdu) == self._bits_response_length:
+            if response_pdu[0] == self.function_code and response_pdu[1] == self._bits_response_length - 2:
+                return tuple(unpack_bits(response_pdu[2:], self._nb_of_digits))
+        # exception or unexpected response: let the master analyze it
+        return self.master._parse_response_pdu(
+            self.function_code, response_pdu, self._data_format, self._is_read_function, self._nb_of_digits,
+            self.returns_raw
+        )
+
+
 class ModbusBlock(object):
     """This class represents the values for a range of addresses"""
 
-    def __init__(self, starting_address, size, name=''):
+    # __weakref__: hooks can be installed for one block
+    __slots__ = ("starting_address", "size", "name", "typecode", "lock", "_data", "_hooks", "__weakref__")
+
+    def __init__(self, starting_address, size, name='', typecode=None):
         """
         Contructor: defines the address range and creates the array of values
+        If typecode is set, the values are stored in an array.array of this type
+        rather than in a list: it uses much less memory
         """
         self.starting_address = starting_address
-        self._data = [0] * size
+        self.name = name
+        self.typecode = typecode
+        # the hooks called for this block only: set by hooks.install_hook
+        self._hooks = None
+        # the requests reading the block can run at the same time but not while writing
+        self.lock = ReadWriteLock()
+        if typecode:
+            self._data = array.array(typecode, bytes(array.array(typecode).itemsize * size))
+        else:
+            self._data = [0] * size
         self.size = len(self._data)
 
     def is_in(self, starting_address, size):
@@ -454,8 +742,173 @@ class ModbusBlock(object):
     def __setitem__(self, item, value):
         """"""
         call_hooks("modbus.ModbusBlock.setitem", (self, item, value))
+        self._setitem(item, value)
+
+    def _setitem(self, item, value):
+        """
+        write the values without calling the setitem hook
+        The slave calls the hook once the values are written and the locks are released
+        """
+        if self.typecode and isinstance(item, slice) and not isinstance(value, array.array):
+            # an array can only be assigned from an array
+            value = array.array(self.typecode, value)
         return self._data.__setitem__(item, value)
 
+    def get_bits(self, offset, count):
+        """returns count values from offset packed in bytes as they are sent in modbus"""
+        return pack_true_bits(self._data[offset:offset+count])
+
+    def set_bits(self, offset, count, data):
+        """
+        write count values from offset: data is the packed bits as they are received in modbus
+        The setitem hook is not called: see _setitem
+        """
+        self._setitem(slice(offset, offset+count), unpack_bits(data, count))
+
+
+class BitsBlock(ModbusBlock):
+    """A block of coils or discrete inputs storing 8 values per byte"""
+
+    __slots__ = ()
+
+    def __init__(self, starting_address, size, name=''):
+        """Contructor: defines the address range and creates the bytes of values"""
+        super(BitsBlock, self).__init__(starting_address, 0, name)
+        self._data = bytearray((size + 7) // 8)
+        self.size = size
+
+    def _get_index(self, item):
+        """returns the positive index of an item"""
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError("block index out of range")
+        return item
+
+    def __getitem__(self, item):
+        """"""
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.size)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            count = max(stop - start, 0)
+            return list(unpack_bits(self.get_bits(start, count), count))
+        item = self._get_index(item)
+        return (self._data[item >> 3] >> (item & 7)) & 1
+
+    def _setitem(self, item, value):
+        """write the values without calling the setitem hook: see ModbusBlock._setitem"""
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(self.size)
+            indexes = range(start, stop, step)
+            if len(value) != len(indexes):
+                raise ValueError("The size of a block of bits can not be changed")
+            if step != 1:
+                for (i, bit) in zip(indexes, value):
+                    self._set_bit(i, bit)
+            elif indexes:
+                self._set_bits(start, len(indexes), pack_true_bits(value))
+        else:
+            self._set_bit(self._get_index(item), value)
+
+    def _set_bit(self, index, value):
+        """set one bit"""
+        if value:
+            self._data[index >> 3] |= 1 << (index & 7)
+        else:
+            self._data[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def _set_bits(self, offset, count, data):
+        """copy count packed bits in the bytes of the block"""
+        (first, last) = (offset >> 3, (offset + count + 7) >> 3)
+        shift = offset & 7
+        mask = (1 << count) - 1
+        value = int.from_bytes(self._data[first:last], "little") & ~(mask << shift)
+        value |= (int.from_bytes(data, "little") & mask) << shift
+        self._data[first:last] = value.to_bytes(last - first, "little")
+
+    def get_bits(self, offset, count):
+        """returns count values from offset packed in bytes as they are sent in modbus"""
+        (first, last) = (offset >> 3, (offset + count + 7) >> 3)
+        value = (int.from_bytes(self._data[first:last], "little") >> (offset & 7)) & ((1 << count) - 1)
+        return value.to_bytes((count + 7) // 8, "little")
+
+    def set_bits(self, offset, count, data):
+        """
+        write count values from offset: data is the packed bits as they are received in modbus
+        The setitem hook is not called: see ModbusBlock._setitem
+        """
+        self._set_bits(offset, count, data)
+
+
+# the Struct packing the response of a reading by (number of registers, unsigned)
+_REGISTERS_STRUCTS = {}
+
+
+def _get_registers_struct(nb_of_registers, unsigned):
+    """returns the Struct packing the byte count and the values of nb_of_registers registers"""
+    key = (nb_of_registers, unsigned)
+    registers_struct = _REGISTERS_STRUCTS.get(key)
+    if registers_struct is None:
+        registers_struct = struct.Struct(">B{0}{1}".format(nb_of_registers, "H" if unsigned else "h"))
+        _REGISTERS_STRUCTS[key] = registers_struct
+    return registers_struct
+
+
+class _SortedBlocks(list):
+    """
+    The blocks of one type sorted by starting address with the list of their starting addresses
+    It replaces the lists of the memory of a slave: the slaves sharing a memory share its index
+    """
+
+    __slots__ = ("starts", )
+
+    def __init__(self, blocks=()):
+        """Constructor: sorts the blocks"""
+        super(_SortedBlocks, self).__init__(sorted(blocks, key=lambda block: block.starting_address))
+        self.starts = [block.starting_address for block in self]
+
+    def find(self, address):
+        """returns the block starting just before the address: the only one which may contain it. None if no block"""
+        i = bisect.bisect_right(self.starts, address) - 1
+        return self[i] if i >= 0 else None
+
+    def get_neighbours(self, starting_address):
+        """returns the blocks just before and just after a starting address: the only ones a new block may overlap"""
+        i = bisect.bisect_right(self.starts, starting_address)
+        return self[max(i - 1, 0):i + 1]
+
+    def insert_block(self, block):
+        """insert a block at its place"""
+        i = bisect.bisect_right(self.starts, block.starting_address)
+        self.insert(i, block)
+        self.starts.insert(i, block.starting_address)
+
+    def delete_block(self, block):
+        """delete a block. The blocks don't overlap: it is the only one starting at its address"""
+        i = bisect.bisect_left(self.starts, block.starting_address)
+        del self[i]
+        del self.starts[i]
+
+
+# serialize the sorting of the memories shared by several slaves
+_MEMORY_LOCK = threading.Lock()
+
+
+def _sort_memory(memory):
+    """
+    replace the lists of blocks of a memory by _SortedBlocks
+    A list shared by several block types is replaced by the same _SortedBlocks
+    """
+    with _MEMORY_LOCK:
+        sorted_blocks = {}
+        for (block_type, blocks) in list(memory.items()):
+            if not isinstance(blocks, _SortedBlocks):
+                if id(blocks) not in sorted_blocks:
+                    # keep the list: its id can not be reused meanwhile
+                    sorted_blocks[id(blocks)] = (blocks, _SortedBlocks(blocks))
+                memory[block_type] = sorted_blocks[id(blocks)][1]
+
 
 class Slave(object):
     """
@@ -463,27 +916,51 @@ class Slave(object):
     asked by a modbus query
     """
 
-    def __init__(self, slave_id, unsigned=True, memory=None):
-        """Constructor"""
+    # the hooks called for this instance only: set by hooks.install_hook
+    _hooks = None
+
+    def __init__(self, slave_id, unsigned=True, memory=None, compact=False):
+        """
+        Constructor
+        If compact is True, the values of the blocks are stored in arrays rather than in lists
+        """
         self._id = slave_id
 
         # treat every value written to/read from register as an unsigned value
         self.unsigned = unsigned
 
+        # the type of the arrays of the registers. None for lists
+        # the bits are stored in BitsBlock
+        self._compact = compact
+        self._typecodes = {}
+        if compact:
+            self._typecodes = {
+                defines.HOLDING_REGISTERS: "H" if unsigned else "h",
+                defines.ANALOG_INPUTS: "H" if unsigned else "h",
+            }
+
         # the map registring all blocks of the slave
         self._blocks = {}
         # a shortcut to find blocks per type
+        # the blocks of every type are sorted by starting address in a _SortedBlocks
         if memory is None:
             self._memory = {
-                defines.COILS: [],
-                defines.DISCRETE_INPUTS: [],
-                defines.HOLDING_REGISTERS: [],
-                defines.ANALOG_INPUTS: [],
+                defines.COILS: _SortedBlocks(),
+                defines.DISCRETE_INPUTS: _SortedBlocks(),
+                defines.HOLDING_REGISTERS: _SortedBlocks(),
+                defines.ANALOG_INPUTS: _SortedBlocks(),
             }
         else:
+            # the slaves sharing the memory share the sorted blocks and their index
+            _sort_memory(memory)
             self._memory = memory
         # a lock for mutual access to the _blocks and _memory maps
-        self._data_lock = threading.RLock()
+        # they are read by the requests and changed when adding or removing blocks
+        # the values of every block are protected by the lock of the block
+        self._data_lock = ReadWriteLock()
+        # the subscriptions notified of the values written by the requests. Replaced when changed
+        self._subscriptions = ()
+        self._subscriptions_lock = threading.Lock()
         # map modbus function code to a function:
         self._fn_code_map = {
             defines.READ_COILS: self._read_coils,
@@ -499,10 +976,78 @@ class Slave(object):
             defines.READ_WRITE_MULTIPLE_REGISTERS: self._read_write_multiple_registers,
         }
 
+    def _lock_blocks(self, *blocks):
+        """
+        returns a context manager locking several blocks for writing
+        The blocks are always locked in the same order: it can not deadlock
+        """
+        stack = contextlib.ExitStack()
+        try:
+            for block in sorted(set(blocks), key=id):
+                stack.enter_context(block.lock.writer)
+        except Exception:
+            stack.close()
+            raise
+        return stack
+
+    @contextlib.contextmanager
+    def lock_blocks(self, *block_names):
+        """
+        Lock several blocks for writing until the end of the with statement
+        The requests can not access them meanwhile: use it for changing the values of several blocks atomically
+        """
+        with self._data_lock.reader:
+            blocks = [self._get_block(block_name) for block_name in block_names]
+            with self._lock_blocks(*blocks):
+                yield
+
+    def subscribe(self, callback=None, window=0.0, block_names=None, maxsize=0):
+        """
+        returns a Subscription receiving a BlockChange for the values written by every request
+        If window is not 0, the changes are coalesced during window seconds
+        The callback is called by the thread handling the request once the locks of the blocks
+        are released: it must be quick but it may add or remove blocks
+        Without callback, the changes are read from the subscription
+        The values written by set_values are not notified
+        """
+        subscription = Subscription(callback, window, block_names, maxsize)
+        subscription.attach(self)
+        return subscription
+
+    def _add_subscription(self, subscription):
+        """notify the subscription of the changes"""
+        with self._subscriptions_lock:
+            if subscription not in self._subscriptions:
+                self._subscriptions = self._subscriptions + (subscription, )
+
+    def _remove_subscription(self, subscription):
+        """stop notifying the subscription"""
+        with self._subscriptions_lock:
+            self._subscriptions = tuple(item for item in self._subscriptions if item is not subscription)
+
+    def _get_change(self, block, offset, count):
+        """
+        returns the values written in a block by a request if there are subscriptions, None otherwise
+        Must be called with the lock of the block
+        """
+        if self._subscriptions:
+            return (block.name, block.starting_address + offset, tuple(block[offset:offset+count]))
+        return None
+
+    def _notify_change(self, change):
+        """notify the subscriptions of a change returned by _get_change"""
+        if change is not None:
+            (block_name, address, values) = change
+            for subscription in self._subscriptions:
+                subscription.notify(self._id, block_name, address, values)
+
     def _get_block_and_offset(self, block_type, address, length):
         """returns the block and offset corresponding to the given address"""
-        for block in self._memory[block_type]:
-            if address >= block.starting_address:
+        # thread-safe: the blocks can not be added or removed during the lookup
+        # the values of the block are protected by its own lock
+        with self._data_lock.reader:
+            block = self._memory[block_type].find(address)
+            if block is not None:
                 offset = address - block.starting_address
                 if block.size >= offset + length:
                     return block, offset
@@ -518,33 +1063,10 @@ class Slave(object):
 
         block, offset = self._get_block_and_offset(block_type, starting_address, quantity_of_x)
 
-        values = block[offset:offset+quantity_of_x]
-
-        # pack bits in bytes
-        byte_count = quantity_of_x // 8
-        if (quantity_of_x % 8) > 0:
-            byte_count += 1
-
-        # write the response header
-        response = struct.pack(">B", byte_count)
-
-        i, byte_value = 0, 0
-        for coil in values:
-            if coil:
-                byte_value += (1 << i)
-            if i >= 7:
-                # write the values of 8 bits in a byte
-                response += struct.pack(">B", byte_value)
-                # reset the counters
-                i, byte_value = 0, 0
-            else:
-                i += 1
-
-        # if there is remaining bits: add one more byte with their values
-        if i > 0:
-            fmt = "B" if self.unsigned else "b"
-            response += struct.pack(">"+fmt, byte_value)
-        return response
+        # write the response header and the bits packed in bytes
+        with block.lock.reader:
+            values = block.get_bits(offset, quantity_of_x)
+        return struct.pack(">B", len(values)) + values
 
     def _read_coils(self, request_pdu):
         """handle read coils modbus function"""
@@ -569,15 +1091,36 @@ class Slave(object):
         block, offset = self._get_block_and_offset(block_type, starting_address, quantity_of_x)
 
         # get the values
-        values = block[offset:offset+quantity_of_x]
-
-        # write the response header
-        response = struct.pack(">B", 2 * quantity_of_x)
-        # add the values of every register on 2 bytes
-        for reg in values:
-            fmt = "H" if self.unsigned else "h"
-            response += struct.pack(">"+fmt, reg)
-        return response
+        with block.lock.reader:
+            values = block[offset:offset+quantity_of_x]
+
+        # write the response header and the values of every register on 2 bytes
+        return self._pack_registers(values)
+
+    def _pack_registers(self, values):
+        """returns the byte count and the values of the registers in big endian"""
+        if isinstance(values, array.array):
+            # compact block: swap the bytes of all registers at once
+            if sys.byteorder == "little":
+                values.byteswap()
+            response = bytearray(1 + 2 * len(values))
+            response[0] = 2 * len(values)
+            response[1:] = values
+            return response
+        # the response is not reused: it is owned by the caller, hooks and connection buffers
+        return _get_registers_struct(len(values), self.unsigned).pack(2 * len(values), *values)
+
+    def _unpack_registers(self, block, data):
+        """returns the registers sent in big endian in a request as values for the block"""
+        if block.typecode:
+            # compact block: swap the bytes of all registers at once
+            values = array.array(block.typecode)
+            values.frombytes(data)
+            if sys.byteorder == "little":
+                values.byteswap()
+            return values
+        fmt = "H" if self.unsigned else "h"
+        return struct.unpack(">{0}{1}".format(len(data) // 2, fmt), data)
 
     def _read_holding_registers(self, request_pdu):
         """handle read coils modbus function"""
@@ -608,16 +1151,7 @@ class Slave(object):
             raise ModbusError(defines.ILLEGAL_DATA_VALUE)
 
         # look for the block corresponding to the request
-        block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, starting_read_address, quantity_of_x_to_read)
-
-        # get the values
-        values = block[offset:offset+quantity_of_x_to_read]
-        # write the response header
-        response = struct.pack(">B", 2 * quantity_of_x_to_read)
-        # add the values of every register on 2 bytes
-        for reg in values:
-            fmt = "H" if self.unsigned else "h"
-            response += struct.pack(">"+fmt, reg)
+        read_block, read_offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, starting_read_address, quantity_of_x_to_read)
 
         # write part
         if (quantity_of_x_to_write <= 0) or (quantity_of_x_to_write > 123) or (byte_count_to_write != (quantity_of_x_to_write * 2)):
@@ -627,13 +1161,20 @@ class Slave(object):
         # look for the block corresponding to the request
         block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, starting_write_address, quantity_of_x_to_write)
 
-        count = 0
-        for i in range(quantity_of_x_to_write):
-            count += 1
-            fmt = "H" if self.unsigned else "h"
-            block[offset+i] = struct.unpack(">"+fmt, request_pdu[10+2*i:12+2*i])[0]
+        # the reading and the writing are atomic
+        with self._lock_blocks(read_block, block):
+            # get the values
+            values = read_block[read_offset:read_offset+quantity_of_x_to_read]
 
-        return response
+            item = slice(offset, offset+quantity_of_x_to_write)
+            written = self._unpack_registers(block, memoryview(request_pdu)[10:10+byte_count_to_write])
+            block._setitem(item, written)
+            change = self._get_change(block, offset, quantity_of_x_to_write)
+        call_hooks("modbus.ModbusBlock.setitem", (block, item, written))
+        self._notify_change(change)
+
+        # write the response header and the values of every register on 2 bytes
+        return self._pack_registers(values)
 
     def _mask_write_register(self, request_pdu):
         """execute modbus function 22"""
@@ -642,7 +1183,12 @@ class Slave(object):
         (data_address, and_mask, or_mask) = struct.unpack(">HHH", request_pdu[1:7])
         # look for the block corresponding to the request
         block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, data_address, 1)
-        block[offset] = (block[offset] & and_mask) | (or_mask & ~and_mask)
+        with block.lock.writer:
+            value = (block[offset] & and_mask) | (or_mask & ~and_mask)
+            block._setitem(offset, value)
+            change = self._get_change(block, offset, 1)
+        call_hooks("modbus.ModbusBlock.setitem", (block, offset, value))
+        self._notify_change(change)
         # returns echo of the command
         return request_pdu[1:]
 
@@ -659,13 +1205,15 @@ class Slave(object):
         # look for the block corresponding to the request
         block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, starting_address, quantity_of_x)
 
-        count = 0
-        for i in range(quantity_of_x):
-            count += 1
-            fmt = "H" if self.unsigned else "h"
-            block[offset+i] = struct.unpack(">"+fmt, request_pdu[6+2*i:8+2*i])[0]
+        # decode all the registers at once and write them in one slice
+        values = self._unpack_registers(block, memoryview(request_pdu)[6:6+byte_count])
+        with block.lock.writer:
+            block._setitem(slice(offset, offset+quantity_of_x), values)
+            change = self._get_change(block, offset, quantity_of_x)
+        call_hooks("modbus.ModbusBlock.setitem", (block, slice(offset, offset+quantity_of_x), values))
+        self._notify_change(change)
 
-        return struct.pack(">HH", starting_address, count)
+        return struct.pack(">HH", starting_address, quantity_of_x)
 
     def _write_multiple_coils(self, request_pdu):
         """execute modbus function 15"""
@@ -684,23 +1232,15 @@ class Slave(object):
         # look for the block corresponding to the request
         block, offset = self._get_block_and_offset(defines.COILS, starting_address, quantity_of_x)
 
-        count = 0
-        for i in range(byte_count):
-            if count >= quantity_of_x:
-                break
-            fmt = "B" if self.unsigned else "b"
-            (byte_value, ) = struct.unpack(">"+fmt, request_pdu[6+i:7+i])
-            for j in range(8):
-                if count >= quantity_of_x:
-                    break
-
-                if byte_value & (1 << j):
-                    block[offset+i*8+j] = 1
-                else:
-                    block[offset+i*8+j] = 0
-
-                count += 1
-        return struct.pack(">HH", starting_address, count)
+        data = request_pdu[6:6+byte_count]
+        with block.lock.writer:
+            block.set_bits(offset, quantity_of_x, data)
+            change = self._get_change(block, offset, quantity_of_x)
+        call_hooks(
+            "modbus.ModbusBlock.setitem", (block, slice(offset, offset+quantity_of_x), unpack_bits(data, quantity_of_x))
+        )
+        self._notify_change(change)
+        return struct.pack(">HH", starting_address, quantity_of_x)
 
     def _write_single_register(self, request_pdu):
         """execute modbus function 6"""
@@ -709,7 +1249,11 @@ class Slave(object):
         fmt = "H" if self.unsigned else "h"
         (data_address, value) = struct.unpack(">H"+fmt, request_pdu[1:5])
         block, offset = self._get_block_and_offset(defines.HOLDING_REGISTERS, data_address, 1)
-        block[offset] = value
+        with block.lock.writer:
+            block._setitem(offset, value)
+            change = self._get_change(block, offset, 1)
+        call_hooks("modbus.ModbusBlock.setitem", (block, offset, value))
+        self._notify_change(change)
         # returns echo of the command
         return request_pdu[1:]
 
@@ -719,12 +1263,14 @@ class Slave(object):
         call_hooks("modbus.Slave.handle_write_single_coil_request", (self, request_pdu))
         (data_address, value) = struct.unpack(">HH", request_pdu[1:5])
         block, offset = self._get_block_and_offset(defines.COILS, data_address, 1)
-        if value == 0:
-            block[offset] = 0
-        elif value == 0xff00:
-            block[offset] = 1
-        else:
+        if value not in (0, 0xff00):
             raise ModbusError(defines.ILLEGAL_DATA_VALUE)
+        value = 1 if value else 0
+        with block.lock.writer:
+            block._setitem(offset, value)
+            change = self._get_change(block, offset, 1)
+        call_hooks("modbus.ModbusBlock.setitem", (block, offset, value))
+        self._notify_change(change)
         # returns echo of the command
         return request_pdu[1:]
 
@@ -732,51 +1278,50 @@ class Slave(object):
         """
         parse the request pdu, makes the corresponding action
         and returns the response pdu
+        The hooks and the subscriptions are called without the lock of the blocks: they may add or remove blocks
         """
-        # thread-safe
-        with self._data_lock:
-            try:
-                retval = call_hooks("modbus.Slave.handle_request", (self, request_pdu))
-                if retval is not None:
-                    return retval
-
-                # get the function code
-                (function_code, ) = struct.unpack(">B", request_pdu[0:1])
-
-                # check if the function code is valid. If not returns error response
-                if function_code not in self._fn_code_map:
-                    raise ModbusError(defines.ILLEGAL_FUNCTION)
-
-                # if read query is broadcasted raises an error
-                cant_be_broadcasted = (
-                    defines.READ_COILS,
-                    defines.READ_DISCRETE_INPUTS,
-                    defines.READ_INPUT_REGISTERS,
-                    defines.READ_HOLDING_REGISTERS
-                )
-                if broadcast and (function_code in cant_be_broadcasted):
-                    raise ModbusInvalidRequestError("Function %d can not be broadcasted" % function_code)
-
-                # execute the corresponding function
-                response_pdu = self._fn_code_map[function_code](request_pdu)
-                if response_pdu:
-                    if broadcast:
-                        call_hooks("modbus.Slave.on_handle_broadcast", (self, response_pdu))
-                        LOGGER.debug("broadcast: %s", get_log_buffer("!!", response_pdu))
-                        return ""
-                    else:
-                        return struct.pack(">B", function_code) + response_pdu
-                raise Exception("No response for function %d" % function_code)
+        try:
+            retval = call_hooks("modbus.Slave.handle_request", (self, request_pdu))
+            if retval is not None:
+                return retval
+
+            # get the function code
+            (function_code, ) = struct.unpack(">B", request_pdu[0:1])
+
+            # check if the function code is valid. If not returns error response
+            if function_code not in self._fn_code_map:
+                raise ModbusError(defines.ILLEGAL_FUNCTION)
+
+            # if read query is broadcasted raises an error
+            cant_be_broadcasted = (
+                defines.READ_COILS,
+                defines.READ_DISCRETE_INPUTS,
+                defines.READ_INPUT_REGISTERS,
+                defines.READ_HOLDING_REGISTERS
+            )
+            if broadcast and (function_code in cant_be_broadcasted):
+                raise ModbusInvalidRequestError("Function %d can not be broadcasted" % function_code)
+
+            # execute the corresponding function
+            response_pdu = self._fn_code_map[function_code](request_pdu)
+            if response_pdu:
+                if broadcast:
+                    call_hooks("modbus.Slave.on_handle_broadcast", (self, response_pdu))
+                    LOGGER.debug("broadcast: %s", get_log_buffer("!!", response_pdu))
+                    return ""
+                else:
+                    return struct.pack(">B", function_code) + response_pdu
+            raise Exception("No response for function %d" % function_code)
 
-            except ModbusError as excpt:
-                LOGGER.debug(str(excpt))
-                call_hooks("modbus.Slave.on_exception", (self, function_code, excpt))
-                return struct.pack(">BB", function_code+128, excpt.get_exception_code())
+        except ModbusError as excpt:
+            LOGGER.debug(str(excpt))
+            call_hooks("modbus.Slave.on_exception", (self, function_code, excpt))
+            return struct.pack(">BB", function_code+128, excpt.get_exception_code())
 
     def add_block(self, block_name, block_type, starting_address, size):
         """Add a new block identified by its name"""
         # thread-safe
-        with self._data_lock:
+        with self._data_lock.writer:
             if size <= 0:
                 raise InvalidArgumentError("size must be a positive number")
 
@@ -792,21 +1337,22 @@ class Slave(object):
             # check that the new block doesn't overlap an existing block
             # it means that only 1 block per type must correspond to a given address
             # for example: it must not have 2 holding registers at address 100
-            index = 0
-            for i in range(len(self._memory[block_type])):
-                block = self._memory[block_type][i]
+            # the blocks are sorted: only the previous and the next blocks may overlap
+            blocks = self._memory[block_type]
+            for block in blocks.get_neighbours(starting_address):
                 if block.is_in(starting_address, size):
                     raise OverlapModbusBlockError(
                         "Overlap block at {0} size {1}".format(block.starting_address, block.size)
                     )
-                if block.starting_address > starting_address:
-                    index = i
-                    break
 
             # if the block is ok: register it
             self._blocks[block_name] = (block_type, starting_address)
             # add it in the 'per type' shortcut
-            self._memory[block_type].insert(index, ModbusBlock(starting_address, size, block_name))
+            if self._compact and block_type in (defines.COILS, defines.DISCRETE_INPUTS):
+                block = BitsBlock(starting_address, size, block_name)
+            else:
+                block = ModbusBlock(starting_address, size, block_name, self._typecodes.get(block_type))
+            blocks.insert_block(block)
 
     def remove_block(self, block_name):
         """
@@ -814,31 +1360,31 @@ class Slave(object):
         Raise an exception if not found
         """
         # thread safe
-        with self._data_lock:
+        with self._data_lock.writer:
             block = self._get_block(block_name)
 
             # the block has been found: remove it from the shortcut
             block_type = self._blocks.pop(block_name)[0]
-            self._memory[block_type].remove(block)
+            self._memory[block_type].delete_block(block)
 
     def remove_all_blocks(self):
         """
         Remove all the blocks
         """
         # thread safe
-        with self._data_lock:
+        with self._data_lock.writer:
             self._blocks.clear()
             for key in self._memory:
-                self._memory[key] = []
+                self._memory[key] = _SortedBlocks()
 
     def _get_block(self, block_name):
         """Find a block by its name and raise and exception if not found"""
         if block_name not in self._blocks:
             raise MissingKeyError("block {0} not found".format(block_name))
         (block_type, starting_address) = self._blocks[block_name]
-        for block in self._memory[block_type]:
-            if block.starting_address == starting_address:
-                return block
+        block = self._memory[block_type].find(starting_address)
+        if block is not None and block.starting_address == starting_address:
+            return block
         raise Exception("Bug?: the block {0} is not registered properly in memory".format(block_name))
 
     def set_values(self, block_name, address, values):
@@ -846,9 +1392,11 @@ class Slave(object):
         Set the values of the items at the given address
         If values is a list or a tuple, the value of every item is written
         If values is a number, only one value is written
+        The setitem hook is called once the values are written and the locks are released:
+        it may add or remove blocks
         """
         # thread safe
-        with self._data_lock:
+        with self._data_lock.reader:
             block = self._get_block(block_name)
 
             # the block has been found
@@ -866,16 +1414,19 @@ class Slave(object):
 
             # if Ok: write the values
             if isinstance(values, list) or isinstance(values, tuple):
-                block[offset:offset+len(values)] = values
+                item = slice(offset, offset+len(values))
             else:
-                block[offset] = values
+                item = offset
+            with block.lock.writer:
+                block._setitem(item, values)
+        call_hooks("modbus.ModbusBlock.setitem", (block, item, values))
 
     def get_values(self, block_name, address, size=1):
         """
         return the values of n items at the given address of the given block
         """
         # thread safe
-        with self._data_lock:
+        with self._data_lock.reader:
             block = self._get_block(block_name)
 
             # the block has been found
@@ -888,15 +1439,19 @@ class Slave(object):
                 )
 
             # returns the values
-            if size == 1:
-                return tuple([block[offset], ])
-            else:
-                return tuple(block[offset:offset+size])
+            with block.lock.reader:
+                if size == 1:
+                    return tuple([block[offset], ])
+                else:
+                    return tuple(block[offset:offset+size])
 
 
 class Databank(object):
     """A databank is a shared place containing the data of all slaves"""
 
+    # the hooks called for this instance only: set by hooks.install_hook
+    _hooks = None
+
     def __init__(self, error_on_missing_slave=True):
         """Constructor"""
         # the map of slaves by ids
@@ -904,15 +1459,20 @@ class Databank(object):
         # protect access to the map of slaves
         self._lock = threading.RLock()
         self.error_on_missing_slave = error_on_missing_slave
+        # the subscriptions to the changes of all the slaves
+        self._subscriptions = []
 
-    def add_slave(self, slave_id, unsigned=True, memory=None):
-        """Add a new slave with the given id"""
+    def add_slave(self, slave_id, unsigned=True, memory=None, compact=False):
+        """Add a new slave with the given id. compact stores its values in arrays (see Slave)"""
         with self._lock:
             if (slave_id <= 0) or (slave_id > 255):
                 raise Exception("Invalid slave id {0}".format(slave_id))
             if slave_id not in self._slaves:
-                self._slaves[slave_id] = Slave(slave_id, unsigned, memory)
-                return self._slaves[slave_id]
+                slave = Slave(slave_id, unsigned, memory, compact)
+                for subscription in self._subscriptions:
+                    slave._add_subscription(subscription)
+                self._slaves[slave_id] = slave
+                return slave
             else:
                 raise DuplicatedKeyError("Slave {0} already exists".format(slave_id))
 
@@ -937,6 +1497,29 @@ class Databank(object):
         with self._lock:
             self._slaves.clear()
 
+    def subscribe(self, callback=None, window=0.0, block_names=None, maxsize=0):
+        """
+        returns a Subscription receiving the changes of all the slaves, including the slaves added later
+        The arguments are the same as Slave.subscribe
+        """
+        subscription = Subscription(callback, window, block_names, maxsize)
+        subscription.attach(self)
+        return subscription
+
+    def _add_subscription(self, subscription):
+        """notify the subscription of the changes of every slave"""
+        with self._lock:
+            self._subscriptions.append(subscription)
+            for slave in self._slaves.values():
+                slave._add_subscription(subscription)
+
+    def _remove_subscription(self, subscription):
+        """stop notifying the subscription"""
+        with self._lock:
+            self._subscriptions.remove(subscription)
+            for slave in self._slaves.values():
+                slave._remove_subscription(subscription)
+
     def handle_request(self, query, request):
         """
         when a request is received, handle it and returns the response pdu
@@ -991,6 +1574,9 @@ class Server(object):
     to be implemented for a TCP or RTU server
     """
 
+    # the hooks called for this instance only: set by hooks.install_hook
+    _hooks = None
+
     def __init__(self, databank=None):
         """Constructor"""
         # never use a mutable type as default argument
@@ -1025,9 +1611,9 @@ class Server(object):
         """returns the databank"""
         return self._databank
 
-    def add_slave(self, slave_id, unsigned=True, memory=None):
+    def add_slave(self, slave_id, unsigned=True, memory=None, compact=False):
         """add slave to the server"""
-        return self._databank.add_slave(slave_id, unsigned, memory)
+        return self._databank.add_slave(slave_id, unsigned, memory, compact)
 
     def get_slave(self, slave_id):
         """get the slave with the given id"""
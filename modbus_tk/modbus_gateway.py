@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+
+ Forward the requests of Modbus TCP clients to the slaves of serial buses
+"""
+
+import collections
+from concurrent.futures import CancelledError
+import struct
+import time
+
+from modbus_tk import LOGGER
+from modbus_tk import defines
+from modbus_tk.exceptions import DuplicatedKeyError, ModbusInvalidRequestError
+from modbus_tk.hooks import call_hooks
+from modbus_tk.modbus import PreparedQuery
+from modbus_tk.modbus_tcp import TcpServer, TcpQuery
+from modbus_tk.scheduler import BusScheduler, PRIORITY_NORMAL
+
+
+def get_expected_length(pdu):
+    """
+    returns the length of the rtu response to a request pdu if it doesn't depend on the slave, -1 otherwise
+    The length of the exceptions and of the responses with a byte count is read in their header
+    """
+    function_code = bytearray(pdu[:1])[0]
+    if function_code in (
+        defines.WRITE_SINGLE_COIL, defines.WRITE_SINGLE_REGISTER, defines.DIAGNOSTIC, defines.MASK_WRITE_REGISTER
+    ):
+        # echo of the request: slave id, pdu and crc
+        return len(pdu) + 3
+    if function_code in (defines.WRITE_MULTIPLE_COILS, defines.WRITE_MULTIPLE_REGISTERS, 11):
+        return 8
+    if function_code == defines.READ_EXCEPTION_STATUS:
+        return 5
+    return -1
+
+
+class ForwardedQuery(PreparedQuery):
+    """
+    A request pdu sent as it is. The response pdu is returned as it is, exception responses included
+    The slaves don't answer to the broadcasts (slave 0): they are sent without waiting for a response
+    """
+
+    def __init__(self, master, slave, pdu):
+        """Constructor"""
+        super(ForwardedQuery, self).__init__(
+            master, slave, defines.RAW, True, pdu, "", get_expected_length(pdu), False, 0
+        )
+
+    def expects_response(self):
+        """returns False for the broadcasts"""
+        return self.slave != 0
+
+    def parse_response_pdu(self, response_pdu):
+        """returns the response pdu"""
+        return response_pdu
+
+
+class TcpRtuGateway(TcpServer):
+    """
+    A Modbus TCP server forwarding the requests to the slaves of one or several serial buses
+    Every bus is a RtuMaster owned by a BusScheduler: the requests of all the clients are queued per bus
+    and executed one after the other while the server keeps on receiving the requests of the other buses
+    The responses are sent back with the transaction id of the request
+    The broadcasts (unit id 0) are forwarded to every bus and are not answered
+    """
+
+    def __init__(self, port=502, address='', timeout_in_sec=1, queue_timeout=None, max_queue_depth=32):
+        """
+        Constructor: initializes the server settings
+        A request still queued after queue_timeout seconds is dropped: the client has given up waiting
+        A request for a bus with max_queue_depth queued requests is answered with SLAVE_DEVICE_BUSY
+        """
+        super(TcpRtuGateway, self).__init__(port, address, timeout_in_sec)
+        self._queue_timeout = queue_timeout
+        self._max_queue_depth = max_queue_depth
+        # the scheduler of every bus by unit id. The bus of the unit id None gets the other unit ids
+        self._routes = {}
+        self._schedulers = []
+        # the responses received by the bus threads and sent by the server thread: (connection, response)
+        self._responses = collections.deque()
+
+    def add_bus(self, master, unit_ids=None, name="", broadcast_turnaround=0.1):
+        """
+        Forward the requests for the unit_ids to the slaves of the master (usually a RtuMaster)
+        If unit_ids is None, the bus gets the requests of the unit ids not routed to another bus
+        The frames are separated by the 3.5 characters required by the RTU protocol
+        and by broadcast_turnaround seconds after a broadcast: the slaves need time for processing it
+        Returns the BusScheduler of the bus: other threads can use it for sharing the bus with the gateway
+        """
+        unit_ids = [None] if unit_ids is None else list(unit_ids)
+        for unit_id in unit_ids:
+            if unit_id in self._routes:
+                raise DuplicatedKeyError("The unit id {0} is already routed".format(unit_id))
+        turnaround = 3.5 * getattr(master, "_t0", 0.0)
+        scheduler = BusScheduler(master, name or str(len(self._schedulers)), turnaround, broadcast_turnaround)
+        self._schedulers.append(scheduler)
+        for unit_id in unit_ids:
+            self._routes[unit_id] = scheduler
+        if self._thread.is_alive():
+            scheduler.start()
+        return scheduler
+
+    def get_bus(self, unit_id):
+        """returns the BusScheduler of the bus of a unit id or None if it is not routed"""
+        return self._routes.get(unit_id, self._routes.get(None))
+
+    def get_queue_depths(self):
+        """returns the number of queued requests of every bus by name"""
+        return dict((scheduler.name, scheduler.get_queue_depth()) for scheduler in self._schedulers)
+
+    def get_bus_stats(self):
+        """returns the statistics of every bus by name: see BusScheduler.get_stats"""
+        return dict((scheduler.name, scheduler.get_stats()) for scheduler in self._schedulers)
+
+    def start(self):
+        """start the buses and the server"""
+        for scheduler in self._schedulers:
+            scheduler.start()
+        super(TcpRtuGateway, self).start()
+
+    def stop(self):
+        """stop the server and the buses. The queued requests are cancelled"""
+        super(TcpRtuGateway, self).stop()
+        for scheduler in self._schedulers:
+            scheduler.stop()
+        self._responses.clear()
+
+    def _process_request(self, connection, request):
+        """queue the request on its bus. The response is sent when the slave answers"""
+        query = TcpQuery()
+        try:
+            (unit_id, pdu) = query.parse_request(request)
+        except ModbusInvalidRequestError as excpt:
+            LOGGER.error("invalid request: %s", excpt)
+            return
+        pdu = bytes(pdu)
+        if not pdu:
+            return
+        scheduler = self.get_bus(unit_id)
+        if scheduler is None and unit_id != 0:
+            self._send_response(connection, self._make_exception(query, pdu, defines.GATEWAY_PATH_UNAVAILABLE))
+            return
+
+        if unit_id != 0 and self._is_full(scheduler):
+            # the bus is overloaded: the client may try again later
+            self._send_response(connection, self._make_exception(query, pdu, defines.SLAVE_DEVICE_BUSY))
+            return
+
+        retval = call_hooks("modbus_gateway.TcpRtuGateway.before_forward", (self, unit_id, pdu))
+        if retval is not None:
+            pdu = retval
+        deadline = time.time() + self._queue_timeout if self._queue_timeout is not None else None
+        if unit_id == 0:
+            # the slaves don't answer to a broadcast: neither does the gateway
+            for scheduler in self._schedulers:
+                if not self._is_full(scheduler):
+                    scheduler.submit(ForwardedQuery(scheduler.master, unit_id, pdu), PRIORITY_NORMAL, deadline)
+            return
+        future = scheduler.submit(ForwardedQuery(scheduler.master, unit_id, pdu), PRIORITY_NORMAL, deadline)
+        future.add_done_callback(lambda future: self._on_response(connection, query, pdu, future))
+
+    def _is_full(self, scheduler):
+        """returns True if the queue of a bus can not get more requests"""
+        return scheduler.get_queue_depth() >= self._max_queue_depth
+
+    def _make_exception(self, query, pdu, exception_code):
+        """returns the tcp frame of an exception response"""
+        function_code = bytearray(pdu[:1])[0]
+        return query.build_response(struct.pack(">BB", function_code | 0x80, exception_code))
+
+    def _on_response(self, connection, query, pdu, future):
+        """called by the thread of the bus when a request is done: the response is sent by the server thread"""
+        try:
+            response_pdu = future.result()
+        except CancelledError:
+            return
+        except Exception as excpt:
+            LOGGER.debug("No response to the forwarded request: %s", excpt)
+            response = self._make_exception(query, pdu, defines.GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        else:
+            response = query.build_response(response_pdu)
+        self._responses.append((connection, response))
+        self._wakeup()
+
+    def _do_run(self):
+        """wait for the sockets being ready then send the responses of the buses"""
+        super(TcpRtuGateway, self)._do_run()
+        while self._responses:
+            (connection, response) = self._responses.popleft()
+            if connection.sock not in self._connections:
+                # the client is gone
+                continue
+            try:
+                self._send_response(connection, response)
+                self._update_events(connection)
+            except Exception as excpt:
+                self._on_connection_error(connection, excpt)
@@ -14,6 +14,8 @@ import struct
 import time
 
 from modbus_tk import LOGGER
+from modbus_tk import crc
+from modbus_tk import defines
 from modbus_tk.modbus import (
     Databank, Query, Master, Server,
     InvalidArgumentError, ModbusInvalidResponseError, ModbusInvalidRequestError
@@ -22,6 +24,87 @@ from modbus_tk.hooks import call_hooks
 from modbus_tk import utils
 
 
+# the length of the requests of fixed size, including the slave id and the crc
+REQUEST_LENGTHS = {
+    defines.READ_COILS: 8,
+    defines.READ_DISCRETE_INPUTS: 8,
+    defines.READ_HOLDING_REGISTERS: 8,
+    defines.READ_INPUT_REGISTERS: 8,
+    defines.WRITE_SINGLE_COIL: 8,
+    defines.WRITE_SINGLE_REGISTER: 8,
+    defines.READ_EXCEPTION_STATUS: 4,
+    defines.DIAGNOSTIC: 8,
+    11: 4,  # get comm event counter
+    12: 4,  # get comm event log
+    defines.REPORT_SLAVE_ID: 4,
+    defines.MASK_WRITE_REGISTER: 10,
+    24: 6,  # read fifo queue
+    defines.DEVICE_INFO: 7,
+}
+
+# the requests of variable size: (position of the byte count, length of the other bytes)
+VARIABLE_REQUEST_LENGTHS = {
+    defines.WRITE_MULTIPLE_COILS: (6, 9),
+    defines.WRITE_MULTIPLE_REGISTERS: (6, 9),
+    defines.READ_FILE_RECORD: (2, 5),
+    21: (2, 5),  # write file record
+    defines.READ_WRITE_MULTIPLE_REGISTERS: (10, 13),
+}
+
+
+def get_request_length(request):
+    """
+    returns the length of a rtu request from its first bytes
+    The length is not known until the function code and the byte count are received: the number of
+    bytes needed for knowing it is returned meanwhile. None is returned for an unknown function code
+    """
+    if len(request) < 2:
+        return 2
+    function_code = bytearray(request[1:2])[0]
+    if function_code in REQUEST_LENGTHS:
+        return REQUEST_LENGTHS[function_code]
+    if function_code in VARIABLE_REQUEST_LENGTHS:
+        (index, length) = VARIABLE_REQUEST_LENGTHS[function_code]
+        if len(request) <= index:
+            return index + 1
+        return length + bytearray(request[index:index+1])[0]
+    return None
+
+
+# the responses starting with a byte count: the slave id, the function code, the byte count and the crc
+BYTE_COUNT_RESPONSES = (
+    defines.READ_COILS,
+    defines.READ_DISCRETE_INPUTS,
+    defines.READ_HOLDING_REGISTERS,
+    defines.READ_INPUT_REGISTERS,
+    12,  # get comm event log
+    defines.REPORT_SLAVE_ID,
+    defines.READ_FILE_RECORD,
+    21,  # write file record
+    defines.READ_WRITE_MULTIPLE_REGISTERS,
+)
+
+
+def get_response_length(response, expected_length=-1):
+    """
+    returns the length of a rtu response from its first bytes
+    The length of the exception responses and of the responses with a byte count is read in their header.
+    Otherwise, expected_length is returned or None if it is not known
+    The number of bytes needed for knowing the length is returned until they are received
+    """
+    if len(response) < 2:
+        return 2
+    function_code = bytearray(response[1:2])[0]
+    if function_code & 0x80:
+        # slave id, function code, exception code and crc
+        return 5
+    if function_code in BYTE_COUNT_RESPONSES:
+        if len(response) < 3:
+            return 3
+        return 5 + bytearray(response[2:3])[0]
+    return expected_length if expected_length >= 0 else None
+
+
 class RtuQuery(Query):
     """Subclass of a Query. Adds the Modbus RTU specific part of the protocol"""
 
@@ -36,27 +119,39 @@ class RtuQuery(Query):
         self._request_address = slave
         if (self._request_address < 0) or (self._request_address > 255):
             raise InvalidArgumentError("Invalid address {0}".format(self._request_address))
-        data = struct.pack(">B", self._request_address) + pdu
-        crc = struct.pack(">H", utils.calculate_crc(data))
-        return data + crc
+        address = struct.pack(">B", self._request_address)
+        frame_crc = crc.update(crc.update(crc.INITIAL_CRC, address), pdu)
+        return b"".join((address, pdu, crc.pack(frame_crc)))
 
     def parse_response(self, response):
         """Extract the pdu from the Modbus RTU response"""
+        pdu = self._parse_response(self._request_address, response)
+        self._response_address = self._request_address
+        return pdu
+
+    def build_prepared_request(self, pdu, slave):
+        """Returns the request of a PreparedQuery: it is sent as it is by every execution"""
+        return self.build_request(pdu, slave)
+
+    def parse_prepared_response(self, request, response):
+        """Check that the response comes from the slave of the request and extract the pdu"""
+        return self._parse_response(bytearray(request[:1])[0], response)
+
+    def _parse_response(self, request_address, response):
+        """Check the address and the crc of the response and extract the pdu"""
         if len(response) < 3:
             raise ModbusInvalidResponseError("Response length is invalid {0}".format(len(response)))
 
-        (self._response_address, ) = struct.unpack(">B", response[0:1])
+        (response_address, ) = struct.unpack(">B", response[0:1])
 
-        if self._request_address != self._response_address:
+        if request_address != response_address:
             raise ModbusInvalidResponseError(
                 "Response address {0} is different from request address {1}".format(
-                    self._response_address, self._request_address
+                    response_address, request_address
                 )
             )
 
-        (crc, ) = struct.unpack(">H", response[-2:])
-
-        if crc != utils.calculate_crc(response[:-2]):
+        if not crc.validate_frame(response):
             raise ModbusInvalidResponseError("Invalid CRC in response")
 
         return response[1:-2]
@@ -68,8 +163,7 @@ class RtuQuery(Query):
 
         (self._request_address, ) = struct.unpack(">B", request[0:1])
 
-        (crc, ) = struct.unpack(">H", request[-2:])
-        if crc != utils.calculate_crc(request[:-2]):
+        if not crc.validate_frame(request):
             raise ModbusInvalidRequestError("Invalid CRC in request")
 
         return self._request_address, request[1:-2]
@@ -77,9 +171,9 @@ class RtuQuery(Query):
     def build_response(self, response_pdu):
         """Build the response"""
         self._response_address = self._request_address
-        data = struct.pack(">B", self._response_address) + response_pdu
-        crc = struct.pack(">H", utils.calculate_crc(data))
-        return data + crc
+        address = struct.pack(">B", self._response_address)
+        frame_crc = crc.update(crc.update(crc.INITIAL_CRC, address), response_pdu)
+        return b"".join((address, response_pdu, crc.pack(frame_crc)))
 
 
 class RtuMaster(Master):
@@ -91,6 +185,8 @@ class RtuMaster(Master):
         self.use_sw_timeout = False
         LOGGER.debug("RtuMaster %s is %s", self._serial.name, "opened" if self._serial.is_open else "closed")
         super(RtuMaster, self).__init__(self._serial.timeout)
+        # several masters may share the same serial line: they must share the same lock
+        self._lock = utils.get_shared_lock(self._serial)
 
         if t0:
             self._t0 = t0
@@ -140,17 +236,18 @@ class RtuMaster(Master):
             self._serial.read(len(request))
 
     def _recv(self, expected_length=-1):
-        """Receive the response from the slave"""
+        """
+        Receive the response from the slave
+        The length of the response is read in its header when possible: an exception response
+        is done after 5 bytes even if expected_length is longer
+        """
         response = utils.to_data("")
         start_time = time.time() if self.use_sw_timeout else 0
-        readed_len = 0
+        length = get_response_length(response, expected_length)
         while True:
-            if self._serial.timeout:
-                # serial.read() says if a timeout is set it may return less characters as requested
-                # we should update expected_length by readed_len
-                read_bytes = self._serial.read(expected_length - readed_len if (expected_length - readed_len) > 0 else 1)
-            else:
-                read_bytes = self._serial.read(expected_length if expected_length > 0 else 1)
+            # serial.read() says if a timeout is set it may return less characters as requested
+            # the bytes still missing are read again
+            read_bytes = self._serial.read(length - len(response) if length is not None else 1)
             if self.use_sw_timeout:
                 read_duration = time.time() - start_time
             else:
@@ -158,11 +255,11 @@ class RtuMaster(Master):
             if (not read_bytes) or (read_duration > self._serial.timeout):
                 break
             response += read_bytes
-            if expected_length >= 0 and len(response) >= expected_length:
+            length = get_response_length(response, expected_length)
+            if length is not None and len(response) >= length:
                 # if the expected number of byte is received consider that the response is done
                 # improve performance by avoiding end-of-response detection by timeout
                 break
-            readed_len += len(read_bytes)
 
         retval = call_hooks("modbus_rtu.RtuMaster.after_recv", (self, response))
         if retval is not None:
@@ -256,6 +353,15 @@ class RtuServer(Server):
         """close the serial connection"""
         self.close()
 
+    def _read(self, size):
+        """read up to size bytes. Returns empty data if the timeout expires or on error"""
+        try:
+            return self._serial.read(size)
+        except Exception:
+            self._serial.close()
+            self._serial.open()
+            return utils.to_data('')
+
     def _do_run(self):
         """main function of the server"""
         try:
@@ -272,17 +378,26 @@ class RtuServer(Server):
                     self._serial.open()
                 self._serial.timeout = self._timeout
 
-            # Read rest of the request
-            while True:
-                try:
-                    read_bytes = self._serial.read(128)
-                    if not read_bytes:
-                        break
-                except Exception as e:
-                    self._serial.close()
-                    self._serial.open()
+            # Read rest of the request: it is handled as soon as it is complete
+            # the crc is updated with the bytes as they are received: it is 0 at the end of a valid frame
+            frame_crc = crc.update(crc.INITIAL_CRC, request)
+            length = get_request_length(request)
+            while (length is not None) and (len(request) < length):
+                read_bytes = self._read(length - len(request))
+                if not read_bytes:
                     break
                 request += read_bytes
+                frame_crc = crc.update(frame_crc, read_bytes)
+                length = get_request_length(request)
+
+            if (length is None) or (len(request) != length) or (frame_crc != 0):
+                # unknown function, truncated request or frame sent by another device:
+                # read until the end of the frame is detected by the timeout
+                while True:
+                    read_bytes = self._read(128)
+                    if not read_bytes:
+                        break
+                    request += read_bytes
 
             # parse the request
             if request:
@@ -305,7 +420,6 @@ class RtuServer(Server):
                     else:
                         self._serial.write(response)
                         self._serial.flush()
-                        time.sleep(self.get_timeout())
 
                 call_hooks("modbus_rtu.RtuServer.after_write", (self, response))
 
@@ -10,7 +10,8 @@
 """
 
 from modbus_tk.hooks import call_hooks
-from modbus_tk.modbus_rtu import RtuQuery
+from modbus_tk.modbus import Master
+from modbus_tk.modbus_rtu import RtuQuery, get_response_length
 from modbus_tk.modbus_tcp import TcpMaster
 from modbus_tk.utils import to_data
 
@@ -19,15 +20,14 @@ class RtuOverTcpMaster(TcpMaster):
     """Subclass of TcpMaster. Implements the Modbus RTU over TCP MAC layer"""
 
     def _recv(self, expected_length=-1):
-        """Receive the response from the slave"""
+        """Receive the response from the slave. The length is read in the header when possible"""
         response = to_data('')
-        length = 255
-        while len(response) < length:
-            rcv_byte = self._sock.recv(1)
+        length = get_response_length(response, expected_length)
+        while len(response) < (length if length is not None else 255):
+            rcv_byte = self._sock.recv(length - len(response) if length is not None else 1)
             if rcv_byte:
                 response += rcv_byte
-            if expected_length >= 0 and len(response) >= expected_length:
-                break
+            length = get_response_length(response, expected_length)
         retval = call_hooks("modbus_rtu_over_tcp.RtuOverTcpMaster.after_recv", (self, response))
         if retval is not None:
             return retval
@@ -36,3 +36,10 @@ class RtuOverTcpMaster(TcpMaster):
     def _make_query(self):
         """Returns an instance of a Query subclass implementing the modbus RTU protocol"""
         return RtuQuery()
+
+    def execute_many(self, queries, window=None):
+        """
+        Execute several queries one after the other
+        RTU frames have no transaction id: the queries can not be pipelined
+        """
+        return Master.execute_many(self, queries)
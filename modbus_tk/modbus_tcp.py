@@ -9,8 +9,9 @@
  This is distributed under GNU LGPL license, see license.txt
 """
 
+import errno
+import selectors
 import socket
-import select
 import struct
 
 from modbus_tk import LOGGER
@@ -19,7 +20,13 @@ from modbus_tk.modbus import (
     Databank, Master, Query, Server,
     InvalidArgumentError, ModbusInvalidResponseError, ModbusInvalidRequestError
 )
-from modbus_tk.utils import threadsafe_function, flush_socket, to_data
+from modbus_tk.utils import threadsafe_function, threadsafe_method, flush_socket, get_log_buffer
+
+
+# maximum value of the length field of the mbap: unit id + pdu
+# The Modbus specification limits the pdu to 253 bytes. Accept a bit more
+# in order to answer with an error to requests which are a bit too long
+MAX_MBAP_LENGTH = 260
 
 
 #-------------------------------------------------------------------------------
@@ -113,6 +120,10 @@ class TcpQuery(Query):
             TcpQuery._last_transaction_id = 0
         return TcpQuery._last_transaction_id
 
+    def get_transaction_id(self):
+        """returns the transaction id of the request"""
+        return self._request_mbap.transaction_id
+
     def build_request(self, pdu, slave):
         """Add the Modbus TCP part to the request"""
         if (slave < 0) or (slave > 255):
@@ -133,6 +144,29 @@ class TcpQuery(Query):
         else:
             raise ModbusInvalidResponseError("Response length is only {0} bytes. ".format(len(response)))
 
+    def build_prepared_request(self, pdu, slave):
+        """Returns the request of a PreparedQuery: only its transaction id is changed by renew_request"""
+        return self.build_request(pdu, slave)
+
+    def renew_request(self, request):
+        """Returns the request with a new transaction id"""
+        return struct.pack(">H", self._get_transaction_id()) + request[2:]
+
+    def parse_prepared_response(self, request, response):
+        """Check the mbap of the response against the one of the request and extract the pdu"""
+        if len(response) <= 6:
+            raise ModbusInvalidResponseError("Response length is only {0} bytes. ".format(len(response)))
+        if (
+            response[:4] != request[:4] or response[6] != request[6]
+            or struct.unpack(">H", response[4:6])[0] != len(response) - 6
+        ):
+            # describe the error like parse_response
+            (request_mbap, response_mbap) = (TcpMbap(), TcpMbap())
+            request_mbap.unpack(request[:7])
+            response_mbap.unpack(response[:7])
+            response_mbap.check_response(request_mbap, len(response) - 7)
+        return response[7:]
+
     def parse_request(self, request):
         """Extract the pdu from a modbus request"""
         if len(request) > 6:
@@ -155,12 +189,16 @@ class TcpQuery(Query):
 class TcpMaster(Master):
     """Subclass of Master. Implements the Modbus TCP MAC layer"""
 
-    def __init__(self, host="127.0.0.1", port=502, timeout_in_sec=5.0):
-        """Constructor. Set the communication settings"""
+    def __init__(self, host="127.0.0.1", port=502, timeout_in_sec=5.0, pipeline_window=8):
+        """
+        Constructor. Set the communication settings
+        pipeline_window is the default number of queries sent without waiting for the response by execute_many
+        """
         super(TcpMaster, self).__init__(timeout_in_sec)
         self._host = host
         self._port = port
         self._sock = None
+        self.pipeline_window = pipeline_window
 
     def _do_open(self):
         """Connect to the Modbus slave"""
@@ -192,9 +230,6 @@ class TcpMaster(Master):
 
     def _send(self, request):
         """Send request to the slave"""
-        retval = call_hooks("modbus_tcp.TcpMaster.before_send", (self, request))
-        if retval is not None:
-            request = retval
         try:
             flush_socket(self._sock, 3)
         except Exception as msg:
@@ -202,7 +237,27 @@ class TcpMaster(Master):
             #try to reconnect
             LOGGER.error('Error while flushing the socket: {0}'.format(msg))
             self._do_open()
-        self._sock.send(request)
+        self._send_request(request)
+
+    def _send_request(self, request):
+        """Send request to the slave without removing the pending data of the socket"""
+        retval = call_hooks("modbus_tcp.TcpMaster.before_send", (self, request))
+        if retval is not None:
+            request = retval
+        self._sock.sendall(request)
+
+    def _recv_into(self, view):
+        """
+        Fill the given memoryview with data from the socket
+        Returns the number of bytes received: less than expected if the connection is closed
+        """
+        nb_of_bytes = 0
+        while nb_of_bytes < len(view):
+            received = self._sock.recv_into(view[nb_of_bytes:])
+            if not received:
+                break
+            nb_of_bytes += received
+        return nb_of_bytes
 
     def _recv(self, expected_length=-1):
         """
@@ -210,17 +265,20 @@ class TcpMaster(Master):
         Do not take expected_length into account because the length of the response is
         written in the mbap. Used for RTU only
         """
-        response = to_data('')
-        length = 255
-        while len(response) < length:
-            rcv_byte = self._sock.recv(1)
-            if rcv_byte:
-                response += rcv_byte
-                if len(response) == 6:
-                    to_be_recv_length = struct.unpack(">HHH", response)[2]
-                    length = to_be_recv_length + 6
-            else:
-                break
+        # read the beginning of the mbap: it contains the number of following bytes
+        header = bytearray(6)
+        received = self._recv_into(memoryview(header))
+        if received < len(header):
+            response = header[:received]
+        else:
+            length = struct.unpack(">HHH", header)[2]
+            response = bytearray(6 + length)
+            view = memoryview(response)
+            view[:6] = header
+            received = self._recv_into(view[6:])
+            if received < length:
+                del view
+                del response[6 + received:]
         retval = call_hooks("modbus_tcp.TcpMaster.after_recv", (self, response))
         if retval is not None:
             return retval
@@ -230,14 +288,216 @@ class TcpMaster(Master):
         """Returns an instance of a Query subclass implementing the modbus TCP protocol"""
         return TcpQuery()
 
+    @threadsafe_method
+    def execute_many(self, queries, window=None):
+        """
+        Execute several queries and returns the list of their results in the same order
+        Every query is a PreparedQuery, a tuple or a dict with the arguments of execute
+        Up to window queries (pipeline_window by default) are sent without waiting for the responses.
+        The responses are matched with the queries by transaction id: they can come in any order.
+        If a query fails, the responses of the queries already sent are read before raising the
+        first error. The following queries are not sent.
+        """
+        if window is None:
+            window = self.pipeline_window
+        pipeline = TcpPipeline(self, queries, window)
+
+        # open the connection if it is not already done
+        self.open()
+
+        # remove the data of a previous query which has timed out
+        try:
+            flush_socket(self._sock, 3)
+        except Exception as msg:
+            LOGGER.error('Error while flushing the socket: {0}'.format(msg))
+            self._do_open()
+
+        while True:
+            # fill the window
+            request = pipeline.pop_request()
+            while request is not None:
+                retval = call_hooks("modbus.Master.before_send", (self, request))
+                if retval is not None:
+                    request = retval
+                if self._verbose:
+                    LOGGER.debug(get_log_buffer("-> ", request))
+                self._send_request(request)
+                call_hooks("modbus.Master.after_send", (self, ))
+                request = pipeline.pop_request()
+
+            if not pipeline.is_waiting():
+                break
+
+            # receive the data from the slave
+            response = self._recv()
+            retval = call_hooks("modbus.Master.after_recv", (self, response))
+            if retval is not None:
+                response = retval
+            if self._verbose:
+                LOGGER.debug(get_log_buffer("<- ", response))
+            pipeline.add_response(response)
+
+        return pipeline.get_results()
+
+
+class TcpPipeline(object):
+    """
+    The queries of an execute_many sent on a Modbus TCP connection without waiting for their responses
+    It frames the requests and matches the responses by transaction id: the masters only do the I/O
+    """
+
+    def __init__(self, master, queries, window):
+        """Constructor: up to window queries are waiting for their response"""
+        if (window < 1) or (window > 0xffff):
+            raise InvalidArgumentError("{0} Invalid value for the window".format(window))
+        self._master = master
+        self._queries = queries
+        self._window = window
+        self._results = [None] * len(queries)
+        # the index, the query, the request and the prepared query by transaction id
+        self._in_flight = {}
+        self._next_index = 0
+        # the first error: the following queries are not sent
+        self._error = None
+
+    def pop_request(self):
+        """returns the next request to send, None if the window is full or if there is nothing to send"""
+        if self._error is not None or len(self._in_flight) >= self._window:
+            return None
+        if self._next_index >= len(self._queries):
+            return None
+        index = self._next_index
+        self._next_index += 1
+        try:
+            prepared = self._master._get_prepared_query(self._queries[index])
+            (query, request) = prepared.get_request(self._master)
+            request = query.renew_request(request)
+        except Exception as excpt:
+            self._error = excpt
+            return None
+        if prepared.expects_response():
+            self._in_flight[struct.unpack(">H", request[:2])[0]] = (index, query, request, prepared)
+        return request
+
+    def is_waiting(self):
+        """returns True if responses are expected"""
+        return bool(self._in_flight)
+
+    def add_response(self, response):
+        """
+        match a response with its query and parse it
+        Raise ModbusInvalidMbapError if the transaction id is unknown: the connection is out of sync
+        """
+        if len(response) < 2:
+            raise ModbusInvalidResponseError("Response length is only {0} bytes. ".format(len(response)))
+        (transaction_id, ) = struct.unpack(">H", response[:2])
+        if transaction_id not in self._in_flight:
+            # the connection is out of sync: the pending responses can't be trusted
+            raise ModbusInvalidMbapError("Unexpected transaction id in response: {0}".format(transaction_id))
+
+        (index, query, request, prepared) = self._in_flight.pop(transaction_id)
+        try:
+            self._results[index] = prepared.parse_response_pdu(query.parse_prepared_response(request, response))
+        except Exception as excpt:
+            if self._error is None:
+                self._error = excpt
+
+    def get_results(self):
+        """returns the results of the queries in their order. Raise the first error if any"""
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+
+class TcpServerConnection(object):
+    """
+    State of a connection between the TcpServer and one of its clients
+    The received bytes are buffered until a complete request is available and
+    the responses are buffered until the socket accepts them
+    """
+
+    # number of bytes read from the socket at once
+    RECV_SIZE = 4096
+
+    def __init__(self, sock, address):
+        """Constructor: the socket must be non-blocking"""
+        self.sock = sock
+        self.address = address
+        self._in_buffer = bytearray()
+        self._out_buffer = bytearray()
+        # the events for which the socket is registered in the selector of the server
+        self.events = 0
+
+    def fileno(self):
+        """returns the file descriptor of the socket"""
+        return self.sock.fileno()
+
+    def recv(self):
+        """
+        Read what is available on the socket
+        Returns False if the client has closed the connection
+        """
+        try:
+            data = self.sock.recv(self.RECV_SIZE)
+        except socket.error as excpt:
+            if excpt.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            raise
+        if not data:
+            return False
+        self._in_buffer += data
+        return True
+
+    def pop_request(self):
+        """Returns the next complete request or None if it is not fully received yet"""
+        if len(self._in_buffer) < 6:
+            return None
+        length = struct.unpack(">HHH", bytes(self._in_buffer[:6]))[2]
+        if (length < 1) or (length > MAX_MBAP_LENGTH):
+            raise ModbusInvalidRequestError("Invalid length in mbap: {0}".format(length))
+        if len(self._in_buffer) < length + 6:
+            return None
+        request = self._in_buffer[:length + 6]
+        del self._in_buffer[:length + 6]
+        return request
+
+    def send(self, response):
+        """Queue the response and send as much as possible without blocking"""
+        self._out_buffer += response
+        self.flush()
+
+    def flush(self):
+        """Send as much as possible of the pending data without blocking"""
+        if self._out_buffer:
+            try:
+                sent = self.sock.send(self._out_buffer)
+            except socket.error as excpt:
+                if excpt.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            del self._out_buffer[:sent]
+
+    def pending_output(self):
+        """returns the number of bytes waiting to be sent"""
+        return len(self._out_buffer)
+
+    def close(self):
+        """close the socket"""
+        self.sock.close()
+
 
 class TcpServer(Server):
     """
     This class implements a simple and mono-threaded modbus tcp server
     !! Change in 0.5.0: By default the TcpServer is not bound to a specific address
     for example: You must set address to 'loaclhost', if youjust want to accept local connections
+    The sockets are monitored with the best selector of the platform (epoll on Linux)
+    so the server can handle thousands of connections
     """
 
+    # stop reading the requests of a client which doesn't read its responses
+    MAX_PENDING_OUTPUT = 65536
+
     def __init__(self, port=502, address='', timeout_in_sec=1, databank=None, error_on_missing_slave=True):
         """Constructor: initializes the server settings"""
         databank = databank if databank else Databank(error_on_missing_slave=error_on_missing_slave)
@@ -245,7 +505,11 @@ class TcpServer(Server):
         self._sock = None
         self._sa = (address, port)
         self._timeout_in_sec = timeout_in_sec
-        self._sockets = []
+        # the connections with the clients by socket
+        self._connections = {}
+        self._selector = None
+        # a socket pair used by stop() for waking up the server thread
+        self._wakeup_sockets = None
 
     def _make_query(self):
         """Returns an instance of a Query subclass implementing the modbus TCP protocol"""
@@ -266,95 +530,168 @@ class TcpServer(Server):
             self._sock.settimeout(self._timeout_in_sec)
         self._sock.setblocking(0)
         self._sock.bind(self._sa)
-        self._sock.listen(10)
-        self._sockets.append(self._sock)
+        self._sock.listen(socket.SOMAXCONN)
+        self._wakeup_sockets = socket.socketpair()
+        for sock in self._wakeup_sockets:
+            sock.setblocking(0)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_sockets[0], selectors.EVENT_READ)
 
     def _do_exit(self):
         """clean the server tasks"""
         #close the sockets
-        for sock in self._sockets:
+        for connection in list(self._connections.values()):
             try:
-                sock.close()
+                connection.close()
             except Exception as msg:
                 LOGGER.warning("Error while closing socket, Exception occurred: %s", msg)
-        self._sockets = []
+        self._connections = {}
+        self._selector.close()
+        self._selector = None
+        for sock in self._wakeup_sockets:
+            sock.close()
+        self._wakeup_sockets = None
         self._sock.close()
         self._sock = None
 
+    def stop(self):
+        """stop the server without waiting for the timeout of the selector"""
+        # the thread creates a new thread object when it ends: keep the running one
+        thread = self._thread
+        if thread.is_alive():
+            self._go.clear()
+            self._wakeup()
+            thread.join()
+
+    def _wakeup(self):
+        """make the selector of the server thread return immediately"""
+        wakeup_sockets = self._wakeup_sockets
+        if wakeup_sockets:
+            try:
+                wakeup_sockets[1].send(b"\x00")
+            except socket.error:
+                # the wakeup socket is full: the thread will wake up anyway
+                pass
+
+    def _accept(self):
+        """accept a new client"""
+        client, address = self._sock.accept()
+        client.setblocking(0)
+        LOGGER.debug("%s is connected with socket %d...", str(address), client.fileno())
+        connection = TcpServerConnection(client, address)
+        self._connections[client] = connection
+        self._update_events(connection)
+        call_hooks("modbus_tcp.TcpServer.on_connect", (self, client, address))
+
+    def _close_connection(self, connection):
+        """close the connection and forget it"""
+        if self._connections.pop(connection.sock, None) is not None and connection.events:
+            self._selector.unregister(connection.sock)
+            connection.events = 0
+        connection.close()
+
+    def _update_events(self, connection):
+        """
+        Register the connection for the events it is waiting for:
+        writable if responses are pending and readable unless too many responses are pending
+        """
+        pending_output = connection.pending_output()
+        events = selectors.EVENT_WRITE if pending_output else 0
+        if pending_output < self.MAX_PENDING_OUTPUT:
+            events |= selectors.EVENT_READ
+        if events != connection.events:
+            if not connection.events:
+                self._selector.register(connection.sock, events, connection)
+            elif not events:
+                self._selector.unregister(connection.sock)
+            else:
+                self._selector.modify(connection.sock, events, connection)
+            connection.events = events
+
+    def _handle_input(self, connection):
+        """read the data sent by a client and handle every complete request"""
+        sock = connection.sock
+        if not connection.recv():
+            # socket is disconnected
+            LOGGER.debug("%d is disconnected" % (sock.fileno()))
+            call_hooks("modbus_tcp.TcpServer.on_disconnect", (self, sock))
+            self._close_connection(connection)
+            return
+
+        while True:
+            request = connection.pop_request()
+            if request is None:
+                break
+
+            # the hook gets the mbap as it did when the requests were read byte per byte
+            # the length of the request has already been read in the mbap: it can not be changed
+            retval = call_hooks("modbus_tcp.TcpServer.after_recv", (self, sock, request[:7]))
+            if retval is not None:
+                request = retval + request[7:]
+
+            self._process_request(connection, request)
+
+    def _process_request(self, connection, request):
+        """handle a request and send back the response"""
+        response = ""
+        # parse the request
+        try:
+            response = self._handle(request)
+        except Exception as msg:
+            LOGGER.error("Error while handling a request, Exception occurred: %s", msg)
+
+        # send back the response
+        if response:
+            self._send_response(connection, response)
+
+    def _send_response(self, connection, response):
+        """queue the response on the connection and send as much as possible"""
+        sock = connection.sock
+        retval = call_hooks("modbus_tcp.TcpServer.before_send", (self, sock, response))
+        if retval is not None:
+            response = retval
+        connection.send(response)
+        call_hooks("modbus_tcp.TcpServer.after_send", (self, sock, response))
+
     def _do_run(self):
         """called in a almost-for-ever loop by the server"""
-        # check the status of every socket
-        inputready = select.select(self._sockets, [], [], 1.0)[0]
-
-        # handle data on each a socket
-        for sock in inputready:
-            try:
-                if sock == self._sock:
+        # wait for the sockets being ready
+        for (key, events) in self._selector.select(1.0):
+            connection = key.data
+            if connection is None:
+                if key.fileobj == self._sock:
                     # handle the server socket
-                    client, address = self._sock.accept()
-                    client.setblocking(0)
-                    LOGGER.debug("%s is connected with socket %d...", str(address), client.fileno())
-                    self._sockets.append(client)
-                    call_hooks("modbus_tcp.TcpServer.on_connect", (self, client, address))
+                    try:
+                        self._accept()
+                    except Exception as excpt:
+                        LOGGER.warning("Error while accepting a connection: %s", excpt)
                 else:
-                    if len(sock.recv(1, socket.MSG_PEEK)) == 0:
-                        # socket is disconnected
-                        LOGGER.debug("%d is disconnected" % (sock.fileno()))
-                        call_hooks("modbus_tcp.TcpServer.on_disconnect", (self, sock))
-                        sock.close()
-                        self._sockets.remove(sock)
-                        break
-
-                    # handle all other sockets
-                    sock.settimeout(1.0)
-                    request = to_data("")
-                    is_ok = True
-
-                    # read the 7 bytes of the mbap
-                    while (len(request) < 7) and is_ok:
-                        new_byte = sock.recv(1)
-                        if len(new_byte) == 0:
-                            is_ok = False
-                        else:
-                            request += new_byte
-
-                    retval = call_hooks("modbus_tcp.TcpServer.after_recv", (self, sock, request))
-                    if retval is not None:
-                        request = retval
-
-                    if is_ok:
-                        # read the rest of the request
-                        length = self._get_request_length(request)
-                        while (len(request) < (length + 6)) and is_ok:
-                            new_byte = sock.recv(1)
-                            if len(new_byte) == 0:
-                                is_ok = False
-                            else:
-                                request += new_byte
-
-                    if is_ok:
-                        response = ""
-                        # parse the request
-                        try:
-                            response = self._handle(request)
-                        except Exception as msg:
-                            LOGGER.error("Error while handling a request, Exception occurred: %s", msg)
-
-                        # send back the response
-                        if response:
-                            try:
-                                retval = call_hooks("modbus_tcp.TcpServer.before_send", (self, sock, response))
-                                if retval is not None:
-                                    response = retval
-                                sock.send(response)
-                                call_hooks("modbus_tcp.TcpServer.after_send", (self, sock, response))
-                            except Exception as msg:
-                                is_ok = False
-                                LOGGER.error(
-                                    "Error while sending on socket %d, Exception occurred: %s", sock.fileno(), msg
-                                )
+                    # woken up by stop()
+                    try:
+                        key.fileobj.recv(1024)
+                    except socket.error:
+                        pass
+                continue
+
+            if connection.sock not in self._connections:
+                # the connection has been closed
+                continue
+            try:
+                # send the pending responses
+                if events & selectors.EVENT_WRITE:
+                    connection.flush()
+                # handle the data received from the client
+                if events & selectors.EVENT_READ:
+                    self._handle_input(connection)
+                if connection.sock in self._connections:
+                    self._update_events(connection)
             except Exception as excpt:
-                LOGGER.warning("Error while processing data on socket %d: %s", sock.fileno(), excpt)
-                call_hooks("modbus_tcp.TcpServer.on_error", (self, sock, excpt))
-                sock.close()
-                self._sockets.remove(sock)
+                self._on_connection_error(connection, excpt)
+
+    def _on_connection_error(self, connection, excpt):
+        """an error occurred on a connection: close it"""
+        sock = connection.sock
+        LOGGER.warning("Error while processing data on socket %d: %s", sock.fileno(), excpt)
+        call_hooks("modbus_tcp.TcpServer.on_error", (self, sock, excpt))
+        self._close_connection(connection)
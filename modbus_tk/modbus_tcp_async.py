@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+
+ Modbus TCP with asyncio: requires python 3.7 or later
+"""
+
+import asyncio
+import struct
+
+from modbus_tk import LOGGER
+from modbus_tk.hooks import call_hooks
+from modbus_tk.modbus import (
+    Databank, Master, Server, ModbusInvalidRequestError, ModbusInvalidResponseError
+)
+from modbus_tk.modbus_tcp import TcpPipeline, TcpQuery, ModbusInvalidMbapError, MAX_MBAP_LENGTH
+from modbus_tk.utils import get_log_buffer
+
+
+class AsyncTcpMaster(Master):
+    """
+    Subclass of Master. Implements the Modbus TCP MAC layer with asyncio
+    open, close, execute and the bulk methods are coroutines: a single event loop can poll many slaves
+    """
+
+    def __init__(self, host="127.0.0.1", port=502, timeout_in_sec=5.0, pipeline_window=8):
+        """
+        Constructor. Set the communication settings
+        pipeline_window is the default number of queries sent without waiting for the response by execute_many
+        """
+        super(AsyncTcpMaster, self).__init__(timeout_in_sec)
+        self._host = host
+        self._port = port
+        self.pipeline_window = pipeline_window
+        self._reader = None
+        self._writer = None
+        # serialize the queries on the connection. Created when first used because
+        # an asyncio.Lock may be bound to the running loop
+        self._async_lock = None
+
+    def __del__(self):
+        """Destructor: close the connection"""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                # the event loop may be closed already
+                pass
+            self._writer = None
+
+    def _get_async_lock(self):
+        """returns the lock of the connection"""
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        return self._async_lock
+
+    def _is_connected(self):
+        """returns True if the connection is usable"""
+        return (
+            self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+        )
+
+    async def open(self):
+        """open the connection with the slave"""
+        if not self._is_connected():
+            await self._do_open()
+            self._is_opened = True
+
+    async def close(self):
+        """close the connection with the slave"""
+        if self._is_opened:
+            await self._do_close()
+            self._is_opened = False
+
+    async def _do_open(self):
+        """Connect to the Modbus slave"""
+        if self._writer is not None:
+            await self._do_close()
+        call_hooks("modbus_tcp_async.AsyncTcpMaster.before_connect", (self, ))
+        coroutine = asyncio.open_connection(self._host, self._port)
+        if self._timeout:
+            coroutine = asyncio.wait_for(coroutine, self._timeout)
+        self._reader, self._writer = await coroutine
+        call_hooks("modbus_tcp_async.AsyncTcpMaster.after_connect", (self, ))
+
+    async def _do_close(self):
+        """Close the connection with the Modbus Slave"""
+        if self._writer is not None:
+            call_hooks("modbus_tcp_async.AsyncTcpMaster.before_close", (self, ))
+            writer, self._reader, self._writer = self._writer, None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception as msg:
+                LOGGER.debug("Error while closing the connection: %s", msg)
+            call_hooks("modbus_tcp_async.AsyncTcpMaster.after_close", (self, ))
+
+    async def _send(self, request):
+        """Send request to the slave"""
+        retval = call_hooks("modbus_tcp_async.AsyncTcpMaster.before_send", (self, request))
+        if retval is not None:
+            request = retval
+        self._writer.write(request)
+        await self._writer.drain()
+
+    async def _recv(self, expected_length=-1):
+        """
+        Receive the response from the slave
+        The length of the response is read in the mbap
+        """
+        try:
+            response = await self._reader.readexactly(6)
+            length = struct.unpack(">HHH", response)[2]
+            response += await self._reader.readexactly(length)
+        except asyncio.IncompleteReadError as excpt:
+            # the connection is closed: the query will fail while parsing the truncated response
+            response = excpt.partial
+            await self._do_close()
+        retval = call_hooks("modbus_tcp_async.AsyncTcpMaster.after_recv", (self, response))
+        if retval is not None:
+            return retval
+        return response
+
+    def _make_query(self):
+        """Returns an instance of a Query subclass implementing the modbus TCP protocol"""
+        return TcpQuery()
+
+    async def execute(
+        self, slave, function_code, starting_address, quantity_of_x=0, output_value=0, data_format="",
+        expected_length=-1, write_starting_address_fc23=0, number_file=None, pdu="", returns_raw=False,
+        and_mask=-1, or_mask=-1
+    ):
+        """
+        Execute a modbus query and returns the data part of the answer as a tuple
+        The arguments and the result are the same as Master.execute
+        The connection is opened again if it has been closed
+        asyncio.TimeoutError is raised if the slave doesn't answer before the timeout
+        """
+        return await self.execute_prepared(self.prepare(
+            slave, function_code, starting_address, quantity_of_x, output_value, data_format, expected_length,
+            write_starting_address_fc23, number_file, pdu, returns_raw, and_mask, or_mask
+        ))
+
+    async def execute_many(self, queries, window=None):
+        """
+        Execute several queries and returns the list of their results in the same order
+        Every query is a PreparedQuery, a tuple or a dict with the arguments of execute
+        Up to window queries (pipeline_window by default) are sent without waiting for the responses.
+        The responses are matched with the queries by transaction id: they can come in any order.
+        If a query fails, the responses of the queries already sent are read before raising the
+        first error. The following queries are not sent.
+        """
+        if window is None:
+            window = self.pipeline_window
+        pipeline = TcpPipeline(self, queries, window)
+
+        async with self._get_async_lock():
+            # connect or reconnect if the connection has been lost
+            await self.open()
+
+            try:
+                while True:
+                    # fill the window
+                    request = pipeline.pop_request()
+                    while request is not None:
+                        await self._send_request(request)
+                        request = pipeline.pop_request()
+
+                    if not pipeline.is_waiting():
+                        break
+
+                    pipeline.add_response(await self._recv_response())
+            except (
+                asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, OSError,
+                ModbusInvalidResponseError, ModbusInvalidMbapError
+            ):
+                # the pending responses would be read by the next queries: start again with a new connection
+                await self._do_close()
+                raise
+
+        return pipeline.get_results()
+
+    async def _read_bulk(self, slave, function_code, starting_address, quantity, max_quantity, window):
+        """read quantity values by chunks and returns them as one tuple"""
+        queries = self._make_bulk_queries(slave, function_code, starting_address, quantity, max_quantity)
+        return tuple(value for values in await self.execute_many(queries, window) for value in values)
+
+    async def _write_bulk(self, slave, function_code, starting_address, values, max_quantity, window):
+        """write the values by chunks and returns (starting_address, number of values written)"""
+        queries = self._make_bulk_queries(slave, function_code, starting_address, len(values), max_quantity, values)
+        await self.execute_many(queries, window)
+        return (starting_address, len(values))
+
+    async def execute_prepared(self, prepared):
+        """Execute a query built by prepare and returns the same result as execute"""
+        async with self._get_async_lock():
+            # connect or reconnect if the connection has been lost
+            await self.open()
+
+            # the request is framed once by the query implementing the MAC part of the protocol
+            (query, request) = prepared.get_request(self)
+            request = query.renew_request(request)
+
+            try:
+                await self._send_request(request)
+                if not prepared.expects_response():
+                    return None
+                response = await self._recv_response(prepared.expected_length)
+            except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, OSError):
+                # a late response would be read by the next query: start again with a new connection
+                await self._do_close()
+                raise
+
+        # extract the pdu part of the response
+        return prepared.parse_response_pdu(query.parse_prepared_response(request, response))
+
+    async def _send_request(self, request):
+        """Send a request to the slave with the hooks of the master"""
+        retval = call_hooks("modbus.Master.before_send", (self, request))
+        if retval is not None:
+            request = retval
+        if self._verbose:
+            LOGGER.debug(get_log_buffer("-> ", request))
+        await self._send(request)
+        call_hooks("modbus.Master.after_send", (self, ))
+
+    async def _recv_response(self, expected_length=-1):
+        """
+        Receive a response from the slave with the hooks of the master
+        asyncio.TimeoutError is raised if the slave doesn't answer before the timeout
+        """
+        if self._timeout:
+            response = await asyncio.wait_for(self._recv(expected_length), self._timeout)
+        else:
+            response = await self._recv(expected_length)
+        retval = call_hooks("modbus.Master.after_recv", (self, response))
+        if retval is not None:
+            response = retval
+        if self._verbose:
+            LOGGER.debug(get_log_buffer("<- ", response))
+        return response
+
+
+class AsyncTcpServer(Server):
+    """
+    This class implements a modbus tcp server running in an asyncio event loop
+    Every connection is served by its own coroutine: the requests are handled as soon as
+    they are received without waiting for the previous responses to be sent
+    start and stop are coroutines
+    """
+
+    def __init__(self, port=502, address='', databank=None, error_on_missing_slave=True):
+        """Constructor: initializes the server settings"""
+        databank = databank if databank else Databank(error_on_missing_slave=error_on_missing_slave)
+        super(AsyncTcpServer, self).__init__(databank)
+        self._sa = (address, port)
+        self._server = None
+        self._writers = set()
+
+    def _make_query(self):
+        """Returns an instance of a Query subclass implementing the modbus TCP protocol"""
+        return TcpQuery()
+
+    def get_address(self):
+        """returns the (address, port) the server is listening on. Useful when port 0 is used"""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        """Start listening. The requests are handled by the running event loop"""
+        self._server = await asyncio.start_server(self._serve_connection, self._sa[0] or None, self._sa[1])
+
+    async def stop(self):
+        """Close the listening socket and every connection"""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        """Start the server if needed and handle the requests until cancelled"""
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def _read_request(self, reader):
+        """returns the next request of the client or None if the client is disconnected"""
+        try:
+            request = await reader.readexactly(6)
+            length = struct.unpack(">HHH", request)[2]
+            if (length < 1) or (length > MAX_MBAP_LENGTH):
+                raise ModbusInvalidRequestError("Invalid length in mbap: {0}".format(length))
+            request += await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+        return bytearray(request)
+
+    async def _serve_connection(self, reader, writer):
+        """handle the requests of a client"""
+        address = writer.get_extra_info("peername")
+        LOGGER.debug("%s is connected", str(address))
+        self._writers.add(writer)
+        call_hooks("modbus_tcp_async.AsyncTcpServer.on_connect", (self, writer, address))
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    LOGGER.debug("%s is disconnected", str(address))
+                    call_hooks("modbus_tcp_async.AsyncTcpServer.on_disconnect", (self, writer))
+                    break
+
+                retval = call_hooks("modbus_tcp_async.AsyncTcpServer.after_recv", (self, writer, request))
+                if retval is not None:
+                    request = retval
+
+                response = ""
+                try:
+                    response = self._handle(request)
+                except Exception as msg:
+                    LOGGER.error("Error while handling a request, Exception occurred: %s", msg)
+
+                if response:
+                    retval = call_hooks("modbus_tcp_async.AsyncTcpServer.before_send", (self, writer, response))
+                    if retval is not None:
+                        response = retval
+                    writer.write(response)
+                    # only waits if the client doesn't read its responses
+                    await writer.drain()
+                    call_hooks("modbus_tcp_async.AsyncTcpServer.after_send", (self, writer, response))
+        except asyncio.CancelledError:
+            raise
+        except Exception as excpt:
+            LOGGER.warning("Error while processing data from %s: %s", str(address), excpt)
+            call_hooks("modbus_tcp_async.AsyncTcpServer.on_error", (self, writer, excpt))
+        finally:
+            self._writers.discard(writer)
+            writer.close()
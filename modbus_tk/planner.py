@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+
+ Coalesce the reads of many tags in as few modbus queries as possible
+"""
+
+from modbus_tk import defines
+from modbus_tk.exceptions import InvalidArgumentError
+
+# the function code reading every block type
+READ_FUNCTIONS = {
+    defines.COILS: defines.READ_COILS,
+    defines.DISCRETE_INPUTS: defines.READ_DISCRETE_INPUTS,
+    defines.HOLDING_REGISTERS: defines.READ_HOLDING_REGISTERS,
+    defines.ANALOG_INPUTS: defines.READ_INPUT_REGISTERS,
+}
+
+
+class ReadPlanner(object):
+    """
+    Build the ReadPlan reading a list of tags: (slave, block_type, address, count)
+    Contiguous or close tags of the same table are read by a single query
+    """
+
+    def __init__(self, max_gap=0, max_registers=defines.MAX_READ_REGISTERS, max_bits=defines.MAX_READ_BITS):
+        """
+        Constructor: max_gap is the number of unused values which can be read for
+        merging 2 tags in the same query.
+        max_registers and max_bits can be decreased for the devices not supporting the maximum
+        """
+        if max_gap < 0:
+            raise InvalidArgumentError("max_gap must be positive: {0}".format(max_gap))
+        if not (0 < max_registers <= defines.MAX_READ_REGISTERS) or not (0 < max_bits <= defines.MAX_READ_BITS):
+            raise InvalidArgumentError(
+                "Invalid limits: {0} registers, {1} bits".format(max_registers, max_bits)
+            )
+        self._max_gap = max_gap
+        self._max_registers = max_registers
+        self._max_bits = max_bits
+        # (slave, block_type) -> list of (starting address, ending address) which must not be read
+        self._forbidden_ranges = {}
+
+    def add_forbidden_range(self, slave, block_type, address, count=1):
+        """The planner will not read these addresses when bridging the gap between 2 tags"""
+        if count < 1:
+            raise InvalidArgumentError("Invalid count of a forbidden range: {0}".format(count))
+        self._forbidden_ranges.setdefault((slave, block_type), []).append((address, address + count))
+
+    def _get_limit(self, block_type):
+        """returns the maximum number of values read by one query"""
+        if block_type in (defines.COILS, defines.DISCRETE_INPUTS):
+            return self._max_bits
+        return self._max_registers
+
+    def _is_forbidden(self, slave, block_type, starting_address, ending_address):
+        """True if one address in [starting_address, ending_address[ must not be read"""
+        for (forbidden_start, forbidden_end) in self._forbidden_ranges.get((slave, block_type), ()):
+            if forbidden_start < ending_address and starting_address < forbidden_end:
+                return True
+        return False
+
+    def plan(self, tags):
+        """
+        returns the ReadPlan reading all the tags
+        Every tag is a tuple (slave, block_type, address) or (slave, block_type, address, count)
+        """
+        tags = [tuple(tag) if len(tag) == 4 else tuple(tag) + (1, ) for tag in tags]
+
+        # group the tags by table
+        tables = {}
+        for (index, (slave, block_type, address, count)) in enumerate(tags):
+            if block_type not in READ_FUNCTIONS:
+                raise InvalidArgumentError("Invalid block type: {0}".format(block_type))
+            if count < 1 or count > self._get_limit(block_type):
+                raise InvalidArgumentError(
+                    "Invalid count of the tag {0}: {1}".format(tags[index], count)
+                )
+            tables.setdefault((slave, block_type), []).append((address, address + count, index))
+
+        requests = []
+        # for every tag: (index of the request, offset of the tag in the response)
+        locations = [None] * len(tags)
+        for (slave, block_type) in sorted(tables):
+            limit = self._get_limit(block_type)
+            ranges = sorted(tables[(slave, block_type)], key=lambda item: (item[0], -item[1]))
+            (starting_address, ending_address) = (None, None)
+            for (address, end, index) in ranges:
+                if starting_address is not None and (
+                    end <= ending_address or (
+                        address <= ending_address + self._max_gap and end - starting_address <= limit
+                        and not self._is_forbidden(slave, block_type, ending_address, address)
+                    )
+                ):
+                    # the tag is merged in the current request
+                    ending_address = max(ending_address, end)
+                else:
+                    if starting_address is not None:
+                        requests.append((slave, block_type, starting_address, ending_address - starting_address))
+                    (starting_address, ending_address) = (address, end)
+                locations[index] = (len(requests), address - starting_address)
+            requests.append((slave, block_type, starting_address, ending_address - starting_address))
+
+        return ReadPlan(requests, tags, locations)
+
+
+class ReadPlan(object):
+    """
+    The queries reading a list of tags. Built by ReadPlanner.plan
+    A plan can be executed many times, for polling the tags
+    """
+
+    def __init__(self, requests, tags, locations):
+        """Constructor: locations is the (request index, offset) of every tag"""
+        self.requests = requests
+        self.tags = tags
+        self._locations = locations
+        # the prepared queries of the last master which executed the plan
+        self._master = None
+        self._queries = None
+
+    def __len__(self):
+        """returns the number of modbus queries"""
+        return len(self.requests)
+
+    def get_queries(self, master):
+        """returns the prepared queries of the plan for this master"""
+        if self._master is not master:
+            self._queries = [
+                master.prepare(slave, READ_FUNCTIONS[block_type], address, count)
+                for (slave, block_type, address, count) in self.requests
+            ]
+            self._master = master
+        return self._queries
+
+    def scatter(self, results):
+        """returns the values of every tag, in the order of the tags, from the results of the requests"""
+        values = []
+        for ((_slave, _block_type, _address, count), (request_index, offset)) in zip(self.tags, self._locations):
+            values.append(tuple(results[request_index][offset:offset + count]))
+        return values
+
+    def execute(self, master, window=None):
+        """
+        Read all the tags with the master and returns the values of every tag in the order of the tags
+        The queries are pipelined if the master supports it (see Master.execute_many)
+        """
+        return self.scatter(master.execute_many(self.get_queries(master), window))
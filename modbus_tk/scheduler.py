@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+
+ Share a serial bus between several threads with priorities
+"""
+
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+import time
+
+from modbus_tk import LOGGER
+from modbus_tk.exceptions import DeadlineExpiredError
+
+# the lower the value, the sooner the query is executed
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+class BusScheduler(object):
+    """
+    Own a master (a RtuMaster for example) and execute the queries submitted by any thread one after
+    the other on its bus. The pending query with the highest priority is executed first, in the
+    order of submission for the same priority
+    Every query returns a concurrent.futures.Future: it can be cancelled until it is executed
+    A query whose deadline expires in the queue fails at its deadline, even if the bus is busy
+    """
+
+    def __init__(self, master, name="", turnaround=0.0, broadcast_turnaround=0.0):
+        """
+        Constructor: name identifies the bus in the logs and the statistics
+        turnaround is the minimum silence in seconds between the end of a query and the start of the next one
+        broadcast_turnaround is the silence after a query without response (a broadcast): the time needed
+        by the slaves for processing it. The longest of both is used
+        The turnaround and the statistics are measured with time.monotonic(): they don't depend on the system clock
+        """
+        self.master = master
+        self.name = name
+        self.turnaround = turnaround
+        self.broadcast_turnaround = broadcast_turnaround
+        self._last_end_time = 0.0
+        # False if the last query was a broadcast
+        self._last_answered = True
+        # the heap of the pending queries: (priority, sequence, deadline, prepared query, future)
+        # the cancelled and expired queries stay in the heap until they are popped
+        self._queue = []
+        # the number of queries in the heap waiting to be executed
+        self._pending = 0
+        # the heap of the deadlines of the pending queries: (deadline, sequence, future)
+        # the timer fails the queries when their deadline expires
+        self._deadlines = []
+        self._deadline_timer = None
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._go = False
+        self._stopped = False
+        # statistics
+        self._start_time = None
+        self._busy_time = 0.0
+        self._executed = 0
+        self._failed = 0
+        self._expired = 0
+        self._cancelled = 0
+
+    def start(self):
+        """start executing the queries"""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._go = True
+            self._stopped = False
+            self._start_time = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="BusScheduler {0}".format(self.name))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        stop executing the queries once the current one is done. The pending queries are cancelled
+        The queries submitted after stop are cancelled
+        """
+        with self._condition:
+            if self._thread is None:
+                return
+            self._go = False
+            self._stopped = True
+            (thread, self._thread) = (self._thread, None)
+            for (_priority, _sequence, _deadline, _prepared, future) in self._queue:
+                future.cancel()
+            self._queue = []
+            self._deadlines = []
+            if self._deadline_timer is not None:
+                self._deadline_timer.cancel()
+                self._deadline_timer = None
+            self._condition.notify()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def submit(self, query, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        Add a query to the queue and returns the Future of its result
+        The query is a PreparedQuery, a tuple or a dict with the arguments of Master.execute
+        If it is not started before deadline (a time.time() value), the future raises DeadlineExpiredError
+        If the scheduler is stopped, the future is cancelled
+        """
+        prepared = self.master._get_prepared_query(query)
+        future = Future()
+        with self._condition:
+            if self._stopped:
+                future.cancel()
+                self._cancelled += 1
+                return future
+            sequence = next(self._sequence)
+            heapq.heappush(self._queue, (priority, sequence, deadline, prepared, future))
+            self._pending += 1
+            future.add_done_callback(self._on_cancelled)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, sequence, future))
+                if self._deadlines[0][2] is future:
+                    self._start_deadline_timer()
+            self._condition.notify()
+        return future
+
+    def execute(self, query, priority=PRIORITY_NORMAL, deadline=None):
+        """Execute a query and returns its result like Master.execute. The calling thread waits for it"""
+        return self.submit(query, priority, deadline).result()
+
+    def get_queue_depth(self):
+        """returns the number of queries waiting to be executed"""
+        with self._condition:
+            return self._pending
+
+    def get_stats(self):
+        """
+        returns the statistics of the bus as a dict: the number of queries executed, failed,
+        expired and cancelled, the queue depth, the busy time and the utilisation of the bus since start
+        """
+        with self._condition:
+            elapsed = time.monotonic() - self._start_time if self._start_time is not None else 0.0
+            return {
+                "executed": self._executed,
+                "failed": self._failed,
+                "expired": self._expired,
+                "cancelled": self._cancelled,
+                "queue_depth": self._pending,
+                "busy_time": self._busy_time,
+                "utilisation": self._busy_time / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def _on_cancelled(self, future):
+        """called when the future of a query is done: the query is not pending anymore if it is cancelled"""
+        if future.cancelled():
+            with self._condition:
+                self._pending -= 1
+                self._cancelled += 1
+
+    def _expire(self, future):
+        """fail a pending query whose deadline has expired. Must be called with the condition"""
+        if future.running() or future.done():
+            # executed or cancelled
+            return
+        if future.set_running_or_notify_cancel():
+            self._pending -= 1
+            self._expired += 1
+            future.set_exception(DeadlineExpiredError(
+                "The deadline of the query on the bus {0} has expired".format(self.name)
+            ))
+
+    def _start_deadline_timer(self):
+        """wait for the earliest deadline. Must be called with the condition"""
+        if self._deadline_timer is not None:
+            self._deadline_timer.cancel()
+            self._deadline_timer = None
+        if self._deadlines:
+            delay = max(self._deadlines[0][0] - time.time(), 0.0)
+            self._deadline_timer = threading.Timer(delay, self._on_deadline)
+            self._deadline_timer.daemon = True
+            self._deadline_timer.start()
+
+    def _on_deadline(self):
+        """called by the timer: fail the queries whose deadline has expired"""
+        with self._condition:
+            if threading.current_thread() is not self._deadline_timer:
+                # replaced by an earlier deadline or stopped
+                return
+            self._deadline_timer = None
+            now = time.time()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                self._expire(heapq.heappop(self._deadlines)[2])
+            self._start_deadline_timer()
+
+    def _next(self):
+        """returns the next query to execute and its future or None when stopped"""
+        with self._condition:
+            while self._go:
+                if self._queue:
+                    (_priority, _sequence, deadline, prepared, future) = heapq.heappop(self._queue)
+                    if future.done():
+                        # cancelled or expired
+                        continue
+                    if deadline is not None and time.time() > deadline:
+                        self._expire(future)
+                    elif future.set_running_or_notify_cancel():
+                        self._pending -= 1
+                        return (prepared, future)
+                else:
+                    self._condition.wait()
+        return None
+
+    def _run(self):
+        """main function of the thread: execute the queries one after the other"""
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            (prepared, future) = item
+            turnaround = self.turnaround if self._last_answered else max(self.turnaround, self.broadcast_turnaround)
+            delay = self._last_end_time + turnaround - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            t0 = time.monotonic()
+            (result, error) = (None, None)
+            try:
+                result = self.master.execute_prepared(prepared)
+            except Exception as excpt:
+                LOGGER.debug("Error on the bus %s: %s", self.name, excpt)
+                error = excpt
+            self._last_end_time = time.monotonic()
+            self._last_answered = prepared.expects_response()
+            # the statistics are up to date when the caller gets the result
+            with self._condition:
+                self._busy_time += self._last_end_time - t0
+                self._executed += 1
+                if error is not None:
+                    self._failed += 1
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
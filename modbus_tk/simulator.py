@@ -11,7 +11,6 @@
  The modbus_tk simulator is a console application which is running a server with TCP and RTU communication
  It is possible to interact with the server from the command line or from a RPC (Remote Process Call)
 """
-from __future__ import print_function
 
 import ctypes
 import os
@@ -27,12 +26,8 @@ from modbus_tk import modbus
 from modbus_tk import modbus_tcp
 from modbus_tk import modbus_rtu
 
-if modbus_tk.utils.PY2:
-    import Queue as queue
-    import SocketServer
-else:
-    import queue
-    import socketserver as SocketServer
+import queue
+import socketserver as SocketServer
 
 
 # add logging capability
@@ -8,7 +8,6 @@
 
  This is distributed under GNU LGPL license, see license.txt
 """
-from __future__ import print_function
 
 import socket
 import modbus_tk.defines
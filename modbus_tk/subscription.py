@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+
+ Notify the changes of the blocks written by the modbus requests
+"""
+
+import asyncio
+import collections
+import queue
+import threading
+
+from modbus_tk import LOGGER
+
+# the values written in a block: address is the address of the first value
+BlockChange = collections.namedtuple("BlockChange", ("slave_id", "block_name", "address", "values"))
+
+
+class Subscription(object):
+    """
+    Receive the BlockChange of the blocks of slaves. Created by Slave.subscribe or Databank.subscribe
+    The changes are passed to the callback if any. Otherwise they are read with get or iterated
+    asynchronously with "async for"
+    If window is not 0, the changes are coalesced during window seconds: every contiguous range
+    of changed values gives one BlockChange with their last values
+    """
+
+    def __init__(self, callback=None, window=0.0, block_names=None, maxsize=0):
+        """
+        Constructor: block_names limits the subscription to these blocks
+        maxsize is the maximum number of changes waiting to be read: the others are dropped and counted
+        It limits the queue of get and the queue of "async for" as well
+        """
+        self._callback = callback
+        self._maxsize = maxsize
+        self._window = window
+        self._block_names = None if block_names is None else frozenset(block_names)
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        # the values changed during the window: {(slave_id, block_name): {address: value}}
+        self._pending = {}
+        self._timer = None
+        # the slaves or databanks notifying the subscription
+        self._sources = []
+        # set when iterated by "async for"
+        self._loop = None
+        self._async_queue = None
+        self.dropped = 0
+
+    def attach(self, source):
+        """receive the changes of a Slave or a Databank"""
+        source._add_subscription(self)
+        self._sources.append(source)
+
+    def close(self):
+        """stop receiving the changes. The coalesced changes are delivered"""
+        for source in self._sources:
+            source._remove_subscription(self)
+        self._sources = []
+        self.flush()
+        with self._lock:
+            if self._loop is not None:
+                # stop the "async for"
+                self._send_to_loop(None)
+
+    def notify(self, slave_id, block_name, address, values):
+        """called by the slave when values are written in a block"""
+        if self._block_names is not None and block_name not in self._block_names:
+            return
+        if not self._window:
+            self._deliver(BlockChange(slave_id, block_name, address, tuple(values)))
+            return
+        with self._lock:
+            pending = self._pending.setdefault((slave_id, block_name), {})
+            for (i, value) in enumerate(values):
+                pending[address + i] = value
+            if self._timer is None:
+                self._timer = threading.Timer(self._window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """deliver the changes coalesced during the window"""
+        with self._lock:
+            (pending, self._pending) = (self._pending, {})
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for ((slave_id, block_name), values) in sorted(pending.items()):
+            addresses = sorted(values)
+            start = 0
+            for i in range(1, len(addresses) + 1):
+                # one change per contiguous range of addresses
+                if i == len(addresses) or addresses[i] != addresses[i - 1] + 1:
+                    self._deliver(BlockChange(
+                        slave_id, block_name, addresses[start],
+                        tuple(values[address] for address in addresses[start:i])
+                    ))
+                    start = i
+
+    def _deliver(self, change):
+        """pass the change to the consumer"""
+        if self._callback is not None:
+            try:
+                self._callback(change)
+            except Exception as excpt:
+                LOGGER.error("Error in the subscription callback: %s", excpt)
+            return
+        with self._lock:
+            if self._loop is not None:
+                if not self._send_to_loop(change):
+                    self.dropped += 1
+                return
+            try:
+                self._queue.put_nowait(change)
+            except queue.Full:
+                self.dropped += 1
+
+    def _send_to_loop(self, change):
+        """
+        pass the change to the "async for" from any thread. Must be called with the lock
+        returns False if the event loop is closed: it is detached and the next changes are read with get
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._put_async, self._async_queue, change)
+        except RuntimeError:
+            # the event loop is closed: nobody iterates the changes anymore
+            self._loop = None
+            self._async_queue = None
+            return False
+        return True
+
+    def _put_async(self, async_queue, change):
+        """called in the event loop: put the change in the queue of the "async for" unless it is full"""
+        try:
+            async_queue.put_nowait(change)
+        except asyncio.QueueFull:
+            with self._lock:
+                self.dropped += 1
+            if change is None:
+                # the end of the iteration is not dropped: the oldest change is
+                async_queue.get_nowait()
+                async_queue.put_nowait(None)
+
+    def get(self, block=True, timeout=None):
+        """returns the next change. Raise queue.Empty if there is no change before the timeout"""
+        return self._queue.get(block, timeout)
+
+    def __aiter__(self):
+        """iterate the changes in the running event loop"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+                self._async_queue = asyncio.Queue(self._maxsize)
+                # the changes received before
+                while not self._queue.empty():
+                    self._async_queue.put_nowait(self._queue.get_nowait())
+        return self
+
+    async def __anext__(self):
+        """returns the next change. The iteration stops when the subscription is closed"""
+        change = await self._async_queue.get()
+        if change is None:
+            raise StopAsyncIteration
+        return change
@@ -8,15 +8,17 @@
 
  This is distributed under GNU LGPL license, see license.txt
 """
-from __future__ import print_function
 
 import sys
 import threading
 import logging
 import socket
 import select
+import weakref
 from modbus_tk import LOGGER
+from modbus_tk import crc
 
+# modbus_tk requires python 3: kept for the applications still testing them
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
 
@@ -44,6 +46,133 @@ def threadsafe_function(fcn):
     return new
 
 
+def threadsafe_method(fcn):
+    """
+    decorator making sure that the decorated method is thread safe
+    The lock is the _lock attribute of the instance: calls on different instances can run in parallel
+    """
+
+    def new(self, *args, **kwargs):
+        """Lock and call the decorated method
+
+           Unless kwargs['threadsafe'] == False
+        """
+        threadsafe = kwargs.pop('threadsafe', True)
+        if threadsafe:
+            self._lock.acquire()
+        try:
+            return fcn(self, *args, **kwargs)
+        finally:
+            if threadsafe:
+                self._lock.release()
+    return new
+
+
+class _LockContext(object):
+    """a context manager calling the acquire and release functions of a lock"""
+
+    def __init__(self, acquire, release):
+        """Constructor"""
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        """acquire the lock"""
+        self._acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """release the lock"""
+        self._release()
+
+
+class ReadWriteLock(object):
+    """
+    A lock which can be hold by several readers or by one writer
+    The writers have the priority: a waiting writer blocks the new readers
+    The lock is reentrant: a reader can read again, a writer can read or write again
+    Use the reader and writer attributes in a with statement
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self._condition = threading.Condition(threading.Lock())
+        # number of acquisitions by every reading thread
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._waiting_writers = 0
+        self.reader = _LockContext(self.acquire_read, self.release_read)
+        self.writer = _LockContext(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        """wait until there is no writer and acquire the lock for reading"""
+        me = threading.current_thread().ident
+        with self._condition:
+            if me not in self._readers and self._writer != me:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        """release the lock acquired for reading"""
+        me = threading.current_thread().ident
+        with self._condition:
+            count = self._readers.pop(me) - 1
+            if count:
+                self._readers[me] = count
+            elif not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        """wait until there is no other reader or writer and acquire the lock for writing"""
+        me = threading.current_thread().ident
+        with self._condition:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("A reader can not acquire the lock for writing")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def release_write(self):
+        """release the lock acquired for writing"""
+        with self._condition:
+            self._writer_count -= 1
+            if not self._writer_count:
+                self._writer = None
+                self._condition.notify_all()
+
+
+_SHARED_LOCKS = weakref.WeakKeyDictionary()
+_SHARED_LOCKS_GUARD = threading.Lock()
+
+
+def get_shared_lock(resource):
+    """
+    returns the lock associated to the given resource (a serial port for example)
+    All the objects sharing a resource get the same lock
+    """
+    with _SHARED_LOCKS_GUARD:
+        try:
+            return _SHARED_LOCKS[resource]
+        except KeyError:
+            lock = threading.RLock()
+            try:
+                _SHARED_LOCKS[resource] = lock
+            except TypeError:
+                # the resource can not be weakly referenced: the lock can't be shared
+                pass
+            return lock
+
+
 def flush_socket(socks, lim=0):
     """remove the data present on the socket"""
     input_socks = [socks]
@@ -65,7 +194,7 @@ def get_log_buffer(prefix, buff):
     """Format binary data into a string for debug purpose"""
     log = prefix
     for i in buff:
-        log += str(ord(i) if PY2 else i) + "-"
+        log += str(i) + "-"
     return log[:-1]
 
 
@@ -92,9 +221,7 @@ class LogitHandler(logging.Handler):
 
     def emit(self, record):
         """format and send the record over udp"""
-        data = self.format(record) + "\r\n"
-        if PY3:
-            data = to_data(data)
+        data = to_data(self.format(record) + "\r\n")
         self._sock.sendto(data, self._dest)
 
 
@@ -138,50 +265,45 @@ def swap_bytes(word_val):
     return (lsb << 8) + msb
 
 
+# the 8 bits of every byte value, least significant bit first
+_BYTE_TO_BITS = tuple(bytes((value >> bit) & 1 for bit in range(8)) for value in range(256))
+# the binary digits of the bits
+_BITS_TO_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def pack_bits(values):
+    """
+    returns the bytes of a list of bits as they are sent in modbus: the first bit is the
+    least significant bit of the first byte. A value is 1 if it is greater than 0
+    """
+    return _pack_flags(bytes([value > 0 for value in values]))
+
+
+def pack_true_bits(values):
+    """same as pack_bits but a value is 1 if it is true: used for the values of the blocks of a slave"""
+    return _pack_flags(bytes(map(bool, values)))
+
+
+def _pack_flags(flags):
+    """returns the bits given as bytes of 0 and 1 packed as they are sent in modbus"""
+    if not flags:
+        return b""
+    # the binary representation of the integer with the last bit first
+    digits = flags[::-1].translate(_BITS_TO_DIGITS)
+    return int(digits, 2).to_bytes((len(flags) + 7) // 8, "little")
+
+
+def unpack_bits(data, nb_of_bits=None):
+    """returns the bits packed in data (see pack_bits) as bytes of 0 and 1"""
+    bits = b"".join(map(_BYTE_TO_BITS.__getitem__, data))
+    if nb_of_bits is None:
+        return bits
+    return bits[:nb_of_bits]
+
+
 def calculate_crc(data):
-    """Calculate the CRC16 of a datagram"""
-    CRC16table = (
-        0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
-        0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481, 0x0440,
-        0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81, 0x0E40,
-        0x0A00, 0xCAC1, 0xCB81, 0x0B40, 0xC901, 0x09C0, 0x0880, 0xC841,
-        0xD801, 0x18C0, 0x1980, 0xD941, 0x1B00, 0xDBC1, 0xDA81, 0x1A40,
-        0x1E00, 0xDEC1, 0xDF81, 0x1F40, 0xDD01, 0x1DC0, 0x1C80, 0xDC41,
-        0x1400, 0xD4C1, 0xD581, 0x1540, 0xD701, 0x17C0, 0x1680, 0xD641,
-        0xD201, 0x12C0, 0x1380, 0xD341, 0x1100, 0xD1C1, 0xD081, 0x1040,
-        0xF001, 0x30C0, 0x3180, 0xF141, 0x3300, 0xF3C1, 0xF281, 0x3240,
-        0x3600, 0xF6C1, 0xF781, 0x3740, 0xF501, 0x35C0, 0x3480, 0xF441,
-        0x3C00, 0xFCC1, 0xFD81, 0x3D40, 0xFF01, 0x3FC0, 0x3E80, 0xFE41,
-        0xFA01, 0x3AC0, 0x3B80, 0xFB41, 0x3900, 0xF9C1, 0xF881, 0x3840,
-        0x2800, 0xE8C1, 0xE981, 0x2940, 0xEB01, 0x2BC0, 0x2A80, 0xEA41,
-        0xEE01, 0x2EC0, 0x2F80, 0xEF41, 0x2D00, 0xEDC1, 0xEC81, 0x2C40,
-        0xE401, 0x24C0, 0x2580, 0xE541, 0x2700, 0xE7C1, 0xE681, 0x2640,
-        0x2200, 0xE2C1, 0xE381, 0x2340, 0xE101, 0x21C0, 0x2080, 0xE041,
-        0xA001, 0x60C0, 0x6180, 0xA141, 0x6300, 0xA3C1, 0xA281, 0x6240,
-        0x6600, 0xA6C1, 0xA781, 0x6740, 0xA501, 0x65C0, 0x6480, 0xA441,
-        0x6C00, 0xACC1, 0xAD81, 0x6D40, 0xAF01, 0x6FC0, 0x6E80, 0xAE41,
-        0xAA01, 0x6AC0, 0x6B80, 0xAB41, 0x6900, 0xA9C1, 0xA881, 0x6840,
-        0x7800, 0xB8C1, 0xB981, 0x7940, 0xBB01, 0x7BC0, 0x7A80, 0xBA41,
-        0xBE01, 0x7EC0, 0x7F80, 0xBF41, 0x7D00, 0xBDC1, 0xBC81, 0x7C40,
-        0xB401, 0x74C0, 0x7580, 0xB541, 0x7700, 0xB7C1, 0xB681, 0x7640,
-        0x7200, 0xB2C1, 0xB381, 0x7340, 0xB101, 0x71C0, 0x7080, 0xB041,
-        0x5000, 0x90C1, 0x9181, 0x5140, 0x9301, 0x53C0, 0x5280, 0x9241,
-        0x9601, 0x56C0, 0x5780, 0x9741, 0x5500, 0x95C1, 0x9481, 0x5440,
-        0x9C01, 0x5CC0, 0x5D80, 0x9D41, 0x5F00, 0x9FC1, 0x9E81, 0x5E40,
-        0x5A00, 0x9AC1, 0x9B81, 0x5B40, 0x9901, 0x59C0, 0x5880, 0x9841,
-        0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81, 0x4A40,
-        0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80, 0x8C41,
-        0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
-        0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040
-    )
-    crc = 0xFFFF
-    if PY2:
-        for c in data:
-            crc = (crc >> 8) ^ CRC16table[(ord(c) ^ crc) & 0xFF]
-    else:
-        for c in data:
-            crc = (crc >> 8) ^ CRC16table[((c) ^ crc) & 0xFF]
-    return swap_bytes(crc)
+    """Calculate the CRC16 of a datagram (see the crc module)"""
+    return crc.calculate(data)
 
 
 def calculate_rtu_inter_char(baudrate):
@@ -231,7 +353,4 @@ class WorkerThread(object):
 
 
 def to_data(string_data):
-    if PY2:
-        return string_data
-    else:
-        return bytearray(string_data, 'ascii')
+    return bytearray(string_data, 'ascii')
@@ -40,6 +40,7 @@ setup(
     license='LGPL-2.1-or-later',
     packages=['modbus_tk'],
     platforms=["Linux", "Mac OS X", "Win"],
+    python_requires='>=3',
     install_requires=[
         'pyserial>=3.1',
     ],
@@ -10,6 +10,7 @@
 """
 
 import os
+import queue
 import time
 import serial
 import struct
@@ -20,11 +21,6 @@ import unittest
 import modbus_tk
 from modbus_tk import modbus_rtu, hooks, utils
 
-if utils.PY2:
-    import Queue as queue
-elif utils.PY3:
-    import queue
-
 from functest_modbus import TestQueries, TestQueriesSetupAndTeardown, SharedDataTest
 
 
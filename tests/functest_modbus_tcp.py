@@ -9,6 +9,7 @@
  This is distributed under GNU LGPL license, see license.txt
 """
 
+import queue
 import socket
 import struct
 import sys
@@ -18,12 +19,6 @@ import unittest
 
 import modbus_tk
 import modbus_tk.modbus_tcp as modbus_tcp
-import modbus_tk.utils as utils
-
-if utils.PY2:
-    import Queue as queue
-elif utils.PY3:
-    import queue
 
 from functest_modbus import TestQueries, TestQueriesSetupAndTeardown, SharedDataTest
 
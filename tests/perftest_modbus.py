@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+import struct
+import sys
+import time
+import tracemalloc
+import unittest
+
+import modbus_tk
+import modbus_tk.defines as cst
+import modbus_tk.modbus
+
+LOGGER = modbus_tk.utils.create_logger()
+
+
+class TestCompactBlocks(unittest.TestCase):
+    """Check the memory and the speed of the blocks stored in arrays"""
+
+    def _get_memory(self, compact):
+        """returns the memory used by a slave with a full map of registers"""
+        tracemalloc.start()
+        try:
+            slave = modbus_tk.modbus.Slave(1, compact=compact)
+            slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 65536)
+            slave.add_block("ir", cst.ANALOG_INPUTS, 0, 65536)
+            slave.set_values("hr", 0, list(range(65536)))
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    def _read(self, slave, nb_of_loops):
+        """returns the duration of reading 125 registers nb_of_loops times"""
+        request = struct.pack(">BHH", cst.READ_HOLDING_REGISTERS, 1000, 125)
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            response = slave.handle_request(request)
+        duration = time.time() - t0
+        self.assertEqual(struct.pack(">BB125H", 3, 250, *range(1000, 1125)), response)
+        return duration
+
+    def testMemory(self):
+        """a compact slave must use much less memory"""
+        reference = self._get_memory(False)
+        memory = self._get_memory(True)
+        LOGGER.info("compact: %d bytes instead of %d bytes", memory, reference)
+        self.assertTrue(memory * 3 < reference)
+
+    def testReadRegisters(self):
+        """reading a compact block must not be slower"""
+        durations = []
+        for compact in (False, True):
+            slave = modbus_tk.modbus.Slave(1, compact=compact)
+            slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 65536)
+            slave.set_values("hr", 0, list(range(65536)))
+            durations.append(self._read(slave, 2000))
+        LOGGER.info("compact: %.3f s instead of %.3f s", durations[1], durations[0])
+        self.assertTrue(durations[1] < durations[0] * 1.5)
+
+    def testCoils(self):
+        """reading and writing 2000 packed coils must be faster than with a list"""
+        read_request = struct.pack(">BHH", cst.READ_COILS, 0, 2000)
+        write_request = struct.pack(">BHHB", cst.WRITE_MULTIPLE_COILS, 0, 1968, 246) + b"\x5a" * 246
+        durations = []
+        for compact in (False, True):
+            slave = modbus_tk.modbus.Slave(1, compact=compact)
+            slave.add_block("c", cst.COILS, 0, 2000)
+            t0 = time.time()
+            for _i in range(200):
+                slave.handle_request(write_request)
+                response = slave.handle_request(read_request)
+            durations.append(time.time() - t0)
+            self.assertEqual(struct.pack(">BB", 1, 250) + b"\x5a" * 246 + b"\x00" * 4, response)
+        LOGGER.info("packed coils: %.3f s instead of %.3f s", durations[1], durations[0])
+        self.assertTrue(durations[1] < durations[0])
+
+    def testRegistersEncoding(self):
+        """encoding 125 registers at once must be faster than register by register"""
+        slave = modbus_tk.modbus.Slave(1)
+        values = list(range(1000, 1125))
+        nb_of_loops = 5000
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            reference = struct.pack(">B", 250)
+            for reg in values:
+                reference += struct.pack(">H", reg)
+        reference_duration = time.time() - t0
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            response = slave._pack_registers(values)
+        duration = time.time() - t0
+
+        self.assertEqual(reference, response)
+        LOGGER.info("encoding: %.3f s instead of %.3f s", duration, reference_duration)
+        self.assertTrue(duration * 5 < reference_duration)
+
+
+class TestHooks(unittest.TestCase):
+    """Check the cost of the hooks on the requests"""
+
+    def testOverheadPerRequest(self):
+        """the hooks must cost much less than the request when no hook is installed"""
+        slave = modbus_tk.modbus.Slave(1)
+        slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 100)
+        request = struct.pack(">BHH", cst.WRITE_SINGLE_REGISTER, 10, 5)
+        nb_of_loops = 20000
+
+        # count the hooks called by one request
+        names = []
+        original_call_hooks = modbus_tk.modbus.call_hooks
+        modbus_tk.modbus.call_hooks = lambda name, args: names.append(name)
+        try:
+            slave.handle_request(request)
+        finally:
+            modbus_tk.modbus.call_hooks = original_call_hooks
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            slave.handle_request(request)
+        request_duration = (time.time() - t0) / nb_of_loops
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            for name in names:
+                modbus_tk.hooks.call_hooks(name, (slave, request))
+        hooks_duration = (time.time() - t0) / nb_of_loops
+
+        LOGGER.info(
+            "%d hooks per request: %.2f us for a request of %.2f us",
+            len(names), hooks_duration * 1e6, request_duration * 1e6
+        )
+        self.assertTrue(hooks_duration < request_duration * 0.25)
+
+
+class TestManyBlocks(unittest.TestCase):
+    """Check the cost of the requests on a slave with many small blocks"""
+
+    nb_of_blocks = 1000
+
+    def testLookupDoesNotDependOnBlocks(self):
+        """the duration of a request must not grow with the number of blocks"""
+        durations = []
+        for nb_of_blocks in (10, self.nb_of_blocks):
+            slave = modbus_tk.modbus.Slave(1)
+            t0 = time.time()
+            # add the blocks in reverse order: every block is inserted before the others
+            for i in reversed(range(nb_of_blocks)):
+                slave.add_block(str(i), cst.HOLDING_REGISTERS, i * 10, 5)
+            LOGGER.info("%d blocks added in %.3f s", nb_of_blocks, time.time() - t0)
+
+            requests = [struct.pack(">BHH", cst.READ_HOLDING_REGISTERS, i * 10, 5) for i in range(nb_of_blocks)]
+            t0 = time.time()
+            for _i in range(20000 // nb_of_blocks):
+                for request in requests:
+                    response = slave.handle_request(request)
+            durations.append(time.time() - t0)
+            self.assertEqual(struct.pack(">BB5H", 3, 10, 0, 0, 0, 0, 0), response)
+        LOGGER.info("20000 requests: %.3f s with %d blocks instead of %.3f s", durations[1], self.nb_of_blocks, durations[0])
+        self.assertTrue(durations[1] < durations[0] * 2)
+
+    def testAddBlocksIsNotQuadratic(self):
+        """adding 10 times more blocks must not take much more than 10 times longer"""
+        durations = []
+        for nb_of_blocks in (2000, 20000):
+            slave = modbus_tk.modbus.Slave(1)
+            t0 = time.time()
+            for i in reversed(range(nb_of_blocks)):
+                slave.add_block(str(i), cst.HOLDING_REGISTERS, i * 2, 1)
+            durations.append(time.time() - t0)
+        LOGGER.info("20000 blocks added in %.3f s, 2000 blocks in %.3f s", durations[1], durations[0])
+        self.assertTrue(durations[1] < durations[0] * 30)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv)
@@ -12,18 +12,16 @@
 import unittest
 import modbus_tk
 import modbus_tk.modbus_tcp as modbus_tcp
+from modbus_tk.modbus_tcp_async import AsyncTcpMaster
 import threading
+import asyncio
 import struct
 import logging
 import socket
-import modbus_tk.utils as utils
 import time
 import sys
-
-if utils.PY2:
-    import Queue as queue
-elif utils.PY3:
-    import queue
+import queue
+from modbus_tk.utils import to_data
 
 LOGGER = modbus_tk.utils.create_logger()
 
@@ -94,5 +92,324 @@ class TestStress(unittest.TestCase):
         LOGGER.debug("all threads have done")
         self.assert_(q.empty())
                        
+
+def slow_slave(server_sock, latency, nb_of_requests):
+    """A fake slave answering to read holding registers queries after a given latency"""
+    sock = server_sock.accept()[0]
+    try:
+        for i in range(nb_of_requests):
+            request = to_data("")
+            while len(request) < 12:
+                request += sock.recv(12 - len(request))
+            (transaction_id, quantity) = struct.unpack(">H", request[:2])[0], struct.unpack(">H", request[10:12])[0]
+            time.sleep(latency)
+            pdu = struct.pack(">BB", 3, 2 * quantity) + struct.pack(">" + quantity * "H", *range(quantity))
+            sock.send(struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, 1) + pdu)
+    finally:
+        sock.close()
+
+
+class TestParallelMasters(unittest.TestCase):
+    """Check that masters connected to different slaves don't block each other"""
+
+    def _run_masters(self, nb_of_masters, nb_of_requests, latency):
+        """query slow slaves from several threads and returns the duration"""
+        server_socks, slaves, masters = [], [], []
+        for i in range(nb_of_masters):
+            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_sock.bind(("127.0.0.1", 0))
+            server_sock.listen(1)
+            server_socks.append(server_sock)
+            slaves.append(threading.Thread(target=slow_slave, args=(server_sock, latency, nb_of_requests)))
+            masters.append(modbus_tcp.TcpMaster(port=server_sock.getsockname()[1]))
+        for slave in slaves:
+            slave.start()
+
+        def poll(master):
+            for i in range(nb_of_requests):
+                master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 10)
+
+        threads = [threading.Thread(target=poll, args=(master, )) for master in masters]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - t0
+
+        for master in masters:
+            master.close()
+        for slave in slaves:
+            slave.join()
+        for server_sock in server_socks:
+            server_sock.close()
+        return duration
+
+    def testScaling(self):
+        """check that the throughput grows almost linearly with the number of masters"""
+        latency, nb_of_requests = 0.02, 20
+        reference = self._run_masters(1, nb_of_requests, latency)
+        for nb_of_masters in (2, 8, 32):
+            duration = self._run_masters(nb_of_masters, nb_of_requests, latency)
+            speedup = nb_of_masters * reference / duration
+            LOGGER.info("%d masters: %.3f s (speed-up x%.1f)", nb_of_masters, duration, speedup)
+            self.assertTrue(speedup > nb_of_masters * 0.5)
+
+
+class TestAsyncMaster(unittest.TestCase):
+    """Compare the asyncio master with threaded masters"""
+
+    nb_of_slaves = 100
+    nb_of_requests = 10
+    latency = 0.01
+
+    def _start_slaves(self):
+        """start slow slaves and returns their ports"""
+        self.server_socks, self.slaves = [], []
+        for i in range(self.nb_of_slaves):
+            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_sock.bind(("127.0.0.1", 0))
+            server_sock.listen(1)
+            self.server_socks.append(server_sock)
+            self.slaves.append(
+                threading.Thread(target=slow_slave, args=(server_sock, self.latency, self.nb_of_requests))
+            )
+        for slave in self.slaves:
+            slave.start()
+        return [server_sock.getsockname()[1] for server_sock in self.server_socks]
+
+    def _stop_slaves(self):
+        for slave in self.slaves:
+            slave.join()
+        for server_sock in self.server_socks:
+            server_sock.close()
+
+    def _run_threads(self):
+        masters = [modbus_tcp.TcpMaster(port=port) for port in self._start_slaves()]
+
+        def poll(master):
+            for i in range(self.nb_of_requests):
+                master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 10)
+
+        threads = [threading.Thread(target=poll, args=(master, )) for master in masters]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - t0
+        for master in masters:
+            master.close()
+        self._stop_slaves()
+        return duration
+
+    def _run_asyncio(self):
+        masters = [AsyncTcpMaster(port=port) for port in self._start_slaves()]
+
+        async def poll(master):
+            for i in range(self.nb_of_requests):
+                result = await master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 10)
+                self.assertEqual(tuple(range(10)), result)
+            await master.close()
+
+        async def poll_all():
+            await asyncio.gather(*[poll(master) for master in masters])
+
+        t0 = time.time()
+        asyncio.run(poll_all())
+        duration = time.time() - t0
+        self._stop_slaves()
+        return duration
+
+    def testAsyncioVsThreads(self):
+        """poll slow slaves from one event loop and from one thread per slave"""
+        threads_duration = self._run_threads()
+        asyncio_duration = self._run_asyncio()
+        LOGGER.info(
+            "%d slaves x %d requests: threads %.3f s - asyncio %.3f s",
+            self.nb_of_slaves, self.nb_of_requests, threads_duration, asyncio_duration
+        )
+        # the event loop must keep all the slaves busy in parallel
+        sequential_duration = self.nb_of_slaves * self.nb_of_requests * self.latency
+        self.assertTrue(asyncio_duration < sequential_duration / 10)
+
+
+def remote_slave(server_sock, latency, nb_of_requests):
+    """A fake slave behind a high latency link: every response is delayed but several queries can be in flight"""
+    sock = server_sock.accept()[0]
+    lock = threading.Lock()
+    timers = []
+
+    def answer(transaction_id, quantity):
+        pdu = struct.pack(">BB", 3, 2 * quantity) + struct.pack(">" + quantity * "H", *range(quantity))
+        with lock:
+            sock.sendall(struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, 1) + pdu)
+
+    try:
+        for i in range(nb_of_requests):
+            request = to_data("")
+            while len(request) < 12:
+                request += sock.recv(12 - len(request))
+            (transaction_id, quantity) = struct.unpack(">H", request[:2])[0], struct.unpack(">H", request[10:12])[0]
+            timer = threading.Timer(latency, answer, args=(transaction_id, quantity))
+            timer.start()
+            timers.append(timer)
+        for timer in timers:
+            timer.join()
+    finally:
+        sock.close()
+
+
+class TestPipelining(unittest.TestCase):
+    """Check the throughput of pipelined queries on a high latency link"""
+
+    def _run(self, nb_of_requests, latency, window):
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind(("127.0.0.1", 0))
+        server_sock.listen(1)
+        slave = threading.Thread(target=remote_slave, args=(server_sock, latency, nb_of_requests))
+        slave.start()
+        master = modbus_tcp.TcpMaster(port=server_sock.getsockname()[1])
+        try:
+            queries = [(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 10)] * nb_of_requests
+            t0 = time.time()
+            results = master.execute_many(queries, window=window)
+            duration = time.time() - t0
+            self.assertEqual([tuple(range(10))] * nb_of_requests, results)
+        finally:
+            master.close()
+            slave.join()
+            server_sock.close()
+        return duration
+
+    def testWindow(self):
+        """the throughput must grow with the window"""
+        nb_of_requests, latency = 64, 0.02
+        reference = self._run(nb_of_requests, latency, 1)
+        for window in (4, 16):
+            duration = self._run(nb_of_requests, latency, window)
+            LOGGER.info("window %d: %.3f s instead of %.3f s", window, duration, reference)
+            self.assertTrue(duration < reference * 2.0 / window)
+
+
+class TestPreparedQueries(unittest.TestCase):
+    """Check the cost of building and decoding queries which are prepared once"""
+
+    def testPreparedIsFaster(self):
+        """decoding with a prepared query must be faster than with execute"""
+        master = modbus_tcp.TcpMaster()
+        nb_of_loops = 5000
+        response_pdu = struct.pack(">BB125H", modbus_tk.defines.READ_HOLDING_REGISTERS, 250, *range(125))
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            (pdu, data_format, expected_length, is_read_function, nb_of_digits) = master._make_request_pdu(
+                modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 125
+            )
+            master._parse_response_pdu(
+                modbus_tk.defines.READ_HOLDING_REGISTERS, response_pdu, data_format, is_read_function,
+                nb_of_digits
+            )
+        reference = time.time() - t0
+
+        prepared = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 125)
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            values = prepared.parse_response_pdu(response_pdu)
+        duration = time.time() - t0
+
+        self.assertEqual(tuple(range(125)), values)
+        LOGGER.info("prepared: %.3f s instead of %.3f s", duration, reference)
+        self.assertTrue(duration < reference)
+
+    def testExecutePreparedIsFaster(self):
+        """a full execution of a prepared query must be faster than execute"""
+        response_pdu = struct.pack(">BB125H", modbus_tk.defines.READ_HOLDING_REGISTERS, 250, *range(125))
+        master = LoopbackTcpMaster(response_pdu)
+        nb_of_loops = 5000
+
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 125)
+        reference = time.time() - t0
+
+        prepared = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 125)
+        t0 = time.time()
+        for _i in range(nb_of_loops):
+            values = master.execute_prepared(prepared)
+        duration = time.time() - t0
+
+        self.assertEqual(tuple(range(125)), values)
+        LOGGER.info("execute_prepared: %.3f s instead of %.3f s", duration, reference)
+        self.assertTrue(duration < reference)
+
+
+class LoopbackTcpMaster(modbus_tcp.TcpMaster):
+    """A TcpMaster answering its requests itself: measures the cost of the library without the network"""
+
+    def __init__(self, response_pdu):
+        super(LoopbackTcpMaster, self).__init__()
+        self._response_pdu = response_pdu
+        self._request = None
+
+    def _do_open(self):
+        pass
+
+    def _do_close(self):
+        return True
+
+    def _send(self, request):
+        self._request = request
+
+    def _recv(self, expected_length=-1):
+        mbap = self._request[:4] + struct.pack(">HB", len(self._response_pdu) + 1, self._request[6])
+        return mbap + self._response_pdu
+
+
+class TestManyConnections(unittest.TestCase):
+    """Check that the server can handle more connections than select() allows"""
+
+    nb_of_clients = 2000
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        slave = self.server.add_slave(1)
+        slave.add_block("a", modbus_tk.defines.HOLDING_REGISTERS, 0, 100)
+        slave.set_values("a", 0, list(range(100)))
+        self.server.start()
+        time.sleep(0.2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testThousandsOfClients(self):
+        """connect a lot of clients and check that every one gets its response"""
+        port = self.server._sock.getsockname()[1]
+        clients = []
+        try:
+            for i in range(self.nb_of_clients):
+                clients.append(socket.create_connection(("127.0.0.1", port)))
+            t0 = time.time()
+            for (i, client) in enumerate(clients):
+                client.send(struct.pack(">HHHBBHH", i, 0, 6, 1, 3, i % 100, 1))
+            for (i, client) in enumerate(clients):
+                client.settimeout(5.0)
+                response = to_data("")
+                while len(response) < 11:
+                    response += client.recv(11 - len(response))
+                self.assertEqual(struct.pack(">HHHBBBH", i, 0, 5, 1, 3, 2, i % 100), response)
+            LOGGER.info("%d clients served in %.3f s", len(clients), time.time() - t0)
+        finally:
+            for client in clients:
+                client.close()
+
+        t0 = time.time()
+        self.server.stop()
+        self.assertTrue(time.time() - t0 < 0.5)
+
+
 if __name__ == '__main__':
     unittest.main(argv = sys.argv)
@@ -9,18 +9,231 @@
  This is distributed under GNU LGPL license, see license.txt
 """
 
+import asyncio
 import unittest
 import modbus_tk.modbus
 import threading
 import struct
 import logging
+import queue
 import time
 import sys
-from modbus_tk.hooks import install_hook
+from modbus_tk.hooks import install_hook, uninstall_hook
 
 LOGGER = modbus_tk.utils.create_logger("udp")
 
 
+class TestBits(unittest.TestCase):
+    """check the packing of bits in bytes"""
+
+    def testPackBits(self):
+        """the first bit is the least significant bit of the first byte"""
+        self.assertEqual(b"", modbus_tk.utils.pack_bits([]))
+        self.assertEqual(b"\x01", modbus_tk.utils.pack_bits([1]))
+        self.assertEqual(b"\x0d", modbus_tk.utils.pack_bits((1, 0, 1, 1, 0)))
+        self.assertEqual(b"\xaa\x02", modbus_tk.utils.pack_bits([0, 1] * 5))
+        self.assertEqual(b"\xff" * 250, modbus_tk.utils.pack_bits([True, 2, 1, 1] * 500))
+        # as in the previous versions, only the values greater than 0 are 1
+        self.assertEqual(b"\x05", modbus_tk.utils.pack_bits([1, -1, 2, 0]))
+        # but the slave returns 1 for any true value
+        self.assertEqual(b"\x07", modbus_tk.utils.pack_true_bits([1, -1, 2, 0]))
+
+    def testUnpackBits(self):
+        """the bits are returned in the order of pack_bits"""
+        self.assertEqual(b"\x01\x00\x01\x01\x00\x00\x00\x00", modbus_tk.utils.unpack_bits(b"\x0d"))
+        self.assertEqual(b"\x00\x01" * 5, modbus_tk.utils.unpack_bits(b"\xaa\x02", 10))
+        values = [(i * 7) % 3 & 1 for i in range(1999)]
+        self.assertEqual(values, list(modbus_tk.utils.unpack_bits(modbus_tk.utils.pack_bits(values), 1999)))
+
+
+class TestReadWriteLock(unittest.TestCase):
+    """check the lock shared by readers"""
+
+    def setUp(self):
+        self.lock = modbus_tk.utils.ReadWriteLock()
+
+    def _try_in_thread(self, context, timeout=0.2):
+        """returns True if another thread can enter the context before the timeout"""
+        entered = threading.Event()
+
+        def enter():
+            with context:
+                entered.set()
+        thread = threading.Thread(target=enter)
+        thread.daemon = True
+        thread.start()
+        result = entered.wait(timeout)
+        return result, thread
+
+    def testConcurrentReaders(self):
+        """several threads can read at the same time"""
+        with self.lock.reader:
+            (entered, thread) = self._try_in_thread(self.lock.reader)
+            self.assertTrue(entered)
+        thread.join()
+
+    def testWriterIsExclusive(self):
+        """a writer waits for the readers and blocks the readers"""
+        with self.lock.reader:
+            (entered, thread) = self._try_in_thread(self.lock.writer)
+            self.assertFalse(entered)
+            # the waiting writer has the priority on the new readers
+            (reader_entered, reader) = self._try_in_thread(self.lock.reader)
+            self.assertFalse(reader_entered)
+        thread.join(1.0)
+        reader.join(1.0)
+        self.assertFalse(thread.is_alive() or reader.is_alive())
+        with self.lock.writer:
+            (entered, thread) = self._try_in_thread(self.lock.reader)
+            self.assertFalse(entered)
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+
+    def testReentrant(self):
+        """a reader can read again and a writer can read or write again"""
+        with self.lock.writer:
+            with self.lock.writer:
+                with self.lock.reader:
+                    pass
+        with self.lock.reader:
+            with self.lock.reader:
+                self.assertRaises(RuntimeError, self.lock.acquire_write)
+        (entered, thread) = self._try_in_thread(self.lock.writer)
+        self.assertTrue(entered)
+        thread.join()
+
+
+class TestHooks(unittest.TestCase):
+    """check the installation and the call of the hooks"""
+
+    name = "unittest_modbus.TestHooks.hook"
+
+    def tearDown(self):
+        uninstall_hook(self.name)
+
+    def testCallHooks(self):
+        """the hooks are called in order until one returns a value"""
+        calls = []
+        install_hook(self.name, lambda args: calls.append(("a", args)))
+        install_hook(self.name, lambda args: 5)
+        install_hook(self.name, lambda args: calls.append(("c", args)))
+        self.assertEqual(5, modbus_tk.hooks.call_hooks(self.name, (1, )))
+        self.assertEqual([("a", (1, ))], calls)
+        self.assertEqual(None, modbus_tk.hooks.call_hooks(self.name + "_", (1, )))
+
+    def testUninstall(self):
+        """a function can be removed from the hooks"""
+        def hook(args):
+            return 1
+        install_hook(self.name, hook)
+        uninstall_hook(self.name, hook)
+        self.assertEqual(None, modbus_tk.hooks.call_hooks(self.name, ()))
+        self.assertRaises(ValueError, uninstall_hook, self.name, hook)
+
+    def testInstanceHooks(self):
+        """a hook installed for an instance is not called for the others"""
+        slaves = [modbus_tk.modbus.Slave(i) for i in range(3)]
+        calls = []
+        install_hook(self.name, lambda args: calls.append(("global", args[0])))
+        install_hook(self.name, lambda args: calls.append(("own", args[0])), instance=slaves[1])
+        for slave in slaves:
+            modbus_tk.hooks.call_hooks(self.name, (slave, ))
+        self.assertEqual(
+            [("global", slaves[0]), ("global", slaves[1]), ("own", slaves[1]), ("global", slaves[2])], calls
+        )
+        # the own hooks of an instance are kept when the global hooks are changed
+        del calls[:]
+        uninstall_hook(self.name)
+        for slave in slaves:
+            modbus_tk.hooks.call_hooks(self.name, (slave, ))
+        self.assertEqual([("own", slaves[1])], calls)
+        uninstall_hook(self.name, instance=slaves[1])
+        self.assertEqual(None, modbus_tk.hooks.call_hooks(self.name, (slaves[1], )))
+        # the instances without own hooks use the global hooks
+        self.assertEqual([None] * 3, [slave._hooks for slave in slaves])
+
+    def testBlockHook(self):
+        """a hook can be installed for one block of a slave"""
+        slave = modbus_tk.modbus.Slave(1)
+        slave.add_block("a", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        slave.add_block("b", modbus_tk.defines.HOLDING_REGISTERS, 10, 10)
+        calls = []
+        install_hook("modbus.ModbusBlock.setitem", lambda args: calls.append(args[1:]), instance=slave._get_block("b"))
+        slave.set_values("a", 0, 1)
+        slave.set_values("b", 12, [2, 3])
+        self.assertEqual([(slice(2, 4), [2, 3])], calls)
+
+    def testSetItemHookCanChangeBlocks(self):
+        """the setitem hook is called without the locks of the slave: it can add a block"""
+        slave = modbus_tk.modbus.Slave(1)
+        slave.add_block("a", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+
+        def add_block(args):
+            (block, item, value) = args
+            slave.add_block("b" + str(value), modbus_tk.defines.HOLDING_REGISTERS, 10 * value, 10)
+        install_hook("modbus.ModbusBlock.setitem", add_block, instance=slave._get_block("a"))
+        slave.set_values("a", 0, 1)
+        slave.handle_request(struct.pack(">BHH", 6, 1, 2))
+        self.assertEqual((1, 2), slave.get_values("a", 0, 2))
+        self.assertEqual([(0, ), (0, )], [slave.get_values("b1", 10), slave.get_values("b2", 20)])
+
+    def testAsyncHook(self):
+        """an async hook is called by another thread and can be uninstalled"""
+        calls = []
+
+        def observer(args):
+            calls.append((args, threading.current_thread()))
+            return "ignored"
+        executor = modbus_tk.hooks.HookExecutor()
+        modbus_tk.hooks.install_async_hook(self.name, observer, executor=executor)
+        self.assertEqual(None, modbus_tk.hooks.call_hooks(self.name, (1, )))
+        executor.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual((1, ), calls[0][0])
+        self.assertNotEqual(threading.current_thread(), calls[0][1])
+
+        uninstall_hook(self.name, observer)
+        modbus_tk.hooks.call_hooks(self.name, (2, ))
+        executor.join()
+        self.assertEqual(1, len(calls))
+
+    def testAsyncHookDropsCalls(self):
+        """the calls are dropped and counted when the queue is full"""
+        release = threading.Event()
+        executor = modbus_tk.hooks.HookExecutor(maxsize=2)
+        modbus_tk.hooks.install_async_hook(self.name, lambda args: release.wait(2.0), executor=executor)
+        t0 = time.time()
+        for i in range(10):
+            modbus_tk.hooks.call_hooks(self.name, (i, ))
+        self.assertTrue(time.time() - t0 < 1.0)
+        release.set()
+        executor.join()
+        # one call may be running when the others are queued
+        self.assertTrue(executor.dropped in (7, 8))
+
+    def testHookIsCalledWithoutLock(self):
+        """a running hook doesn't block the other threads"""
+        running, release = threading.Event(), threading.Event()
+
+        def slow_hook(args):
+            if args[0] == "slow":
+                running.set()
+                release.wait(2.0)
+        install_hook(self.name, slow_hook)
+        thread = threading.Thread(target=modbus_tk.hooks.call_hooks, args=(self.name, ("slow", )))
+        thread.start()
+        try:
+            self.assertTrue(running.wait(1.0))
+            t0 = time.time()
+            modbus_tk.hooks.call_hooks(self.name, ("fast", ))
+            # a hook may install another hook while the slow one is running
+            install_hook(self.name, lambda args: None)
+            self.assertTrue(time.time() - t0 < 0.5)
+        finally:
+            release.set()
+            thread.join()
+
+
 class TestSlaveRequestHandler(unittest.TestCase):
     def setUp(self):
         self._slave = modbus_tk.modbus.Slave(0)
@@ -57,6 +270,27 @@ class TestSlaveRequestHandler(unittest.TestCase):
                 struct.pack(">BHH", function, starting_addresses[i], len(list_of_coils[i])))
             )
 
+    def testWriteMultipleRegisters(self):
+        """check that the registers are written at once: the block is changed once per request"""
+        self._slave.add_block(self._name, modbus_tk.defines.HOLDING_REGISTERS, 0, 200)
+        calls = []
+
+        def setitem_hook(args):
+            (block, item, values) = args
+            calls.append((item, tuple(values)))
+        install_hook("modbus.ModbusBlock.setitem", setitem_hook)
+        try:
+            values = list(range(65413, 65536))
+            request = struct.pack(">BHHB123H", 16, 50, 123, 246, *values)
+            self.assertEqual(struct.pack(">BHH", 16, 50, 123), self._slave.handle_request(request))
+            request = struct.pack(">BHHHHBHH", 23, 0, 1, 2, 2, 4, 1, 2)
+            self.assertEqual(struct.pack(">BBH", 23, 2, 0), self._slave.handle_request(request))
+        finally:
+            uninstall_hook("modbus.ModbusBlock.setitem", setitem_hook)
+        self.assertEqual(tuple(values), self._slave.get_values(self._name, 50, 123))
+        self.assertEqual((0, 0, 1, 2), self._slave.get_values(self._name, 0, 4))
+        self.assertEqual([(slice(50, 173), tuple(values)), (slice(2, 4), (1, 2))], calls)
+
     def _read_out_of_blocks(self, function, block_type):
         self._slave.add_block(self._name, block_type, 20, 80)
         list_of_ranges = ((200, 10), (0, 1), (100, 1), (100, 5), (60, 50), (10, 30))
@@ -174,6 +408,67 @@ class TestSlaveRequestHandler(unittest.TestCase):
         self._read_continuous_blocks(modbus_tk.defines.READ_INPUT_REGISTERS, modbus_tk.defines.ANALOG_INPUTS)
 
 
+class TestCompactSlaveRequestHandler(TestSlaveRequestHandler):
+    """Run the same tests on a slave storing its values in arrays"""
+    def setUp(self):
+        self._slave = modbus_tk.modbus.Slave(0, compact=True)
+        self._name = "toto"
+
+    def testBlocksAreArrays(self):
+        """check the type of the values of the blocks"""
+        self._slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 65536)
+        self._slave.add_block("c", modbus_tk.defines.COILS, 0, 10)
+        self.assertEqual("H", self._slave._get_block("hr").typecode)
+        self.assertTrue(isinstance(self._slave._get_block("c"), modbus_tk.modbus.BitsBlock))
+        self.assertEqual(65536, self._slave._get_block("hr").size)
+        self.assertEqual(10, self._slave._get_block("c").size)
+
+    def testBitsBlock(self):
+        """check the access to the bits of a block"""
+        block = modbus_tk.modbus.BitsBlock(0, 21)
+        block[3] = 1
+        block[-1] = 5
+        block[5:15] = [1, 0] * 5
+        self.assertEqual([0, 0, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0, 1], block[:])
+        self.assertEqual([1, 1, 1, 1, 1], block[5:15:2])
+        self.assertEqual(b"\x55\x05", block.get_bits(3, 11))
+        block.set_bits(1, 12, b"\xff\x0f")
+        self.assertEqual([0] + [1] * 13 + [0, 0, 0, 0, 0, 0, 1], block[:])
+        block[0:21:3] = [0] * 7
+        self.assertEqual(0, block[9])
+        self.assertRaises(IndexError, block.__getitem__, 21)
+        self.assertRaises(ValueError, block.__setitem__, slice(0, 2), [1])
+
+    def testWriteMultipleCoils(self):
+        """check that the coils are written without modifying their neighbours"""
+        self._slave.add_block(self._name, modbus_tk.defines.COILS, 0, 100)
+        self._slave.set_values(self._name, 0, [1] * 100)
+        request = struct.pack(">BHHBBB", 15, 3, 10, 2, 0x5A, 0x02)
+        self.assertEqual(struct.pack(">BHH", 15, 3, 10), self._slave.handle_request(request))
+        self.assertEqual((1, 1, 1, 0, 1, 0, 1, 1, 0, 1, 0, 0, 1, 1), self._slave.get_values(self._name, 0, 14))
+
+    def testReadRegisters(self):
+        """check that the registers are sent in big endian"""
+        self._slave.add_block(self._name, modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        self._slave.set_values(self._name, 2, [0x1234, 0xFFFF])
+        self.assertEqual(
+            struct.pack(">BBHHH", 3, 6, 0x1234, 0xFFFF, 0),
+            self._slave.handle_request(struct.pack(">BHH", 3, 2, 3))
+        )
+
+    def testSignedRegisters(self):
+        """check that a signed slave stores negative values"""
+        slave = modbus_tk.modbus.Slave(0, unsigned=False, compact=True)
+        slave.add_block(self._name, modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        slave.set_values(self._name, 0, [-1, 5])
+        self.assertEqual((-1, 5), slave.get_values(self._name, 0, 2))
+        self.assertEqual(struct.pack(">BBhh", 3, 4, -1, 5), slave.handle_request(struct.pack(">BHH", 3, 0, 2)))
+        self.assertEqual(
+            struct.pack(">BHH", 16, 2, 1), slave.handle_request(struct.pack(">BHHBh", 16, 2, 1, 2, -300))
+        )
+        self.assertEqual((-300, ), slave.get_values(self._name, 2))
+
+
 class TestSlaveBlocks(unittest.TestCase):
     def setUp(self):
         self._slave = modbus_tk.modbus.Slave(0)
@@ -283,6 +578,70 @@ class TestSlaveBlocks(unittest.TestCase):
             self._slave.remove_block(self._name)
             self._slave.remove_block(self._name+"_")
         
+    def testBlocksInAnyOrder(self):
+        """Add blocks in any order and check that every address is found in its block"""
+        slave = self._slave
+        for (i, address) in enumerate((500, 100, 0, 900, 300, 700)):
+            slave.add_block(self._name+str(i), modbus_tk.defines.HOLDING_REGISTERS, address, 100)
+            slave.set_values(self._name+str(i), address, [address] * 100)
+        for address in (0, 99, 100, 399, 500, 750, 999):
+            response = slave.handle_request(struct.pack(">BHH", 3, address, 1))
+            self.assertEqual(struct.pack(">BBH", 3, 2, address - address % 100), response)
+        for address in (200, 299, 450, 600, 1000):
+            response = slave.handle_request(struct.pack(">BHH", 3, address, 1))
+            self.assertEqual(struct.pack(">BB", 0x83, modbus_tk.defines.ILLEGAL_DATA_ADDRESS), response)
+        self.assertRaises(
+            modbus_tk.modbus.OverlapModbusBlockError, slave.add_block, "_", modbus_tk.defines.HOLDING_REGISTERS, 450, 100
+        )
+        slave.add_block("_", modbus_tk.defines.HOLDING_REGISTERS, 400, 100)
+        slave.remove_block(self._name+"1")
+        self.assertEqual((300, ), slave.get_values(self._name+"4", 399))
+        self.assertEqual(
+            struct.pack(">BB", 0x83, modbus_tk.defines.ILLEGAL_DATA_ADDRESS),
+            slave.handle_request(struct.pack(">BHH", 3, 100, 1))
+        )
+        self.assertEqual(struct.pack(">BBH", 3, 2, 0), slave.handle_request(struct.pack(">BHH", 3, 450, 1)))
+
+    def testSharedMemory(self):
+        """Check that the blocks added to a list shared by several block types are found for every type"""
+        registers = []
+        memory = {
+            modbus_tk.defines.COILS: [],
+            modbus_tk.defines.DISCRETE_INPUTS: [],
+            modbus_tk.defines.HOLDING_REGISTERS: registers,
+            modbus_tk.defines.ANALOG_INPUTS: registers,
+        }
+        slave = modbus_tk.modbus.Slave(1, memory=memory)
+        slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        self.assertEqual(struct.pack(">BBH", 4, 2, 0), slave.handle_request(struct.pack(">BHH", 4, 5, 1)))
+        slave.add_block("ai", modbus_tk.defines.ANALOG_INPUTS, 10, 10)
+        slave.set_values("ai", 10, 7)
+        self.assertEqual(struct.pack(">BBH", 3, 2, 7), slave.handle_request(struct.pack(">BHH", 3, 10, 1)))
+        slave.remove_block("hr")
+        self.assertEqual(
+            struct.pack(">BB", 0x84, modbus_tk.defines.ILLEGAL_DATA_ADDRESS),
+            slave.handle_request(struct.pack(">BHH", 4, 5, 1))
+        )
+
+    def testMemorySharedBySlaves(self):
+        """Check that the blocks added and removed by a slave are seen by the slaves sharing its memory"""
+        memory = {
+            modbus_tk.defines.COILS: [],
+            modbus_tk.defines.DISCRETE_INPUTS: [],
+            modbus_tk.defines.HOLDING_REGISTERS: [],
+            modbus_tk.defines.ANALOG_INPUTS: [],
+        }
+        (slave1, slave2) = (modbus_tk.modbus.Slave(1, memory=memory), modbus_tk.modbus.Slave(2, memory=memory))
+        request = struct.pack(">BHH", 3, 15, 1)
+        self.assertEqual(struct.pack(">BB", 0x83, modbus_tk.defines.ILLEGAL_DATA_ADDRESS), slave2.handle_request(request))
+        slave1.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 10, 10)
+        self.assertEqual(struct.pack(">BBH", 3, 2, 0), slave2.handle_request(request))
+        self.assertRaises(
+            modbus_tk.modbus.OverlapModbusBlockError, slave2.add_block, "hr2", modbus_tk.defines.HOLDING_REGISTERS, 5, 10
+        )
+        slave1.remove_block("hr")
+        self.assertEqual(struct.pack(">BB", 0x83, modbus_tk.defines.ILLEGAL_DATA_ADDRESS), slave2.handle_request(request))
+
     def testMultiThreadedAccess(self):
         """test mutual access"""
         def add_blocks(slave, name, starting_address):
@@ -298,6 +657,44 @@ class TestSlaveBlocks(unittest.TestCase):
         for i in range(10):
             self._slave.remove_block(self._name+str(i))
             
+    def testBlocksAreLockedSeparately(self):
+        """a block locked for writing doesn't block the requests on other blocks"""
+        self._slave.add_block("a", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        self._slave.add_block("b", modbus_tk.defines.HOLDING_REGISTERS, 10, 10)
+        self._slave.set_values("b", 10, [5])
+        responses = []
+
+        def read(address):
+            responses.append(self._slave.handle_request(struct.pack(">BHH", 3, address, 1)))
+
+        with self._slave.lock_blocks("a"):
+            thread = threading.Thread(target=read, args=(10, ))
+            thread.start()
+            thread.join(1.0)
+            self.assertEqual([struct.pack(">BBH", 3, 2, 5)], responses)
+
+            thread = threading.Thread(target=read, args=(0, ))
+            thread.start()
+            thread.join(0.2)
+            # the request waits for the end of the lock
+            self.assertTrue(thread.is_alive())
+            self._slave.set_values("a", 0, [7])
+        thread.join(1.0)
+        self.assertEqual(struct.pack(">BBH", 3, 2, 7), responses[1])
+
+    def testReadWriteMultipleRegistersIsAtomic(self):
+        """FC23 reads and writes 2 blocks at once"""
+        self._slave.add_block("a", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        self._slave.add_block("b", modbus_tk.defines.HOLDING_REGISTERS, 10, 10)
+        self._slave.set_values("a", 0, [1, 2])
+        request = struct.pack(">BHHHHBHH", 23, 0, 2, 10, 2, 4, 3, 4)
+        self.assertEqual(struct.pack(">BBHH", 23, 4, 1, 2), self._slave.handle_request(request))
+        self.assertEqual((3, 4), self._slave.get_values("b", 10, 2))
+        # the same block for reading and writing
+        request = struct.pack(">BHHHHBHH", 23, 10, 2, 11, 2, 4, 8, 9)
+        self.assertEqual(struct.pack(">BBHH", 23, 4, 3, 4), self._slave.handle_request(request))
+        self.assertEqual((3, 8, 9), self._slave.get_values("b", 10, 3))
+
     def testSetAndGetRegister(self):
         """change the value of a register and check that it is properly set"""
         self._slave.add_block(self._name, modbus_tk.defines.HOLDING_REGISTERS, 0, 100)
@@ -387,6 +784,135 @@ class TestSlaveBlocks(unittest.TestCase):
         self.assertEqual(vals, expected_values)
 
 
+class TestSubscription(unittest.TestCase):
+    """Check the notification of the values written by the requests"""
+
+    def setUp(self):
+        self.databank = modbus_tk.modbus.Databank()
+        self.slave = self.databank.add_slave(1)
+        self.slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 100)
+        self.slave.add_block("c", modbus_tk.defines.COILS, 0, 100)
+
+    def _write_registers(self, slave, address, values):
+        """write the registers with a modbus request"""
+        request = struct.pack(">BHHB%dH" % len(values), 16, address, len(values), len(values) * 2, *values)
+        return slave.handle_request(request)
+
+    def testOneChangePerRequest(self):
+        """Check that every request is notified once with all its values"""
+        subscription = self.slave.subscribe()
+        self._write_registers(self.slave, 10, (1, 2, 3))
+        self.slave.handle_request(struct.pack(">BHH", 5, 7, 0xff00))
+        self.slave.handle_request(struct.pack(">BHHBB", 15, 2, 3, 1, 5))
+        self.slave.handle_request(struct.pack(">BHH", 6, 20, 8))
+        self.assertEqual((1, "hr", 10, (1, 2, 3)), subscription.get(timeout=1))
+        self.assertEqual((1, "c", 7, (1, )), subscription.get(timeout=1))
+        self.assertEqual((1, "c", 2, (1, 0, 1)), subscription.get(timeout=1))
+        self.assertEqual((1, "hr", 20, (8, )), subscription.get(timeout=1))
+
+    def testReadsAndSetValuesAreNotNotified(self):
+        """Check that only the values written by the requests are notified"""
+        subscription = self.slave.subscribe()
+        self.slave.set_values("hr", 0, (5, 6))
+        self.slave.handle_request(struct.pack(">BHH", 3, 0, 2))
+        self._write_registers(self.slave, 200, (1, ))
+        self.assertRaises(queue.Empty, subscription.get, timeout=0.1)
+
+    def testCallbackAndBlockNames(self):
+        """Check that the callback only receives the changes of the subscribed blocks"""
+        changes = []
+        subscription = self.slave.subscribe(changes.append, block_names=["c"])
+        self._write_registers(self.slave, 0, (1, ))
+        self.slave.handle_request(struct.pack(">BHH", 5, 1, 0xff00))
+        self.assertEqual([(1, "c", 1, (1, ))], changes)
+        subscription.close()
+        self.slave.handle_request(struct.pack(">BHH", 5, 2, 0xff00))
+        self.assertEqual(1, len(changes))
+
+    def testWindow(self):
+        """Check that the changes are coalesced during the window"""
+        subscription = self.slave.subscribe(window=0.2)
+        self._write_registers(self.slave, 10, (1, 2))
+        self._write_registers(self.slave, 12, (3, ))
+        self._write_registers(self.slave, 11, (4, ))
+        self._write_registers(self.slave, 50, (5, ))
+        self.assertRaises(queue.Empty, subscription.get, timeout=0.05)
+        self.assertEqual((1, "hr", 10, (1, 4, 3)), subscription.get(timeout=1))
+        self.assertEqual((1, "hr", 50, (5, )), subscription.get(timeout=1))
+        # close delivers the pending changes
+        self._write_registers(self.slave, 0, (6, ))
+        subscription.close()
+        self.assertEqual((1, "hr", 0, (6, )), subscription.get(timeout=0.05))
+
+    def testCallbacksCanChangeBlocks(self):
+        """Check that the hooks and the callbacks called by a request can add and remove blocks"""
+        def add_block(change):
+            self.slave.add_block("hr" + str(change.address), modbus_tk.defines.HOLDING_REGISTERS, 200, 10)
+        self.slave.subscribe(add_block)
+        self._write_registers(self.slave, 10, (1, ))
+        self.assertEqual((0, ), self.slave.get_values("hr10", 200))
+
+        def remove_block(args):
+            self.slave.remove_block("hr10")
+        install_hook("modbus.Slave.handle_request", remove_block, instance=self.slave)
+        try:
+            self.assertEqual(struct.pack(">BB", 0x83, 2), self.slave.handle_request(struct.pack(">BHH", 3, 200, 1)))
+        finally:
+            uninstall_hook("modbus.Slave.handle_request", instance=self.slave)
+
+    def testMaxSize(self):
+        """Check that the changes are dropped when the queue is full"""
+        subscription = self.slave.subscribe(maxsize=2)
+        for i in range(5):
+            self._write_registers(self.slave, i, (i, ))
+        self.assertEqual(3, subscription.dropped)
+
+    def testAsyncMaxSize(self):
+        """Check that the changes iterated by "async for" are dropped when the queue is full"""
+        subscription = self.slave.subscribe(maxsize=2)
+
+        async def read():
+            changes = []
+            iterator = subscription.__aiter__()
+            for i in range(3):
+                self._write_registers(self.slave, i, (i, ))
+            await asyncio.sleep(0.1)
+            subscription.close()
+            async for change in iterator:
+                changes.append(change)
+            return changes
+        self.assertEqual([(1, "hr", 0, (0, )), (1, "hr", 1, (1, ))], asyncio.run(read()))
+        self.assertEqual(1, subscription.dropped)
+
+    def testClosedEventLoop(self):
+        """Check that a write succeeds when the event loop iterating the subscription is closed"""
+        subscription = self.slave.subscribe()
+
+        async def start_iteration():
+            subscription.__aiter__()
+        asyncio.run(start_iteration())
+        request = struct.pack(">BHH", 6, 20, 8)
+        self.assertEqual(request, self.slave.handle_request(request))
+        self.assertEqual((8, ), self.slave.get_values("hr", 20))
+        self.assertEqual(1, subscription.dropped)
+        # the loop is detached: the next changes are read with get
+        self.slave.handle_request(struct.pack(">BHH", 6, 21, 9))
+        self.assertEqual((1, "hr", 21, (9, )), subscription.get(timeout=1))
+
+    def testDatabank(self):
+        """Check that a databank subscription receives the changes of all the slaves"""
+        subscription = self.databank.subscribe()
+        slave2 = self.databank.add_slave(2)
+        slave2.add_block("hr2", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        self._write_registers(self.slave, 0, (1, ))
+        self._write_registers(slave2, 5, (2, ))
+        self.assertEqual((1, "hr", 0, (1, )), subscription.get(timeout=1))
+        self.assertEqual((2, "hr2", 5, (2, )), subscription.get(timeout=1))
+        subscription.close()
+        self._write_registers(slave2, 5, (3, ))
+        self.assertRaises(queue.Empty, subscription.get, timeout=0.05)
+
+
 class TestServer(unittest.TestCase):
     def setUp(self):
         self.server = modbus_tk.modbus.Server()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import fcntl
+    import pty
+    import termios
+    import tty
+except ImportError:
+    # no pseudo terminal on this platform
+    pty = None
+
+import modbus_tk
+import modbus_tk.defines as cst
+import modbus_tk.modbus
+import modbus_tk.modbus_rtu as modbus_rtu
+import modbus_tk.modbus_tcp as modbus_tcp
+from modbus_tk.exceptions import ModbusError
+from modbus_tk.modbus_gateway import ForwardedQuery, TcpRtuGateway, get_expected_length
+
+LOGGER = modbus_tk.utils.create_logger()
+
+
+class PtySerial(object):
+    """A serial line on one side of a pseudo terminal. Implements what modbus_tk uses of pyserial"""
+
+    baudrate = 115200
+    inter_byte_timeout = None
+
+    def __init__(self, fd, name):
+        self.fd = fd
+        self.name = name
+        self.is_open = True
+        self.timeout = 1.0
+        # cancel_read wakes up a blocking read
+        (self._cancel_fd, self._cancel_write_fd) = os.pipe()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def read(self, size=1):
+        data = b""
+        end_time = None if self.timeout is None else time.time() + self.timeout
+        while len(data) < size:
+            remaining = None if end_time is None else max(0.0, end_time - time.time())
+            readable = select.select([self.fd, self._cancel_fd], [], [], remaining)[0]
+            if self._cancel_fd in readable:
+                os.read(self._cancel_fd, 1)
+                break
+            if not readable:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data
+
+    def write(self, data):
+        os.write(self.fd, bytes(data))
+
+    def flush(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        return struct.unpack("I", fcntl.ioctl(self.fd, termios.FIONREAD, b"\x00" * 4))[0]
+
+    def reset_input_buffer(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 1024)
+
+    def reset_output_buffer(self):
+        pass
+
+    def cancel_read(self):
+        os.write(self._cancel_write_fd, b"\x00")
+
+    def release(self):
+        for fd in (self._cancel_fd, self._cancel_write_fd):
+            os.close(fd)
+
+
+class BlockedMaster(modbus_tk.modbus.Master):
+    """A master which answers the requests when it is released"""
+
+    def __init__(self):
+        super(BlockedMaster, self).__init__(1.0)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def execute_prepared(self, prepared):
+        self.started.set()
+        self.release.wait(5.0)
+        return struct.pack(">BBH", cst.READ_HOLDING_REGISTERS, 2, 7)
+
+
+class SlaveIdQuery(modbus_tk.modbus.Query):
+    """A query without prepared framing: the request is the slave id and the pdu"""
+
+    def build_request(self, pdu, slave):
+        return struct.pack(">B", slave) + pdu
+
+    def parse_response(self, response):
+        return response[1:]
+
+
+class SendOnlyMaster(modbus_tk.modbus.Master):
+    """A master recording the requests and failing if it waits for a response"""
+
+    def __init__(self):
+        super(SendOnlyMaster, self).__init__(1.0)
+        self.requests = []
+
+    def _do_open(self):
+        pass
+
+    def _do_close(self):
+        return True
+
+    def _send(self, request):
+        self.requests.append(request)
+
+    def _recv(self, expected_length=-1):
+        raise AssertionError("No response is expected")
+
+    def _make_query(self):
+        return SlaveIdQuery()
+
+
+def recv_exactly(sock, size):
+    """returns size bytes received from the socket"""
+    data = b""
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+class TestExpectedLength(unittest.TestCase):
+    """Check the length of the responses forwarded to the serial buses"""
+
+    def testExpectedLength(self):
+        """Check that the length is known when it doesn't depend on the slave"""
+        self.assertEqual(8, get_expected_length(struct.pack(">BHH", cst.WRITE_SINGLE_REGISTER, 1, 2)))
+        self.assertEqual(10, get_expected_length(struct.pack(">BHHH", cst.MASK_WRITE_REGISTER, 1, 2, 3)))
+        self.assertEqual(8, get_expected_length(struct.pack(">BHHBH", cst.WRITE_MULTIPLE_REGISTERS, 1, 1, 2, 3)))
+        self.assertEqual(-1, get_expected_length(struct.pack(">BHH", cst.READ_HOLDING_REGISTERS, 1, 2)))
+
+
+class TestForwardedQuery(unittest.TestCase):
+    """Check the forwarded queries"""
+
+    def testBroadcastWithoutPreparedFraming(self):
+        """Check that a broadcast doesn't wait for a response on a master without prepared framing"""
+        master = SendOnlyMaster()
+        pdu = struct.pack(">BHH", cst.WRITE_SINGLE_REGISTER, 1, 2)
+        self.assertEqual(None, master.execute_prepared(ForwardedQuery(master, 0, pdu)))
+        self.assertEqual([b"\x00" + pdu], master.requests)
+
+
+@unittest.skipIf(pty is None, "pseudo terminals are not available")
+class TestTcpRtuGateway(unittest.TestCase):
+    """Check the gateway with a RtuServer on the other side of a pseudo terminal"""
+
+    def setUp(self):
+        (self.master_fd, self.slave_fd) = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.rtu_serial = PtySerial(self.slave_fd, "slave")
+        self.rtu_server = modbus_rtu.RtuServer(self.rtu_serial)
+        slave = self.rtu_server.add_slave(1)
+        slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 100)
+        slave.set_values("hr", 0, list(range(100)))
+        self.rtu_server.start()
+
+        self.master_serial = PtySerial(self.master_fd, "master")
+        rtu_master = modbus_rtu.RtuMaster(self.master_serial)
+        rtu_master.set_timeout(0.3)
+        self.gateway = TcpRtuGateway(port=0, address="127.0.0.1")
+        self.gateway.add_bus(rtu_master, [1, 2], "bus1")
+        self.gateway.start()
+        time.sleep(0.2)
+        self.master = modbus_tcp.TcpMaster(port=self.gateway._sock.getsockname()[1], timeout_in_sec=2.0)
+
+    def tearDown(self):
+        self.master.close()
+        self.gateway.stop()
+        self.rtu_server.stop()
+        for serial in (self.rtu_serial, self.master_serial):
+            serial.release()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def testReadAndWrite(self):
+        """Check that the requests are forwarded to the slave"""
+        self.assertEqual((5, 6, 7), self.master.execute(1, cst.READ_HOLDING_REGISTERS, 5, 3))
+        self.master.execute(1, cst.WRITE_MULTIPLE_REGISTERS, 10, output_value=[20, 21])
+        self.master.execute(1, cst.WRITE_SINGLE_REGISTER, 12, output_value=22)
+        self.assertEqual((20, 21, 22), self.rtu_server.get_slave(1).get_values("hr", 10, 3))
+
+    def testExceptions(self):
+        """Check that the exceptions of the slave and of the gateway are returned"""
+        t0 = time.time()
+        with self.assertRaises(ModbusError) as context:
+            self.master.execute(1, cst.READ_HOLDING_REGISTERS, 200, 1)
+        self.assertEqual(cst.ILLEGAL_DATA_ADDRESS, context.exception.get_exception_code())
+        # the exception response doesn't wait for the timeout of the bus
+        self.assertTrue(time.time() - t0 < 0.3)
+
+        with self.assertRaises(ModbusError) as context:
+            self.master.execute(2, cst.READ_HOLDING_REGISTERS, 0, 1)
+        self.assertEqual(cst.GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND, context.exception.get_exception_code())
+
+        with self.assertRaises(ModbusError) as context:
+            self.master.execute(3, cst.READ_HOLDING_REGISTERS, 0, 1)
+        self.assertEqual(cst.GATEWAY_PATH_UNAVAILABLE, context.exception.get_exception_code())
+
+    def testBroadcast(self):
+        """Check that a broadcast is forwarded without waiting for a response and is not answered"""
+        client = socket.create_connection(self.gateway._sock.getsockname(), 2.0)
+        try:
+            client.sendall(struct.pack(">HHHBBHH", 1, 0, 6, 0, cst.WRITE_SINGLE_REGISTER, 20, 99))
+            client.sendall(struct.pack(">HHHBBHH", 2, 0, 6, 1, cst.READ_HOLDING_REGISTERS, 20, 1))
+            response = recv_exactly(client, 11)
+        finally:
+            client.close()
+        # the first response is the one of the read request
+        self.assertEqual(struct.pack(">HHHBBBH", 2, 0, 5, 1, cst.READ_HOLDING_REGISTERS, 2, 99), response)
+        stats = self.gateway.get_bus_stats()["bus1"]
+        self.assertEqual((2, 0), (stats["executed"], stats["failed"]))
+
+    def testQueueDepth(self):
+        """Check that the requests for a bus with a full queue are answered as busy"""
+        master = BlockedMaster()
+        self.gateway.add_bus(master, [5], "blocked")
+        self.gateway._max_queue_depth = 2
+        client = socket.create_connection(self.gateway._sock.getsockname(), 2.0)
+        try:
+            client.sendall(struct.pack(">HHHBBHH", 1, 0, 6, 5, cst.READ_HOLDING_REGISTERS, 0, 1))
+            self.assertTrue(master.started.wait(1.0))
+            for transaction_id in (2, 3, 4):
+                client.sendall(struct.pack(">HHHBBHH", transaction_id, 0, 6, 5, cst.READ_HOLDING_REGISTERS, 0, 1))
+            self.assertEqual(struct.pack(">HHHBBB", 4, 0, 3, 5, 0x83, cst.SLAVE_DEVICE_BUSY), recv_exactly(client, 9))
+            master.release.set()
+            self.assertEqual(
+                b"".join([struct.pack(">HHHBBBH", i, 0, 5, 5, cst.READ_HOLDING_REGISTERS, 2, 7) for i in (1, 2, 3)]),
+                recv_exactly(client, 33)
+            )
+        finally:
+            master.release.set()
+            client.close()
+
+    def testPipelinedRequests(self):
+        """Check that the requests are queued on the bus and answered with their transaction id"""
+        queries = [(1, cst.READ_HOLDING_REGISTERS, i, 1) for i in range(20)]
+        self.assertEqual([(i, ) for i in range(20)], self.master.execute_many(queries, 8))
+        stats = self.gateway.get_bus_stats()["bus1"]
+        self.assertEqual((20, 0), (stats["executed"], stats["failed"]))
+        self.assertEqual({"bus1": 0}, self.gateway.get_queue_depths())
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv)
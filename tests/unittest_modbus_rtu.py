@@ -12,9 +12,10 @@
 import unittest
 import modbus_tk
 import modbus_tk.modbus_rtu as modbus_rtu
+from modbus_tk import crc
 import struct
 import sys
-from modbus_tk.utils import to_data, PY2, PY3
+from modbus_tk.utils import to_data
 
 LOGGER = modbus_tk.utils.create_logger()
 
@@ -22,10 +23,7 @@ LOGGER = modbus_tk.utils.create_logger()
 def crc16_alternative(data):
     crc = 0xFFFF
     for i in data:
-        if PY2:
-            crc = crc ^ ord(i)
-        else:
-            crc = crc ^ i
+        crc = crc ^ i
         for j in range(8):
             tmp = crc & 1
             crc = crc >> 1
@@ -77,6 +75,35 @@ class TestCrc(unittest.TestCase):
             s += struct.pack(">B", i)
             self.assertEqual(crc16_alternative(s), modbus_tk.utils.calculate_crc(s))
 
+    def testIncrementalCrc(self):
+        """Check that the crc can be updated with the parts of a frame"""
+        data = to_data("12345678910111213141516")
+        value = crc.INITIAL_CRC
+        for i in range(0, len(data), 5):
+            value = crc.update(value, memoryview(data)[i:i+5])
+        self.assertEqual(crc.update(crc.INITIAL_CRC, data), value)
+        self.assertEqual(struct.pack(">H", crc16_alternative(data)), crc.pack(value))
+        self.assertEqual(0, crc.update(value, crc.pack(value)))
+
+    def testValidateFrame(self):
+        """Check that a frame is validated without being copied"""
+        frame = bytearray(to_data("\x00modbus-tk"))
+        frame += struct.pack(">H", crc.calculate(frame[1:]))
+        self.assertFalse(crc.validate_frame(frame))
+        self.assertTrue(crc.validate_frame(frame, 1))
+        self.assertFalse(crc.validate_frame(frame, 1, len(frame) - 1))
+        self.assertFalse(crc.validate_frame(frame, 1, 2))
+
+    def testValidateFrames(self):
+        """Check that the crc of many frames are checked at once"""
+        query = modbus_rtu.RtuQuery()
+        frames = [query.build_request(struct.pack(">BHH", 3, i, 1), 1) for i in range(10)]
+        frames[3] = frames[3][:-1] + struct.pack(">B", bytearray(frames[3])[-1] ^ 0xFF)
+        expected = [True] * 10
+        expected[3] = False
+        self.assertEqual(expected, crc.validate_frames(frames))
+        self.assertEqual([False, False], crc.validate_frames([b"", b"\x01"]))
+
 
 class TestRtuQuery(unittest.TestCase):
     """Check that RtuQuery class"""
@@ -160,6 +187,19 @@ class TestRtuQuery(unittest.TestCase):
         response += struct.pack(">H", response_crc)
         self.assertRaises(modbus_tk.modbus.ModbusInvalidResponseError, query.parse_response, response)
     
+    def testPreparedRequest(self):
+        """Test that a prepared request is sent as it is and that its response is checked"""
+        query = modbus_rtu.RtuQuery()
+        request = query.build_prepared_request(to_data("a"), 5)
+        self.assertEqual(query.build_request(to_data("a"), 5), query.renew_request(request))
+        response = struct.pack(">B1s", 5, to_data("b"))
+        response += struct.pack(">H", crc16_alternative(response))
+        self.assertEqual(to_data("b"), query.parse_prepared_response(request, response))
+        for wrong_response in (to_data("\x08") + response[1:], response[:-1] + to_data("\x00"), response[:2]):
+            self.assertRaises(
+                modbus_tk.modbus.ModbusInvalidResponseError, query.parse_prepared_response, request, wrong_response
+            )
+
     def testParseTooShortRequest(self):
         """Test an error is raised if the request is too short"""
         query = modbus_rtu.RtuQuery()
@@ -188,6 +228,143 @@ class TestRtuQuery(unittest.TestCase):
             self.assertEqual(to_data(pdu), response_pdu)
             i += 1
 
+class FakeSerial(object):
+    """A serial line which doesn't do anything"""
+    name = "fake"
+    is_open = True
+    baudrate = 9600
+    timeout = 1.0
+    inter_byte_timeout = None
+
+    def close(self):
+        self.is_open = False
+
+
+class TestRtuMaster(unittest.TestCase):
+    """Check the RtuMaster class"""
+
+    def testMastersOnSameSerialShareLock(self):
+        """Check that masters on the same serial line are serialized"""
+        serial1, serial2 = FakeSerial(), FakeSerial()
+        master1 = modbus_rtu.RtuMaster(serial1)
+        master2 = modbus_rtu.RtuMaster(serial1)
+        master3 = modbus_rtu.RtuMaster(serial2)
+        self.assertTrue(master1._lock is master2._lock)
+        self.assertFalse(master1._lock is master3._lock)
+
+    def _make_response(self, pdu):
+        """returns the rtu frame of a response of slave 1"""
+        query = modbus_rtu.RtuQuery()
+        query.build_request(b"", 1)
+        return query.build_response(pdu)
+
+    def testExceptionResponse(self):
+        """Check that an exception response is received without waiting for the timeout"""
+        response = self._make_response(struct.pack(">BB", 0x83, 2))
+        serial = BufferSerial(response + to_data("\x01"))
+        master = modbus_rtu.RtuMaster(serial)
+        self.assertEqual(response, master._recv(25))
+        self.assertEqual([2, 3], serial.reads)
+
+    def testByteCountResponse(self):
+        """Check that the length of a response is read in its byte count"""
+        response = self._make_response(struct.pack(">BB2H", 3, 4, 1, 2))
+        serial = BufferSerial(response + to_data("\x01"))
+        master = modbus_rtu.RtuMaster(serial)
+        self.assertEqual(response, master._recv())
+        self.assertEqual([2, 1, 6], serial.reads)
+
+    def testExpectedLength(self):
+        """Check that expected_length is used for the responses without byte count"""
+        response = self._make_response(struct.pack(">BHH", 6, 1, 2))
+        serial = BufferSerial(response + to_data("\x01"))
+        master = modbus_rtu.RtuMaster(serial)
+        self.assertEqual(response, master._recv(8))
+        self.assertEqual([2, 6], serial.reads)
+
+
+class BufferSerial(FakeSerial):
+    """A serial line receiving the bytes of a buffer"""
+
+    def __init__(self, data):
+        self.input = bytearray(data)
+        self.output = bytearray()
+        self.reads = []
+
+    @property
+    def in_waiting(self):
+        return len(self.input)
+
+    def open(self):
+        self.is_open = True
+
+    def read(self, size=1):
+        self.reads.append(size)
+        data = bytes(self.input[:size])
+        del self.input[:size]
+        return data
+
+    def write(self, data):
+        self.output += data
+
+    def flush(self):
+        pass
+
+
+class TestRtuServer(unittest.TestCase):
+    """Check the detection of the end of the requests by the RtuServer"""
+
+    def _make_frame(self, slave, pdu):
+        """returns the rtu frame of a pdu"""
+        query = modbus_rtu.RtuQuery()
+        return query.build_request(pdu, slave)
+
+    def _make_server(self, data):
+        """returns a server receiving the data"""
+        server = modbus_rtu.RtuServer(BufferSerial(data))
+        slave = server.add_slave(1)
+        slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        slave.set_values("hr", 0, list(range(10)))
+        return server
+
+    def testRequestLength(self):
+        """Check that the length of the requests is known from their first bytes"""
+        read_request = self._make_frame(1, struct.pack(">BHH", 3, 0, 10))
+        self.assertEqual(2, modbus_rtu.get_request_length(read_request[:1]))
+        self.assertEqual(8, modbus_rtu.get_request_length(read_request[:2]))
+        write_request = self._make_frame(1, struct.pack(">BHHB3H", 16, 0, 3, 6, 1, 2, 3))
+        self.assertEqual(7, modbus_rtu.get_request_length(write_request[:6]))
+        self.assertEqual(len(write_request), modbus_rtu.get_request_length(write_request[:7]))
+        fc23_request = self._make_frame(1, struct.pack(">BHHHHBH", 23, 0, 1, 0, 1, 2, 5))
+        self.assertEqual(len(fc23_request), modbus_rtu.get_request_length(fc23_request[:11]))
+        self.assertEqual(None, modbus_rtu.get_request_length(to_data("\x01\x64")))
+
+    def testRequestHandledWhenComplete(self):
+        """Check that a request is handled without waiting for the timeout"""
+        first_request = self._make_frame(1, struct.pack(">BHHB2H", 16, 0, 2, 4, 7, 8))
+        second_request = self._make_frame(1, struct.pack(">BHH", 3, 0, 2))
+        server = self._make_server(first_request)
+        server._do_run()
+        # no read is waiting for the timeout
+        self.assertEqual([2, 5, 6], server._serial.reads)
+        server._serial.input += second_request
+        server._do_run()
+        self.assertEqual([2, 5, 6, 2, 6], server._serial.reads)
+        query = modbus_rtu.RtuQuery()
+        query.build_request(b"", 1)
+        self.assertEqual(struct.pack(">BHH", 16, 0, 2), query.parse_response(bytes(server._serial.output[:8])))
+        self.assertEqual(struct.pack(">BB2H", 3, 4, 7, 8), query.parse_response(bytes(server._serial.output[8:])))
+
+    def testInvalidFrameUntilTimeout(self):
+        """Check that a frame with a wrong crc is read until the timeout"""
+        request = self._make_frame(1, struct.pack(">BHH", 3, 0, 2))
+        request = request[:-1] + struct.pack(">B", (bytearray(request)[-1] + 1) % 256)
+        server = self._make_server(request + to_data("\x01\x02\x03"))
+        server._do_run()
+        self.assertEqual(b"", bytes(server._serial.input))
+        self.assertEqual(b"", bytes(server._serial.output))
+
+
 class TestRtuCom(unittest.TestCase):
     """Check rtu com settinsg are Ok"""
     
@@ -16,6 +16,8 @@ import threading
 import struct
 import logging
 import sys
+import socket
+import time
 from modbus_tk.utils import to_data
 
 LOGGER = modbus_tk.utils.create_logger()
@@ -284,6 +286,24 @@ class TestTcpQuery(unittest.TestCase):
         )
         self.assertRaises(modbus_tk.modbus_tcp.ModbusInvalidMbapError, query.parse_response, response)
     
+    def testPreparedRequest(self):
+        """Test that a prepared request gets a new transaction id and that its response is checked"""
+        query = modbus_tcp.TcpQuery()
+        prepared = query.build_prepared_request(to_data("abc"), 5)
+        request = query.renew_request(prepared)
+        self.assertEqual(prepared[2:], request[2:])
+        self.assertNotEqual(request[:2], query.renew_request(prepared)[:2])
+        response = request[:4] + struct.pack(">HB", 3, 5) + to_data("de")
+        self.assertEqual(to_data("de"), query.parse_prepared_response(request, response))
+        self.assertRaises(modbus_tk.modbus.ModbusInvalidResponseError, query.parse_prepared_response, request, request[:6])
+        for wrong_response in (
+            struct.pack(">H", 0xffff) + response[2:], response[:2] + struct.pack(">H", 1) + response[4:],
+            response[:6] + struct.pack(">B", 6) + response[7:], response + to_data("f"),
+        ):
+            self.assertRaises(
+                modbus_tk.modbus_tcp.ModbusInvalidMbapError, query.parse_prepared_response, request, wrong_response
+            )
+
     def testParseTooShortRequest(self):
         """Test an error is raised if the request is too short"""
         query = modbus_tcp.TcpQuery()
@@ -325,6 +345,102 @@ class TestTcpQuery(unittest.TestCase):
             i += 1
 
 
+class TestTcpMaster(unittest.TestCase):
+
+    def testLockIsPerMaster(self):
+        """Check that 2 masters don't share the same lock: their queries can run in parallel"""
+        master1 = modbus_tcp.TcpMaster(port=1502)
+        master2 = modbus_tcp.TcpMaster(port=1503)
+        self.assertFalse(master1._lock is master2._lock)
+
+        # the lock of a master doesn't block the other one
+        master1._lock.acquire()
+        try:
+            acquired = []
+            thread = threading.Thread(target=lambda: acquired.append(master2._lock.acquire(False)))
+            thread.start()
+            thread.join()
+            self.assertEqual([True], acquired)
+        finally:
+            master1._lock.release()
+
+    def _recv_from(self, chunks, close=False):
+        """feed a master through a socket pair with the given chunks and returns what it received"""
+        master = modbus_tcp.TcpMaster()
+        master._sock, peer = socket.socketpair()
+
+        def send_chunks():
+            for chunk in chunks:
+                peer.send(chunk)
+                time.sleep(0.01)
+            if close:
+                peer.close()
+
+        thread = threading.Thread(target=send_chunks)
+        thread.start()
+        try:
+            return master._recv()
+        finally:
+            thread.join()
+            master._sock.close()
+            master._sock = None
+            if not close:
+                peer.close()
+
+    def testExecuteManyResponsesInAnyOrder(self):
+        """Check that pipelined responses are matched by transaction id"""
+        master = modbus_tcp.TcpMaster()
+        master._sock, peer = socket.socketpair()
+        master._is_opened = True
+
+        def reversed_slave():
+            requests = []
+            for i in range(3):
+                request = to_data("")
+                while len(request) < 12:
+                    request += peer.recv(12 - len(request))
+                requests.append(request)
+            for request in reversed(requests):
+                (transaction_id, address) = struct.unpack(">H", request[:2])[0], struct.unpack(">H", request[8:10])[0]
+                peer.send(struct.pack(">HHHBBBH", transaction_id, 0, 5, 1, 3, 2, address))
+
+        thread = threading.Thread(target=reversed_slave)
+        thread.start()
+        try:
+            queries = [(1, modbus_tk.defines.READ_HOLDING_REGISTERS, address, 1) for address in (10, 20, 30)]
+            self.assertEqual([(10, ), (20, ), (30, )], master.execute_many(queries, window=3))
+        finally:
+            thread.join()
+            master._sock.close()
+            master._sock = None
+            peer.close()
+
+    def testExecuteManyInvalidWindow(self):
+        """Check that an error is raised if the window is not valid"""
+        master = modbus_tcp.TcpMaster()
+        queries = [(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 0, 1)]
+        self.assertRaises(modbus_tk.modbus.InvalidArgumentError, master.execute_many, queries, window=0x10000)
+        self.assertRaises(modbus_tk.modbus.InvalidArgumentError, master.execute_many, queries, window=0)
+
+    def testRecvPartialReads(self):
+        """Check that a response received in several parts is read entirely"""
+        pdu = struct.pack(">BB", 3, 250) + to_data("a" * 250)
+        response = struct.pack(">HHHB", 1, 0, len(pdu) + 1, 1) + pdu
+        chunks = [response[:3], response[3:9], response[9:100], response[100:]]
+        self.assertEqual(response, self._recv_from(chunks))
+
+    def testRecvStopsAtLength(self):
+        """Check that the data following the response is not consumed"""
+        response = struct.pack(">HHHBBH", 1, 0, 4, 1, 6, 12)
+        self.assertEqual(response, self._recv_from([response + response[:5]]))
+
+    def testRecvConnectionClosed(self):
+        """Check that what has been received is returned if the connection is closed"""
+        response = struct.pack(">HHHBBH", 1, 0, 4, 1, 6, 12)
+        self.assertEqual(response[:9], self._recv_from([response[:9]], close=True))
+        self.assertEqual(response[:4], self._recv_from([response[:4]], close=True))
+
+
 class TestTcpServer(unittest.TestCase):
     def setUp(self): pass
     def tearDown(self): pass
@@ -344,6 +460,283 @@ class TestTcpServer(unittest.TestCase):
         request = struct.pack(">HHB", 0, 0, 1)
         self.assertRaises(modbus_tk.modbus.ModbusInvalidRequestError, s._get_request_length, request)
         self.assertRaises(modbus_tk.modbus.ModbusInvalidRequestError, s._get_request_length, "")
+
+    def testAfterRecvHookGetsMbap(self):
+        """Check that the after_recv hook gets the mbap of the request and can modify it"""
+        server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        slave = server.add_slave(1)
+        slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 10)
+        slave.set_values("hr", 0, 7)
+        mbaps = []
+
+        def after_recv(args):
+            (_server, _sock, mbap) = args
+            mbaps.append(mbap)
+            # send the requests of the unit 5 to the slave 1
+            return mbap[:6] + struct.pack(">B", 1)
+        modbus_tk.hooks.install_hook("modbus_tcp.TcpServer.after_recv", after_recv)
+        server.start()
+        try:
+            time.sleep(0.2)
+            client = socket.create_connection(server._sock.getsockname(), 2.0)
+            client.sendall(struct.pack(">HHHBBHH", 3, 0, 6, 5, 3, 0, 1))
+            response = client.recv(1024)
+            client.close()
+        finally:
+            modbus_tk.hooks.uninstall_hook("modbus_tcp.TcpServer.after_recv", after_recv)
+            server.stop()
+        self.assertEqual([struct.pack(">HHHB", 3, 0, 6, 5)], mbaps)
+        self.assertEqual(struct.pack(">HHHBBBH", 3, 0, 5, 1, 3, 2, 7), response)
                 
+
+class TestTcpServerConnection(unittest.TestCase):
+    """Check the reassembly of requests and the buffering of responses"""
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(0)
+        self.connection = modbus_tcp.TcpServerConnection(self.sock, "peer")
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def _request(self, transaction_id, pdu):
+        return struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, 1) + pdu
+
+    def testPipelinedRequests(self):
+        """Check that several requests received at once are extracted"""
+        requests = [self._request(i, struct.pack(">BHH", 3, i, 10)) for i in range(5)]
+        self.peer.send(b"".join(requests))
+        time.sleep(0.1)
+        self.assertTrue(self.connection.recv())
+        for request in requests:
+            self.assertEqual(request, self.connection.pop_request())
+        self.assertEqual(None, self.connection.pop_request())
+
+    def testPartialRequest(self):
+        """Check that a request is returned only when complete"""
+        request = self._request(1, struct.pack(">BHH", 3, 0, 10))
+        for i in range(len(request)):
+            self.assertEqual(None, self.connection.pop_request())
+            self.peer.send(request[i:i+1])
+            time.sleep(0.01)
+            self.assertTrue(self.connection.recv())
+        self.assertEqual(request, self.connection.pop_request())
+
+    def testNothingToRead(self):
+        """Check that reading when no data is available doesn't block"""
+        self.assertTrue(self.connection.recv())
+        self.assertEqual(None, self.connection.pop_request())
+
+    def testDisconnection(self):
+        """Check that recv returns False when the client is disconnected"""
+        self.peer.close()
+        self.assertFalse(self.connection.recv())
+
+    def testInvalidLength(self):
+        """Check that an error is raised if the mbap length is not possible"""
+        self.peer.send(to_data("hello world!"))
+        time.sleep(0.1)
+        self.connection.recv()
+        self.assertRaises(modbus_tk.modbus.ModbusInvalidRequestError, self.connection.pop_request)
+
+    def testBufferedResponses(self):
+        """Check that responses are kept until the socket accepts them"""
+        response = to_data("a" * 4000000)
+        self.connection.send(response)
+        self.assertTrue(self.connection.pending_output() > 0)
+        received = to_data("")
+        while len(received) < len(response):
+            received += self.peer.recv(65536)
+            self.connection.flush()
+        self.assertEqual(0, self.connection.pending_output())
+        self.assertEqual(response, received)
+
+
+class TestBulk(unittest.TestCase):
+    """Check the reads and writes exceeding the limits of one query"""
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        self.slave = self.server.add_slave(1)
+        self.slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 10000)
+        self.slave.add_block("c", modbus_tk.defines.COILS, 0, 5000)
+        self.slave.set_values("hr", 0, [i % 65536 for i in range(10000)])
+        self.server.start()
+        time.sleep(0.2)
+        self.master = modbus_tcp.TcpMaster(port=self.server._sock.getsockname()[1], timeout_in_sec=1.0)
+
+    def tearDown(self):
+        self.master.close()
+        self.server.stop()
+
+    def testReadRegisters(self):
+        """Check that a large read returns all the registers in order"""
+        self.assertEqual(tuple(range(10000)), self.master.read_holding_registers_bulk(1, 0, 10000))
+        self.assertEqual(tuple(range(7, 307)), self.master.read_holding_registers_bulk(1, 7, 300, window=2))
+
+    def testWriteRegisters(self):
+        """Check that a large write is split in several queries"""
+        values = [(3 * i) % 65536 for i in range(1000)]
+        self.assertEqual((10, 1000), self.master.write_registers_bulk(1, 10, values))
+        self.assertEqual(tuple(values), self.slave.get_values("hr", 10, 1000))
+
+    def testCoils(self):
+        """Check that a large number of coils is written and read back"""
+        values = [(i % 3) & 1 for i in range(4500)]
+        self.assertEqual((100, 4500), self.master.write_coils_bulk(1, 100, values))
+        self.assertEqual(tuple(values), self.master.read_coils_bulk(1, 100, 4500))
+
+    def testInvalidRange(self):
+        """Check that the range must fit in the modbus addresses"""
+        self.assertRaises(modbus_tk.exceptions.InvalidArgumentError, self.master.read_holding_registers_bulk, 1, 65000, 1000)
+        self.assertRaises(modbus_tk.exceptions.InvalidArgumentError, self.master.read_holding_registers_bulk, 1, 0, 0)
+
+    def testError(self):
+        """Check that an error of one chunk is raised"""
+        try:
+            self.master.read_holding_registers_bulk(1, 9900, 200)
+        except modbus_tk.modbus.ModbusError as excpt:
+            self.assertEqual(modbus_tk.defines.ILLEGAL_DATA_ADDRESS, excpt.get_exception_code())
+        else:
+            self.fail("ModbusError not raised")
+
+
+class TestTcpServerLoop(unittest.TestCase):
+    """Check the server with real sockets"""
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        slave = self.server.add_slave(1)
+        slave.add_block("hr", modbus_tk.defines.HOLDING_REGISTERS, 0, 100)
+        slave.set_values("hr", 0, list(range(100)))
+        self.server.start()
+        time.sleep(0.2)
+        self.port = self.server._sock.getsockname()[1]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def testPipelinedRequests(self):
+        """Check that the server answers all the requests sent at once"""
+        client = socket.create_connection(("127.0.0.1", self.port))
+        try:
+            requests = [
+                struct.pack(">HHHBBHH", i, 0, 6, 1, 3, i, 1) for i in range(10)
+            ]
+            client.send(b"".join(requests))
+            expected = b"".join([struct.pack(">HHHBBBH", i, 0, 5, 1, 3, 2, i) for i in range(10)])
+            received = to_data("")
+            client.settimeout(2.0)
+            while len(received) < len(expected):
+                received += client.recv(1024)
+            self.assertEqual(expected, received)
+        finally:
+            client.close()
+
+    def testHalfOpenClientDoesNotBlock(self):
+        """Check that a client which sent an incomplete request doesn't block the others"""
+        lazy_client = socket.create_connection(("127.0.0.1", self.port))
+        lazy_client.send(struct.pack(">HHH", 1, 0, 6))
+        try:
+            master = modbus_tcp.TcpMaster(port=self.port, timeout_in_sec=1.0)
+            t0 = time.time()
+            for i in range(20):
+                self.assertEqual((i, ), master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, i, 1))
+            self.assertTrue(time.time() - t0 < 1.0)
+            master.close()
+        finally:
+            lazy_client.close()
+
+    def testExecuteMany(self):
+        """Check that pipelined queries return their results in order"""
+        master = modbus_tcp.TcpMaster(port=self.port, timeout_in_sec=1.0)
+        try:
+            queries = [(1, modbus_tk.defines.READ_HOLDING_REGISTERS, i, 2) for i in range(50)]
+            queries.append({
+                "slave": 1, "function_code": modbus_tk.defines.WRITE_MULTIPLE_REGISTERS,
+                "starting_address": 0, "output_value": [7, 8]
+            })
+            results = master.execute_many(queries, window=10)
+            self.assertEqual([(i, i + 1) for i in range(50)] + [(0, 2)], results)
+            self.assertEqual((7, 8), self.server.get_slave(1).get_values("hr", 0, 2))
+        finally:
+            master.close()
+
+    def testExecuteManyError(self):
+        """Check that the first error is raised and the connection stays usable"""
+        master = modbus_tcp.TcpMaster(port=self.port, timeout_in_sec=1.0)
+        try:
+            queries = [(1, modbus_tk.defines.READ_HOLDING_REGISTERS, address, 1) for address in (1, 200, 3, 300)]
+            try:
+                master.execute_many(queries, window=4)
+            except modbus_tk.modbus.ModbusError as excpt:
+                self.assertEqual(modbus_tk.defines.ILLEGAL_DATA_ADDRESS, excpt.get_exception_code())
+            else:
+                self.fail("ModbusError not raised")
+            self.assertEqual((5, ), master.execute(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 5, 1))
+        finally:
+            master.close()
+
+    def testPreparedQuery(self):
+        """Check that a prepared query can be executed several times"""
+        master = modbus_tcp.TcpMaster(port=self.port, timeout_in_sec=1.0)
+        try:
+            prepared = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 10, 5)
+            self.assertEqual(tuple(range(10, 15)), master.execute_prepared(prepared))
+            self.server.get_slave(1).set_values("hr", 10, [65535])
+            self.assertEqual((65535, 11, 12, 13, 14), prepared.execute())
+
+            signed = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 10, 2, data_format=">hH")
+            self.assertEqual((-1, 11), master.execute_prepared(signed))
+
+            raw = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 11, 1, returns_raw=True)
+            self.assertEqual(b"\x00\x0b", bytes(master.execute_prepared(raw)))
+
+            write = master.prepare(1, modbus_tk.defines.WRITE_SINGLE_REGISTER, 12, output_value=42)
+            self.assertEqual((12, 42), master.execute_prepared(write))
+
+            results = master.execute_many([prepared, prepared], window=2)
+            self.assertEqual([(65535, 11, 42, 13, 14)] * 2, results)
+        finally:
+            master.close()
+
+    def testPreparedQueryError(self):
+        """Check that the exception responses are raised by a prepared query"""
+        master = modbus_tcp.TcpMaster(port=self.port, timeout_in_sec=1.0)
+        try:
+            prepared = master.prepare(1, modbus_tk.defines.READ_HOLDING_REGISTERS, 99, 2)
+            try:
+                master.execute_prepared(prepared)
+            except modbus_tk.modbus.ModbusError as excpt:
+                self.assertEqual(modbus_tk.defines.ILLEGAL_DATA_ADDRESS, excpt.get_exception_code())
+            else:
+                self.fail("ModbusError not raised")
+        finally:
+            master.close()
+
+    def testStopIsImmediate(self):
+        """Check that stopping the server doesn't wait for the timeout of the selector"""
+        client = socket.create_connection(("127.0.0.1", self.port))
+        try:
+            time.sleep(0.1)
+            t0 = time.time()
+            self.server.stop()
+            self.assertTrue(time.time() - t0 < 0.5)
+        finally:
+            client.close()
+
+    def testDisconnectedClientsAreForgotten(self):
+        """Check that the connections are removed when the clients disconnect"""
+        clients = [socket.create_connection(("127.0.0.1", self.port)) for i in range(10)]
+        time.sleep(0.2)
+        self.assertEqual(10, len(self.server._connections))
+        for client in clients:
+            client.close()
+        time.sleep(0.2)
+        self.assertEqual(0, len(self.server._connections))
+
+
 if __name__ == '__main__':
     unittest.main(argv = sys.argv)
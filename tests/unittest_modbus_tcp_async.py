@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+import asyncio
+import socket
+import struct
+import sys
+import time
+import unittest
+
+import modbus_tk
+import modbus_tk.defines as cst
+import modbus_tk.modbus_tcp as modbus_tcp
+from modbus_tk.modbus_tcp_async import AsyncTcpMaster, AsyncTcpServer
+
+LOGGER = modbus_tk.utils.create_logger()
+
+
+class TestAsyncTcpMaster(unittest.TestCase):
+    """Check the asyncio master against the TcpServer"""
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        self.slave = self.server.add_slave(1)
+        self.slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 100)
+        self.slave.add_block("c", cst.COILS, 0, 100)
+        self.slave.set_values("hr", 0, list(range(100)))
+        self.server.start()
+        time.sleep(0.2)
+        self.port = self.server._sock.getsockname()[1]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _run(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def testReadHoldingRegisters(self):
+        """Check that registers are read"""
+        async def read():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                return await master.execute(1, cst.READ_HOLDING_REGISTERS, 10, 20)
+            finally:
+                await master.close()
+        self.assertEqual(tuple(range(10, 30)), self._run(read()))
+
+    def testPreparedQuery(self):
+        """Check that a prepared query can be executed several times"""
+        async def read():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                prepared = master.prepare(1, cst.READ_HOLDING_REGISTERS, 10, 3)
+                first = await master.execute_prepared(prepared)
+                return [first] + await master.execute_many([prepared, (1, cst.READ_COILS, 0, 3)])
+            finally:
+                await master.close()
+        self.assertEqual([(10, 11, 12), (10, 11, 12), (0, 0, 0)], self._run(read()))
+
+    def testBulk(self):
+        """Check that the bulk methods are coroutines splitting the queries"""
+        async def write_and_read():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                await master.write_registers_bulk(1, 0, list(range(100, 0, -1)))
+                return await master.read_holding_registers_bulk(1, 0, 100)
+            finally:
+                await master.close()
+        self.assertEqual(tuple(range(100, 0, -1)), self._run(write_and_read()))
+
+    def testExecuteManyWindow(self):
+        """Check that execute_many sends window queries at once and matches the responses by transaction id"""
+        async def reversed_slave(reader, writer):
+            # answer only when 4 requests are received, the last one first
+            while True:
+                try:
+                    requests = [await reader.readexactly(12) for i in range(4)]
+                except asyncio.IncompleteReadError:
+                    break
+                for request in reversed(requests):
+                    (address, ) = struct.unpack(">H", request[8:10])
+                    writer.write(request[:2] + struct.pack(">HHBBBH", 0, 5, 1, 3, 2, address))
+            writer.close()
+
+        async def read():
+            server = await asyncio.start_server(reversed_slave, "127.0.0.1", 0)
+            master = AsyncTcpMaster(port=server.sockets[0].getsockname()[1], timeout_in_sec=1.0)
+            try:
+                queries = [(1, cst.READ_HOLDING_REGISTERS, i, 1) for i in range(8)]
+                with self.assertRaises(modbus_tk.exceptions.InvalidArgumentError):
+                    await master.execute_many(queries, 0)
+                return await master.execute_many(queries, 4)
+            finally:
+                await master.close()
+                server.close()
+                await server.wait_closed()
+        self.assertEqual([(i, ) for i in range(8)], self._run(read()))
+
+    def testWriteAndReadCoils(self):
+        """Check that the coils are written and read back"""
+        async def write_and_read():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                result = await master.execute(1, cst.WRITE_MULTIPLE_COILS, 0, output_value=[1, 0, 1, 1])
+                self.assertEqual((0, 4), result)
+                return await master.execute(1, cst.READ_COILS, 0, 5)
+            finally:
+                await master.close()
+        self.assertEqual((1, 0, 1, 1, 0), self._run(write_and_read()))
+
+    def testModbusError(self):
+        """Check that an exception returned by the slave raises a ModbusError"""
+        async def read_out_of_block():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                await master.execute(1, cst.READ_HOLDING_REGISTERS, 200, 2)
+            finally:
+                await master.close()
+        try:
+            self._run(read_out_of_block())
+        except modbus_tk.modbus.ModbusError as excpt:
+            self.assertEqual(cst.ILLEGAL_DATA_ADDRESS, excpt.get_exception_code())
+        else:
+            self.fail("ModbusError not raised")
+
+    def testConcurrentQueries(self):
+        """Check that concurrent queries on the same master get their own response"""
+        async def read_all():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                return await asyncio.gather(*[
+                    master.execute(1, cst.READ_HOLDING_REGISTERS, i, 1) for i in range(50)
+                ])
+            finally:
+                await master.close()
+        self.assertEqual([(i, ) for i in range(50)], self._run(read_all()))
+
+    def testTimeout(self):
+        """Check that a timeout is raised if the slave doesn't answer"""
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(1)
+
+        async def read():
+            master = AsyncTcpMaster(port=silent.getsockname()[1], timeout_in_sec=0.2)
+            try:
+                await master.execute(1, cst.READ_HOLDING_REGISTERS, 0, 1)
+            finally:
+                await master.close()
+        try:
+            self.assertRaises(asyncio.TimeoutError, self._run, read())
+        finally:
+            silent.close()
+
+    def testReconnect(self):
+        """Check that the master reconnects when the server has closed the connection"""
+        async def read_twice():
+            master = AsyncTcpMaster(port=self.port)
+            try:
+                first = await master.execute(1, cst.READ_HOLDING_REGISTERS, 0, 1)
+                # close the connection on the server side
+                for connection in list(self.server._connections.values()):
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                await asyncio.sleep(0.2)
+                second = await master.execute(1, cst.READ_HOLDING_REGISTERS, 1, 1)
+                return first, second
+            finally:
+                await master.close()
+        self.assertEqual(((0, ), (1, )), self._run(read_twice()))
+
+
+class TestAsyncTcpServer(unittest.TestCase):
+    """Check the asyncio server"""
+
+    def setUp(self):
+        self.server = AsyncTcpServer(port=0, address="127.0.0.1")
+        self.slave = self.server.add_slave(1)
+        self.slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 100)
+        self.slave.set_values("hr", 0, list(range(100)))
+
+    def _run(self, test_coroutine):
+        """start the server, run the test and stop the server"""
+        async def run():
+            await self.server.start()
+            try:
+                return await test_coroutine(self.server.get_address()[1])
+            finally:
+                await self.server.stop()
+        return asyncio.run(run())
+
+    def testReadAndWrite(self):
+        """Check that a master can read and write the databank"""
+        async def test(port):
+            master = AsyncTcpMaster(port=port)
+            try:
+                await master.execute(1, cst.WRITE_MULTIPLE_REGISTERS, 0, output_value=[5, 6, 7])
+                return await master.execute(1, cst.READ_HOLDING_REGISTERS, 0, 4)
+            finally:
+                await master.close()
+        self.assertEqual((5, 6, 7, 3), self._run(test))
+        self.assertEqual((5, 6, 7), self.slave.get_values("hr", 0, 3))
+
+    def testPipelinedRequests(self):
+        """Check that several requests sent at once are all answered"""
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"".join([struct.pack(">HHHBBHH", i, 0, 6, 1, 3, i, 1) for i in range(20)]))
+            await writer.drain()
+            responses = await reader.readexactly(20 * 11)
+            writer.close()
+            return responses
+        expected = b"".join([struct.pack(">HHHBBBH", i, 0, 5, 1, 3, 2, i) for i in range(20)])
+        self.assertEqual(expected, self._run(test))
+
+    def testManyMasters(self):
+        """Check that many masters can query the server concurrently"""
+        async def test(port):
+            masters = [AsyncTcpMaster(port=port) for i in range(50)]
+
+            async def read(i, master):
+                try:
+                    return await master.execute(1, cst.READ_HOLDING_REGISTERS, i, 1)
+                finally:
+                    await master.close()
+            return await asyncio.gather(*[read(i, master) for (i, master) in enumerate(masters)])
+        self.assertEqual([(i, ) for i in range(50)], self._run(test))
+
+    def testInvalidLengthClosesConnection(self):
+        """Check that the connection is closed when the mbap is not valid"""
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"hello world!")
+            await writer.drain()
+            data = await asyncio.wait_for(reader.read(), 1.0)
+            writer.close()
+            return data
+        self.assertEqual(b"", self._run(test))
+
+    def testSubscription(self):
+        """Check that the changes written by a master can be iterated by the event loop"""
+        async def test(port):
+            subscription = self.server.get_db().subscribe()
+            changes = []
+
+            async def consume():
+                async for change in subscription:
+                    changes.append(change)
+            consumer = asyncio.ensure_future(consume())
+            await asyncio.sleep(0)
+            master = AsyncTcpMaster(port=port)
+            try:
+                await master.execute(1, cst.WRITE_MULTIPLE_REGISTERS, 10, output_value=[1, 2])
+                await master.execute(1, cst.WRITE_SINGLE_REGISTER, 50, output_value=3)
+            finally:
+                await master.close()
+            subscription.close()
+            await asyncio.wait_for(consumer, 1.0)
+            return changes
+        self.assertEqual([(1, "hr", 10, (1, 2)), (1, "hr", 50, (3, ))], self._run(test))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv)
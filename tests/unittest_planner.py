@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+import sys
+import time
+import unittest
+
+import modbus_tk
+import modbus_tk.defines as cst
+import modbus_tk.modbus_tcp as modbus_tcp
+from modbus_tk.exceptions import InvalidArgumentError
+from modbus_tk.planner import ReadPlanner
+
+LOGGER = modbus_tk.utils.create_logger()
+
+
+class TestReadPlanner(unittest.TestCase):
+    """Check how the tags are merged in requests"""
+
+    def testContiguousTags(self):
+        """Check that contiguous tags are read by one request"""
+        plan = ReadPlanner().plan([(1, cst.HOLDING_REGISTERS, i, 2) for i in range(0, 20, 2)])
+        self.assertEqual([(1, cst.HOLDING_REGISTERS, 0, 20)], plan.requests)
+
+    def testOverlappingTags(self):
+        """Check that overlapping and duplicated tags share the same request"""
+        plan = ReadPlanner().plan([
+            (1, cst.HOLDING_REGISTERS, 5, 10), (1, cst.HOLDING_REGISTERS, 7),
+            (1, cst.HOLDING_REGISTERS, 7), (1, cst.HOLDING_REGISTERS, 0, 6)
+        ])
+        self.assertEqual([(1, cst.HOLDING_REGISTERS, 0, 15)], plan.requests)
+        self.assertEqual([tuple(range(5, 15)), (7, ), (7, ), tuple(range(6))], plan.scatter([tuple(range(15))]))
+
+    def testMaxGap(self):
+        """Check that a gap is bridged only if it is small enough"""
+        tags = [(1, cst.HOLDING_REGISTERS, 0, 2), (1, cst.HOLDING_REGISTERS, 5, 2), (1, cst.HOLDING_REGISTERS, 20)]
+        self.assertEqual(3, len(ReadPlanner().plan(tags)))
+        self.assertEqual(
+            [(1, cst.HOLDING_REGISTERS, 0, 7), (1, cst.HOLDING_REGISTERS, 20, 1)],
+            ReadPlanner(max_gap=3).plan(tags).requests
+        )
+        self.assertEqual([(1, cst.HOLDING_REGISTERS, 0, 21)], ReadPlanner(max_gap=13).plan(tags).requests)
+
+    def testLimits(self):
+        """Check that a request doesn't read more than the protocol allows"""
+        plan = ReadPlanner().plan([(1, cst.HOLDING_REGISTERS, i) for i in range(300)])
+        self.assertEqual([(1, 3, 0, 125), (1, 3, 125, 125), (1, 3, 250, 50)], plan.requests)
+        plan = ReadPlanner().plan([(1, cst.COILS, i, 1000) for i in range(0, 5000, 1000)])
+        self.assertEqual([(1, 1, 0, 2000), (1, 1, 2000, 2000), (1, 1, 4000, 1000)], plan.requests)
+        plan = ReadPlanner(max_registers=10).plan([(1, cst.ANALOG_INPUTS, i) for i in range(15)])
+        self.assertEqual([(1, 4, 0, 10), (1, 4, 10, 5)], plan.requests)
+        self.assertRaises(InvalidArgumentError, ReadPlanner().plan, [(1, cst.HOLDING_REGISTERS, 0, 126)])
+        self.assertRaises(InvalidArgumentError, ReadPlanner, max_registers=126)
+
+    def testForbiddenRanges(self):
+        """Check that a forbidden range is never read for bridging a gap"""
+        planner = ReadPlanner(max_gap=10)
+        planner.add_forbidden_range(1, cst.HOLDING_REGISTERS, 4, 2)
+        tags = [(1, cst.HOLDING_REGISTERS, 0, 2), (1, cst.HOLDING_REGISTERS, 7, 2), (1, cst.HOLDING_REGISTERS, 12)]
+        self.assertEqual(
+            [(1, cst.HOLDING_REGISTERS, 0, 2), (1, cst.HOLDING_REGISTERS, 7, 6)], planner.plan(tags).requests
+        )
+        # other slaves and tables are not concerned
+        tags = [(2, cst.HOLDING_REGISTERS, 0), (2, cst.HOLDING_REGISTERS, 7), (1, cst.ANALOG_INPUTS, 0), (1, cst.ANALOG_INPUTS, 7)]
+        self.assertEqual(2, len(planner.plan(tags)))
+
+    def testTablesAreNotMixed(self):
+        """Check that every slave and table is read by its own requests"""
+        plan = ReadPlanner().plan([
+            (1, cst.HOLDING_REGISTERS, 0), (1, cst.ANALOG_INPUTS, 1), (2, cst.HOLDING_REGISTERS, 1),
+            (1, cst.COILS, 2), (1, cst.DISCRETE_INPUTS, 3)
+        ])
+        self.assertEqual(5, len(plan))
+
+
+class TestReadPlan(unittest.TestCase):
+    """Check that a plan reads the tags with a master"""
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        slave = self.server.add_slave(1)
+        slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 300)
+        slave.add_block("ir", cst.ANALOG_INPUTS, 0, 100)
+        slave.add_block("c", cst.COILS, 0, 100)
+        slave.set_values("hr", 0, list(range(300)))
+        slave.set_values("ir", 0, list(range(1000, 1100)))
+        slave.set_values("c", 10, [1, 0, 1])
+        self.server.start()
+        time.sleep(0.2)
+        self.master = modbus_tcp.TcpMaster(port=self.server._sock.getsockname()[1], timeout_in_sec=1.0)
+
+    def tearDown(self):
+        self.master.close()
+        self.server.stop()
+
+    def testExecute(self):
+        """Check that every tag gets its values"""
+        tags = [
+            (1, cst.HOLDING_REGISTERS, 290, 3), (1, cst.ANALOG_INPUTS, 5), (1, cst.COILS, 10, 3),
+            (1, cst.HOLDING_REGISTERS, 0, 2), (1, cst.HOLDING_REGISTERS, 100), (1, cst.ANALOG_INPUTS, 8, 2),
+        ]
+        plan = ReadPlanner(max_gap=5).plan(tags)
+        self.assertEqual(5, len(plan))
+        expected = [(290, 291, 292), (1005, ), (1, 0, 1), (0, 1), (100, ), (1008, 1009)]
+        self.assertEqual(expected, plan.execute(self.master))
+        # the plan can be executed again
+        self.server.get_slave(1).set_values("hr", 100, 7)
+        expected[4] = (7, )
+        self.assertEqual(expected, plan.execute(self.master, window=1))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ Modbus TestKit: Implementation of Modbus protocol in python
+
+ (C)2009 - Luc Jean - luc.jean@gmail.com
+ (C)2009 - Apidev - http://www.apidev.fr
+
+ This is distributed under GNU LGPL license, see license.txt
+"""
+
+from concurrent.futures import CancelledError
+import struct
+import sys
+import threading
+import time
+import unittest
+
+import modbus_tk
+import modbus_tk.defines as cst
+import modbus_tk.modbus
+import modbus_tk.modbus_tcp as modbus_tcp
+from modbus_tk.exceptions import DeadlineExpiredError, ModbusError
+from modbus_tk.modbus_gateway import ForwardedQuery
+from modbus_tk.scheduler import BusScheduler, PRIORITY_HIGH, PRIORITY_LOW
+
+LOGGER = modbus_tk.utils.create_logger()
+
+
+class FakeMaster(modbus_tk.modbus.Master):
+    """A master recording the queries. Every query waits until it is released"""
+
+    def __init__(self):
+        super(FakeMaster, self).__init__(1.0)
+        self.executed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def execute_prepared(self, prepared):
+        self.started.set()
+        self.release.wait(5.0)
+        self.executed.append(prepared.slave)
+        if prepared.slave == 0:
+            raise ModbusError(cst.ILLEGAL_DATA_ADDRESS)
+        return (prepared.slave, )
+
+
+class TestBusScheduler(unittest.TestCase):
+    """Check the order and the results of the queries"""
+
+    def setUp(self):
+        self.master = FakeMaster()
+        self.scheduler = BusScheduler(self.master, "fake")
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.master.release.set()
+        self.scheduler.stop()
+
+    def _block_bus(self):
+        """submit a query which keeps the bus busy until the master is released"""
+        future = self.scheduler.submit((100, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(self.master.started.wait(1.0))
+        return future
+
+    def testPriorities(self):
+        """Check that the queries are executed by priority then in the order of submission"""
+        self._block_bus()
+        futures = [
+            self.scheduler.submit((1, cst.READ_HOLDING_REGISTERS, 0, 1), PRIORITY_LOW),
+            self.scheduler.submit((2, cst.READ_HOLDING_REGISTERS, 0, 1)),
+            self.scheduler.submit((3, cst.READ_HOLDING_REGISTERS, 0, 1), PRIORITY_HIGH),
+            self.scheduler.submit((4, cst.READ_HOLDING_REGISTERS, 0, 1)),
+        ]
+        self.assertEqual(4, self.scheduler.get_queue_depth())
+        self.master.release.set()
+        self.assertEqual([(1, ), (2, ), (3, ), (4, )], [future.result(1.0) for future in futures])
+        self.assertEqual([100, 3, 2, 4, 1], self.master.executed)
+
+    def testCancelAndDeadline(self):
+        """Check that a query can be cancelled or expire before being executed"""
+        self._block_bus()
+        cancelled = self.scheduler.submit((1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        expired = self.scheduler.submit((2, cst.READ_HOLDING_REGISTERS, 0, 1), deadline=time.time() + 0.05)
+        executed = self.scheduler.submit((3, cst.READ_HOLDING_REGISTERS, 0, 1), deadline=time.time() + 10)
+        self.assertTrue(cancelled.cancel())
+        time.sleep(0.1)
+        self.master.release.set()
+        self.assertEqual((3, ), executed.result(1.0))
+        self.assertRaises(DeadlineExpiredError, expired.result, 1.0)
+        self.assertEqual([100, 3], self.master.executed)
+        stats = self.scheduler.get_stats()
+        self.assertEqual((2, 1, 1), (stats["executed"], stats["expired"], stats["cancelled"]))
+
+    def testDeadlineWhileBusy(self):
+        """Check that a query fails at its deadline while the bus is busy and that the cancelled queries are not counted"""
+        self._block_bus()
+        expired = self.scheduler.submit((1, cst.READ_HOLDING_REGISTERS, 0, 1), deadline=time.time() + 0.05)
+        cancelled = self.scheduler.submit((2, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.scheduler.submit((3, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(cancelled.cancel())
+        self.assertRaises(DeadlineExpiredError, expired.result, 1.0)
+        self.assertFalse(self.master.release.is_set())
+        self.assertEqual(1, self.scheduler.get_queue_depth())
+        stats = self.scheduler.get_stats()
+        self.assertEqual((1, 1, 1), (stats["queue_depth"], stats["expired"], stats["cancelled"]))
+
+    def testErrorAndStats(self):
+        """Check that the errors are raised by the futures and that the bus utilisation is measured"""
+        self.master.release.set()
+        self.assertRaises(ModbusError, self.scheduler.execute, (0, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertEqual((5, ), self.scheduler.execute((5, cst.READ_HOLDING_REGISTERS, 0, 1)))
+        stats = self.scheduler.get_stats()
+        self.assertEqual((2, 1, 0), (stats["executed"], stats["failed"], stats["queue_depth"]))
+        self.assertTrue(0.0 <= stats["utilisation"] <= 1.0)
+
+    def testTurnaround(self):
+        """Check that the bus is silent between 2 queries"""
+        self.master.release.set()
+        self.scheduler.turnaround = 0.1
+        self.scheduler.execute((1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        t0 = time.time()
+        self.scheduler.execute((2, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(time.time() - t0 >= 0.09)
+
+    def testBroadcastTurnaround(self):
+        """Check that the bus is silent longer after a query without response"""
+        self.master.release.set()
+        self.scheduler.broadcast_turnaround = 0.1
+        self.scheduler.execute((1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        t0 = time.time()
+        self.scheduler.execute((2, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(time.time() - t0 < 0.05)
+        broadcast = ForwardedQuery(self.master, 0, struct.pack(">BHH", cst.WRITE_SINGLE_REGISTER, 0, 1))
+        self.assertRaises(ModbusError, self.scheduler.execute, broadcast)
+        t0 = time.time()
+        self.scheduler.execute((3, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(time.time() - t0 >= 0.09)
+
+    def testStopCancelsPendingQueries(self):
+        """Check that the queries still in the queue are cancelled when stopping"""
+        self._block_bus()
+        future = self.scheduler.submit((1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        threading.Timer(0.1, self.master.release.set).start()
+        self.scheduler.stop()
+        self.assertTrue(future.cancelled())
+
+    def testSubmitAfterStop(self):
+        """Check that the queries submitted after stop are cancelled"""
+        self.scheduler.stop()
+        future = self.scheduler.submit((1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertTrue(future.cancelled())
+        self.assertRaises(CancelledError, self.scheduler.execute, (1, cst.READ_HOLDING_REGISTERS, 0, 1))
+        self.assertEqual(0, self.scheduler.get_queue_depth())
+
+
+class TestBusSchedulerWithServer(unittest.TestCase):
+    """Check that many threads can share a master through the scheduler"""
+
+    def setUp(self):
+        self.server = modbus_tcp.TcpServer(port=0, address="127.0.0.1")
+        slave = self.server.add_slave(1)
+        slave.add_block("hr", cst.HOLDING_REGISTERS, 0, 100)
+        slave.set_values("hr", 0, list(range(100)))
+        self.server.start()
+        time.sleep(0.2)
+        self.master = modbus_tcp.TcpMaster(port=self.server._sock.getsockname()[1], timeout_in_sec=1.0)
+        self.scheduler = BusScheduler(self.master, "tcp")
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.master.close()
+        self.server.stop()
+
+    def testManyThreads(self):
+        """Check that every thread gets its own result"""
+        results = {}
+
+        def read(address):
+            results[address] = self.scheduler.execute((1, cst.READ_HOLDING_REGISTERS, address, 1))
+        threads = [threading.Thread(target=read, args=(address, )) for address in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict((address, (address, )) for address in range(20)), results)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=sys.argv)